@@ -12,13 +12,14 @@ topics=(
 container_name="kafka"
 kafka_topics_script="/opt/kafka/bin/kafka-topics.sh"
 bootstrap_server="localhost:9092"
+partitions="${KAFKA_PARTITIONS:-1}"   # more partitions let more consumer workers share a topic
 
 for topic in "${topics[@]}"; do
   echo "Creating topic: $topic"
   sudo docker exec -it $container_name $kafka_topics_script --create \
     --topic $topic \
     --bootstrap-server $bootstrap_server \
-    --partitions 1 \
+    --partitions $partitions \
     --replication-factor 1
 
   if [ $? -eq 0 ]; then
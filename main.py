@@ -2,42 +2,89 @@ from src._create_dataset import DatasetCreator
 from src.producer import SimpleProducer
 from src.data_processor import DataPreprocessor
 from src.druid_data import DruidDataFetcher
-from src.model import RNNModel
+from src.druid_cleaner import DruidCleaner
+from src.model import run_model
+from src.global_model import run_global_model
 from src.postgre_db import PostgreClient
-from src.consumer import SimpleConsumer
+from src.consumer_pool import ConsumerPool
+from src.stage_scheduler import StageScheduler
+from src.model_registry import ModelRegistry
+from src.streaming_inference import run_streaming_inference
+from src.streaming_processor import run_streaming_preprocessor
 from src._logger import ProjectLogger
 import time as t
 from datetime import datetime, timedelta, time
-import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from collections import Counter
+import pandas as pd
+import multiprocessing
 import traceback
+import os
 
 
 class RunPipeline:
     logger = ProjectLogger(class_name='RunPipeline').create_logger()
+    legacy_machine = ('L301', 'Blower-Pump-1')     # the only machine the pipeline ran before fleet mode, owner of models/{interval}m
+    timeframes = {
+        '1m': {
+            'window_days': 14, 'output_days': 2, 'interval_minute': 1, 'load_best_model': True, 'incremental': False, 'chunk': '1D', 'model_memory_mb': 2048,
+            'raw_topic': 'raw-data', 'processed_topic': 'processed-data', 'predicted_topic': 'predicted-data', 'table_name': 'model_results_1m'
+        },
+        '15m': {
+            'window_days': 90, 'output_days': 10, 'interval_minute': 15, 'load_best_model': False, 'incremental': True, 'chunk': '7D', 'model_memory_mb': 1024,
+            'raw_topic': 'raw-data-15m', 'processed_topic': 'processed-data-15m', 'predicted_topic': 'predicted-data-15m', 'table_name': 'model_results_15m'
+        }
+    }
 
 
-    def __init__(self):
-        self.lstm_model = RNNModel()
+    def __init__(self, fleet:list=None, max_model_workers:int=2, memory_limit_mb:int=None, consumer_workers:int=1, global_model:bool=False, streaming:bool=False, streaming_cadence_minutes:int=15, streaming_preprocessing:bool=False):
         self.dataset_creator = DatasetCreator()
         self.producer = SimpleProducer()
         self.druid_fetcher = DruidDataFetcher()
-        self.preprocesser = DataPreprocessor()
         self.postgre_client = PostgreClient()
 
         # create postgre tables
         self.postgre_client.create_table(table_name='model_results_1m')
         self.postgre_client.create_table(table_name='model_results_15m')
+        self.postgre_client.create_forecast_table()
+        self.forecast_retention_days = 180
+        self.druid_retention_margin_days = 7     # druid keeps each timeframe's model window plus this margin
 
-        self.consumers = []
-        self.starting_date_1m = None
-        self.starting_date_15m = None
+        self.consumer_pool = None
+        self.consumer_workers = consumer_workers
+
+        # fleet mode: (line, machine) pairs share one pipeline, one set of model worker processes and one memory budget
+        self.fleet = fleet or [('L301', 'Blower-Pump-1')]
+        self.max_model_workers = max_model_workers
+        self.memory_limit_mb = memory_limit_mb
+        self.model_threads = max(1, (os.cpu_count() or 1) // max_model_workers)     # cpu cores are split between the model workers
+        self.model_pool = None      # kept between runs, the workers keep tf initialized and their artifact cache warm
+        self.batch_size = 32
+        self.global_model = global_model      # one model per timeframe trained on every machine instead of one per machine
+        self.starting_dates = {}
 
         self.starting_hour = 0
         self.starting_minute = 0
+        self.n_samples = 100    # monte-carlo rollouts per forecast
+
+        # fast path: model runs on the in-memory frames, kafka publishing happens in the background for the dashboards
+        self.fast_path = True
+        self.history = {}
+        self.publisher = ThreadPoolExecutor(max_workers=1, thread_name_prefix='kafka-publisher')
+        self.publishing = []
+
+        # streaming mode: separate processes keep processing raw data and forecasting between the nightly runs
+        self.streaming = streaming
+        self.streaming_cadence_minutes = streaming_cadence_minutes
+        self.streaming_preprocessing = streaming_preprocessing      # raw topics are processed continuously, the nightly run skips its raw druid round trip
+        self.services = {}
 
 
     def run(self):
+        self.migrate_model_directories()
         self.start_consumers()
+        self.start_services()
+        self.resume_incomplete_run()
         starting_time = datetime.combine(datetime.now().date(), time(self.starting_hour, self.starting_minute)).replace(second=0, microsecond=0)
         self.logger.info(msg=f'The program will start at {starting_time}.')
         while True:
@@ -45,6 +92,9 @@ class RunPipeline:
                 now = datetime.now()
                 if now.hour == self.starting_hour and now.minute == self.starting_minute:
                     self.pipeline()
+                    self.consumer_pool.ensure_alive()
+                    self.start_services()
+                    self.consumer_pool.report_lag()
 
                     # sleep until next midnight
                     tomorrow = datetime.now() + timedelta(days=1)
@@ -62,67 +112,361 @@ class RunPipeline:
 
     def start_consumers(self):
         topics = ['processed-data', 'processed-data-15m', 'predicted-data', 'predicted-data-15m']
-        for topic in topics:
-            consumer = SimpleConsumer()
-            thread = threading.Thread(target=consumer.main, args=(topic, topic))
-            thread.daemon = True
-            self.consumers.append(thread)
-            thread.start()
-
-
-    def pipeline(self):
-        # calculate starting and ending dates
-        if self.starting_date_1m is None and self.starting_date_15m is None:
-            self.starting_date_1m = str((datetime.now() - timedelta(days=14)).isoformat()).split('T')[0] + 'T00:00:00Z'
-            self.starting_date_15m = str((datetime.now() - timedelta(days=90)).isoformat()).split('T')[0] + 'T00:00:00Z'
-        
-        self.ending_date_15m = str((datetime.now() - timedelta(days=1)).isoformat()).split('T')[0] + 'T00:00:00Z'
-        self.ending_date_1m = str((datetime.now() - timedelta(days=1)).isoformat()).split('T')[0] + 'T00:00:00Z'
-
-        # create dataset
-        raw_df_1m = self.dataset_creator.main(start=self.starting_date_1m, stop=self.ending_date_1m, line='L301', timeframe='1m', machine='Blower-Pump-1')
-        raw_df_15m = self.dataset_creator.main(start=self.starting_date_15m, stop=self.ending_date_15m, line='L301', timeframe='15m', machine='Blower-Pump-1')
-
-        # produce raw data
-        self.producer.main(topic='raw-data', df=raw_df_1m)
-        self.producer.main(topic='raw-data-15m', df=raw_df_15m)
-
-        # fetch raw data from druid
-        t.sleep(60)  # wait for druid to consume the raw data from kafka topics
-        df_1m = self.druid_fetcher.main(topic='raw-data')
-        df_15m = self.druid_fetcher.main(topic='raw-data-15m')
-
-        # pre-process data
-        processed_df_1m = self.preprocesser.main(df=df_1m)
-        processed_df_15m = self.preprocesser.main(df=df_15m)
-
-        # produce processed data
-        self.producer.main(topic='processed-data', df=processed_df_1m)
-        self.producer.main(topic='processed-data-15m', df=processed_df_15m)
-
-        # fetch processed data from druid
-        t.sleep(60)  # wait for druid to consume the processed data from kafka topics
-        df_1m = self.druid_fetcher.main(topic='processed-data')
-        df_15m = self.druid_fetcher.main(topic='processed-data-15m')
-
-        # run lstm model
-        results_1m, predicted_data_1m = self.lstm_model.main(load_best_model=True, df=df_1m, input_days=14, output_days=2, interval_minute=1)
-        results_15m, predicted_data_15m = self.lstm_model.main(load_best_model=False, df=df_15m, input_days=90, output_days=10, interval_minute=15)
-
-        # produce predicted data and insert model results into postgre db
-        if results_1m is not None and predicted_data_1m is not None:
-            self.producer.main(topic='predicted-data', df=predicted_data_1m)
-            self.postgre_client.insert_data(table_name='model_results_1m', results=results_1m)
-
-        if results_15m is not None and predicted_data_15m is not None:
-            self.producer.main(topic='predicted-data-15m', df=predicted_data_15m)
-            self.postgre_client.insert_data(table_name='model_results_15m', results=results_15m)
-
-        # update starting dates as dataframes' last rows
-        self.starting_date_1m = raw_df_1m['time'].iloc[-1]
-        self.starting_date_15m = raw_df_15m['time'].iloc[-1]
+        self.consumer_pool = ConsumerPool(topics=topics, workers=self.consumer_workers)
+        self.consumer_pool.start()
+
+
+    def start_services(self):
+        # also used as the restart check after each nightly run, running processes are left alone
+        if self.streaming_preprocessing:
+            topics = {config['raw_topic']: config['processed_topic'] for config in self.timeframes.values()}
+            self.start_service(name='streaming-preprocessor', target=run_streaming_preprocessor, kwargs={'topics': topics})
+        if self.streaming:
+            self.start_service(name='streaming-inference', target=run_streaming_inference, kwargs={
+                'fleet': self.fleet, 'timeframes': self.timeframes, 'cadence_minutes': self.streaming_cadence_minutes,
+                'n_samples': self.n_samples, 'threads': self.model_threads, 'global_model': self.global_model
+            })
+
+
+    def start_service(self, name:str, target, kwargs:dict):
+        process = self.services.get(name)
+        if process is not None and process.is_alive():
+            return process
+        if process is not None:
+            self.logger.warning(msg=f'{name} exited with code {process.exitcode}, restarting it.')
+        process = multiprocessing.get_context('spawn').Process(target=target, kwargs=kwargs, name=name, daemon=True)
+        process.start()
+        self.services[name] = process
+        self.logger.info(msg=f'{name} started.')
+        return process
+
+
+    def model_workers(self):
+        if self.model_pool is None:
+            self.model_pool = ProcessPoolExecutor(max_workers=self.max_model_workers, mp_context=multiprocessing.get_context('spawn'))
+        return self.model_pool
+
+
+    def migrate_model_directories(self):
+        # models saved before fleet mode (models/{interval}m) or before lines were part of the path (models/{machine}/{interval}m)
+        # are moved once into models/{line}/{machine}/{interval}m, so load_best_model and fine-tuning keep using them
+        registry = ModelRegistry()
+        lines_per_machine = Counter(machine for _, machine in self.fleet)
+        for config in self.timeframes.values():
+            interval_minute = config['interval_minute']
+            for line, machine in self.fleet:
+                target = ModelRegistry.model_directory(interval_minute=interval_minute, line=line, machine=machine)
+                machine_directory = ModelRegistry.model_directory(interval_minute=interval_minute, machine=machine)
+                if lines_per_machine[machine] == 1:
+                    self.move_models(registry=registry, source=machine_directory, target=target, line=line, machine=machine)
+                elif os.path.isdir(machine_directory):
+                    self.logger.warning(msg=f'{machine_directory} can belong to any of the lines running {machine}, it is not migrated.')
+                if (line, machine) == self.legacy_machine:
+                    self.move_models(registry=registry, source=ModelRegistry.model_directory(interval_minute=interval_minute), target=target, line=line, machine=machine)
+
+
+    def move_models(self, registry:ModelRegistry, source:str, target:str, line:str, machine:str):
+        if not os.path.isdir(source):
+            return
+        model_files = [f for f in os.listdir(source) if f.startswith('model_')]
+        if len(model_files) == 0:
+            return
+        os.makedirs(target, exist_ok=True)
+        for f in model_files:
+            if not os.path.exists(os.path.join(target, f)):
+                os.replace(os.path.join(source, f), os.path.join(target, f))
+        registry.relocate(source_directory=source, target_directory=target, line=line, machine=machine)
+        self.logger.info(msg=f'{len(model_files)} model file(s) moved from {source} to {target}.')
+
+
+    def resume_incomplete_run(self):
+        # a run that crashed (or had failed stages) is finished on startup from its checkpoints instead of waiting for midnight
+        run_id = StageScheduler.latest_incomplete_run()
+        if run_id is None:
+            return
+        try:
+            ending_date = pd.Timestamp(run_id).strftime('%Y-%m-%d') + 'T00:00:00Z'
+        except ValueError:
+            self.logger.warning(msg=f'Checkpoint directory {run_id} is not a run date, it is not resumed.')
+            return
+        self.logger.info(msg=f'Incomplete run {run_id} found, resuming it.')
+        try:
+            self.pipeline(ending_date=ending_date)
+        except Exception as e:
+            self.logger.error(msg=f'Resuming run {run_id} failed, error: {e}')
+            self.logger.error(traceback.format_exc())
+
+
+    def pipeline(self, ending_date:str=None):
+        # run_id is the ending date, a resumed run passes the ending date of the run it continues
+        ending_date = ending_date or str((datetime.now() - timedelta(days=1)).isoformat()).split('T')[0] + 'T00:00:00Z'
+        scheduler = StageScheduler(run_id=ending_date.split('T')[0], max_threads=max(4, 2 * len(self.fleet)), max_processes=self.max_model_workers, memory_limit_mb=self.memory_limit_mb, process_pool=self.model_workers())
+
+        # every (line, machine, timeframe) branch is dataset -> prepare -> model -> store and independent of the others
+        # with global_model the branches of a timeframe meet in one model stage and split again for storing
+        for timeframe, config in self.timeframes.items():
+            for line, machine in self.fleet:
+                key = (line, machine, timeframe)
+                if key not in self.starting_dates:
+                    self.starting_dates[key] = str((datetime.now() - timedelta(days=config['window_days'])).isoformat()).split('T')[0] + 'T00:00:00Z'
+                self.add_branch(scheduler=scheduler, line=line, machine=machine, timeframe=timeframe, starting_date=self.starting_dates[key], ending_date=ending_date)
+            if self.global_model:
+                self.add_global_model(scheduler=scheduler, timeframe=timeframe)
+
+        # every store stage of this run writes into these day partitions, creating them here keeps the ddl off the parallel stages
+        self.prepare_forecast_partitions(ending_date=ending_date)
+
+        # segment housekeeping only submits tasks to the overlord, it needs no branch result and runs next to them
+        scheduler.add_stage(name='druid_retention', func=self.run_druid_retention)
+
+        results = scheduler.run(raise_on_failure=False)
+        self.wait_for_publishing()
+        if scheduler.broken_process_pool:
+            # a worker died (e.g. out of memory), the next run starts with fresh workers
+            self.model_pool.shutdown(wait=False, cancel_futures=True)
+            self.model_pool = None
+
+        # update starting dates as dataframes' last rows, a failed branch retries its range on the next run
+        for line, machine, timeframe in list(self.starting_dates):
+            raw_df = results.get(self.stage_name(stage='dataset', line=line, machine=machine, timeframe=timeframe))
+            if raw_df is not None and len(raw_df) > 0:
+                self.starting_dates[(line, machine, timeframe)] = raw_df['time'].iloc[-1]
+        if len(scheduler.failed) > 0:
+            self.logger.error(msg=f'{len(scheduler.failed)} stage(s) failed in the fleet run: {scheduler.failed}')
+        self.postgre_client.drop_old_partitions(retention_days=self.forecast_retention_days)
+
+
+    def prepare_forecast_partitions(self, ending_date:str):
+        # forecasts start at the last ingested row (around ending_date) and reach output_days ahead
+        start = pd.Timestamp(ending_date) - timedelta(days=1)
+        end = pd.Timestamp(ending_date) + timedelta(days=max(config['output_days'] for config in self.timeframes.values()) + 1)
+        try:
+            self.postgre_client.ensure_partitions(table_name=self.postgre_client.FORECAST_TABLE, start=start, end=end)
+        except Exception as e:
+            # copy_forecasts still creates any missing partition itself
+            self.logger.error(msg=f'Forecast partitions could not be created before the run, error: {e}')
+
+
+    def druid_retention(self):
+        # {datasource: days}, every topic of a timeframe is kept as long as that timeframe's model window needs it
+        retention = {}
+        for config in self.timeframes.values():
+            for topic in ['raw_topic', 'processed_topic', 'predicted_topic']:
+                retention[config[topic]] = config['window_days'] + self.druid_retention_margin_days
+        return retention
+
+
+    def run_druid_retention(self):
+        return DruidCleaner(retention=self.druid_retention()).main()
+
+
+    def add_branch(self, scheduler:StageScheduler, line:str, machine:str, timeframe:str, starting_date:str, ending_date:str):
+        config = self.timeframes[timeframe]
+        name = lambda stage: self.stage_name(stage=stage, line=line, machine=machine, timeframe=timeframe)
+        scheduler.add_stage(
+            name=name('dataset'),
+            func=self.dataset_creator.extract_machine,
+            kwargs={'start': starting_date, 'stop': ending_date, 'line': line, 'timeframe': timeframe, 'machine': machine}
+        )
+        scheduler.add_stage(
+            name=name('prepare'),
+            func=self.process_in_memory if self.fast_path else self.process_through_druid,
+            inputs={'raw_df': name('dataset')},
+            kwargs={
+                'line': line, 'machine': machine, 'timeframe': timeframe, 'raw_topic': config['raw_topic'], 'processed_topic': config['processed_topic'],
+                'window_days': config['window_days'], 'chunk': config['chunk'], 'starting_date': starting_date, 'ending_date': ending_date
+            }
+        )
+        if not self.global_model:
+            scheduler.add_stage(
+                name=name('model'),
+                func=run_model,
+                inputs={'df': name('prepare')},
+                kwargs={
+                    'load_best_model': config['load_best_model'], 'incremental': config['incremental'], 'input_days': config['window_days'], 'output_days': config['output_days'],
+                    'interval_minute': config['interval_minute'], 'n_samples': self.n_samples, 'line': line, 'machine': machine,
+                    'threads': self.model_threads, 'batch_size': self.batch_size
+                },
+                executor='process',
+                memory_mb=config['model_memory_mb']
+            )
+        scheduler.add_stage(
+            name=name('store'),
+            func=self.store_results,
+            inputs={'model_output': f'model_global_{timeframe}' if self.global_model else name('model')},
+            kwargs={'line': line, 'machine': machine, 'topic': config['predicted_topic'], 'table_name': config['table_name'], 'interval_minute': config['interval_minute']}
+        )
+
+
+    def add_global_model(self, scheduler:StageScheduler, timeframe:str):
+        config = self.timeframes[timeframe]
+        scheduler.add_stage(
+            name=f'collect_{timeframe}',
+            func=self.collect_frames,
+            inputs={f'{line}/{machine}': self.stage_name(stage='prepare', line=line, machine=machine, timeframe=timeframe) for line, machine in self.fleet}
+        )
+        scheduler.add_stage(
+            name=f'model_global_{timeframe}',
+            func=run_global_model,
+            inputs={'frames': f'collect_{timeframe}'},
+            kwargs={
+                'input_days': config['window_days'], 'output_days': config['output_days'],
+                'interval_minute': config['interval_minute'], 'n_samples': self.n_samples, 'load_best_model': config['load_best_model'],
+                'threads': self.model_threads, 'batch_size': self.batch_size
+            },
+            executor='process',
+            memory_mb=config['model_memory_mb'] * len(self.fleet)
+        )
+
+
+    def collect_frames(self, **frames):
+        return frames
+
+
+    def stage_name(self, stage:str, line:str, machine:str, timeframe:str):
+        return f'{stage}_{line}_{machine}_{timeframe}'
+
+
+    def process_through_druid(self, raw_df, line:str, machine:str, timeframe:str, raw_topic:str, processed_topic:str, window_days:int, chunk:str, starting_date:str, ending_date:str):
+        # runs on a scheduler thread next to the other branch, so it keeps its own fetcher and preprocessor
+        druid_fetcher = DruidDataFetcher()
+        preprocesser = DataPreprocessor()
+        raw_df = self.with_line(df=raw_df, line=line)
+        filters = self.druid_filters(line=line, machine=machine)
+
+        if self.streaming_preprocessing:
+            # the streaming preprocessor turns every raw row into a processed row, only the processed topic is waited for
+            baseline = self.count_in_druid(topic=processed_topic, df=raw_df, filters=filters, druid_fetcher=druid_fetcher)
+            self.publish(topic=raw_topic, df=raw_df).result()
+            self.wait_for_druid(topic=processed_topic, df=raw_df, filters=filters, baseline=baseline, druid_fetcher=druid_fetcher)
+        else:
+            # produce raw data and fetch it back from druid
+            baseline = self.count_in_druid(topic=raw_topic, df=raw_df, filters=filters, druid_fetcher=druid_fetcher)
+            self.publish(topic=raw_topic, df=raw_df).result()
+            self.wait_for_druid(topic=raw_topic, df=raw_df, filters=filters, baseline=baseline, druid_fetcher=druid_fetcher)
+            df = druid_fetcher.main(topic=raw_topic, start=starting_date, end=ending_date, chunk=chunk, filters=filters)
+
+            # pre-process data, produce it and fetch the model window from druid
+            processed_df = preprocesser.main(df=df)
+            baseline = self.count_in_druid(topic=processed_topic, df=processed_df, filters=filters, druid_fetcher=druid_fetcher)
+            self.publish(topic=processed_topic, df=processed_df).result()
+            self.wait_for_druid(topic=processed_topic, df=processed_df, filters=filters, baseline=baseline, druid_fetcher=druid_fetcher)
+        window_start = str((datetime.now() - timedelta(days=window_days + 1)).isoformat()).split('T')[0] + 'T00:00:00Z'
+        return druid_fetcher.main(topic=processed_topic, start=window_start, end=ending_date, chunk=chunk, filters=filters)
+
+
+    def process_in_memory(self, raw_df:pd.DataFrame, line:str, machine:str, timeframe:str, raw_topic:str, processed_topic:str, window_days:int, chunk:str, starting_date:str, ending_date:str):
+        raw_df = self.with_line(df=raw_df, line=line)
+        self.publish(topic=raw_topic, df=raw_df)
+        processed_df = None
+        if raw_df is not None and len(raw_df) > 0:
+            processed_df = DataPreprocessor().main(df=raw_df.rename(columns={'time': '__time'}))
+            if not self.streaming_preprocessing:
+                self.publish(topic=processed_topic, df=processed_df)     # otherwise the streaming preprocessor produces these rows
+
+        # the model needs the whole window, new rows are appended to what the previous runs kept in memory
+        window_start = pd.Timestamp(ending_date) - pd.Timedelta(days=window_days)
+        history = self.history.get((line, machine, timeframe))
+        if history is None and (processed_df is None or pd.Timestamp(starting_date) > window_start + pd.Timedelta(days=1)):
+            self.logger.warning(msg=f'No in-memory {line} {machine} {timeframe} data, cold start from the {processed_topic} datasource.')
+            history = DruidDataFetcher().main(topic=processed_topic, start=window_start.isoformat(), end=ending_date, chunk=chunk, filters=self.druid_filters(line=line, machine=machine))
+
+        frames = [frame for frame in [history, processed_df] if frame is not None and len(frame) > 0]
+        if len(frames) == 0:
+            return None
+        df = pd.concat(frames, ignore_index=True)
+        df['__time'] = pd.to_datetime(df['__time'], utc=True, format='ISO8601')
+        df = df.drop_duplicates(subset='__time', keep='last').sort_values('__time')
+        df = df[df['__time'] >= window_start].reset_index(drop=True)
+        self.history[(line, machine, timeframe)] = df
+        self.logger.info(msg=f'{line} {machine} {timeframe} model input prepared in memory. Shape: {df.shape}')
+        return df.copy()
+
+
+    def store_results(self, model_output:tuple, line:str, machine:str, topic:str, table_name:str, interval_minute:int):
+        # produce predicted data and insert model results into postgre db, line and machine become influx tags and postgre columns
+        if isinstance(model_output, dict):
+            model_output = model_output.get(f'{line}/{machine}', (None, None))
+        results, predicted_data = model_output
+        if results is None or predicted_data is None:
+            self.logger.warning(msg=f'No {machine} model results to store into {table_name}.')
+            return False
+        results = {**results, 'line': line, 'machine': machine}
+        self.publish(topic=topic, df=predicted_data.assign(line=line, machine=machine))
+        self.postgre_client.insert_data(table_name=table_name, results=results)
+        # raises when the forecasts could not be stored, so the stage is reported in scheduler.failed
+        self.postgre_client.copy_forecasts(predictions=predicted_data, results=results, interval_minute=interval_minute)
+        return True
+
+
+    def publish(self, topic:str, df):
+        # a single background worker keeps the topics in order while the model keeps running
+        # always returns a future, an empty frame gets an already completed one so callers can chain .result()
+        if df is None or len(df) == 0:
+            future = Future()
+            future.set_result(None)
+            return future
+        future = self.publisher.submit(self.producer.main, topic=topic, df=df.copy())
+        self.publishing.append(future)
+        return future
+
+
+    def wait_for_publishing(self):
+        for future in self.publishing:
+            future.result()
+        self.publishing = []
+
+
+    def time_bounds(self, df):
+        time_column = 'time' if 'time' in df.columns else '__time'
+        return df[time_column].min(), df[time_column].max()
+
+
+    def with_line(self, df, line:str):
+        # the same machine name can exist on several lines, every published row carries its line
+        if df is None or len(df) == 0:
+            return df
+        return df.assign(line=line)
+
+
+    def druid_filters(self, line:str, machine:str):
+        # rows published before the line column existed have no line, they still belong to their machine's history
+        return {'line': (line, None), 'machine': machine}
+
+
+    def count_in_druid(self, topic:str, df, filters:dict, druid_fetcher:DruidDataFetcher=None):
+        # rows of this machine already in the range, a re-run re-publishes the overlapping rows on top of them
+        if df is None or len(df) == 0:
+            return 0
+        druid_fetcher = druid_fetcher or self.druid_fetcher
+        start, end = self.time_bounds(df=df)
+        try:
+            rows, _ = druid_fetcher.query_progress(topic=topic, start=start, end=end, filters=filters)
+            return rows
+        except Exception as e:
+            # the datasource does not exist before the first ingestion
+            self.logger.info(msg=f'{topic} row count for {filters} is not available, 0 is assumed: {e}')
+            return 0
+
+
+    def wait_for_druid(self, topic:str, df, filters:dict, baseline:int=0, druid_fetcher:DruidDataFetcher=None):
+        # block until druid has ingested this machine's rows that were just produced to the topic
+        if df is None or len(df) == 0:
+            return
+        druid_fetcher = druid_fetcher or self.druid_fetcher
+        start, end = self.time_bounds(df=df)
+        druid_fetcher.wait_until_ready(topic=topic, start=start, end=end, expected_rows=baseline + len(df), filters=filters)
 
 
 if __name__ == '__main__':
-    run_pipeline = RunPipeline()
+    # FLEET="L301:Blower-Pump-1,L301:Blower-Pump-2" runs several machines in this one process
+    fleet = [tuple(pair.split(':', 1)) for pair in os.getenv('FLEET', '').split(',') if ':' in pair]
+    memory_limit_mb = os.getenv('MEMORY_LIMIT_MB')     # unset means no memory cap for the model stages
+    run_pipeline = RunPipeline(
+        fleet=fleet or None, max_model_workers=int(os.getenv('MAX_MODEL_WORKERS', 2)),
+        memory_limit_mb=int(memory_limit_mb) if memory_limit_mb else None, consumer_workers=int(os.getenv('CONSUMER_WORKERS', 1)),
+        global_model=os.getenv('GLOBAL_MODEL', 'false').lower() == 'true',
+        streaming=os.getenv('STREAMING_INFERENCE', 'false').lower() == 'true', streaming_cadence_minutes=int(os.getenv('STREAMING_CADENCE_MINUTES', 15)),
+        streaming_preprocessing=os.getenv('STREAMING_PREPROCESSOR', 'false').lower() == 'true'
+    )
     run_pipeline.run()
\ No newline at end of file
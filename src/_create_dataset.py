@@ -3,7 +3,28 @@ import pandas as pd
 import os
 from dotenv import load_dotenv
 import time
+import traceback
 from src._logger import ProjectLogger
+from src.dataset_cache import DatasetCache
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Literal
+import threading
+
+
+class RateLimiter:
+    def __init__(self, requests_per_second:float):
+        self.interval = 1 / requests_per_second if requests_per_second > 0 else 0
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if wait > 0:
+            time.sleep(wait)
 
 
 class DatasetCreator:
@@ -15,10 +36,15 @@ class DatasetCreator:
     URL = os.getenv('INFLUX_URL')
 
     db_columns = ['', 'result', 'table', '_start', '_stop', '_time', '_value', '_field', '_measurement', 'host', 'line', 'machine', 'name', 'slave_id', 'type']
+    field_columns = ['axialAxisRmsVibration', 'radialAxisKurtosis', 'radialAxisPeakAcceleration', 'radialAxisRmsAcceleration', 'radialAxisRmsVibration', 'temperature']
     df_columns = ['machine', 'time', 'axialAxisRmsVibration', 'radialAxisKurtosis', 'radialAxisPeakAcceleration', 'radialAxisRmsAcceleration', 'radialAxisRmsVibration', 'temperature']
+    REQUESTS_PER_SECOND = 2
+    MAX_RETRIES = 3
+    RETRY_BACKOFF_SECONDS = 2
+    CHUNK_DAYS = 7
     default_machine_list = ['Blower-Pump-1', 'Blower-Pump-2', 'Blower-Pump-3', 'Blower-Pump-4', 'Vacuum-Pump-2', 'Vacuum-Pump-3', 'Vacuum-Pump-4', 'Vacuum-Pump-5']
 
-    def __init__(self, machine_list:list=None) -> None:
+    def __init__(self, machine_list:list=None, use_cache:bool=True, cache_directory:str=None, fetch_mode:Literal['pivot', 'csv']='pivot') -> None:
         self.start = None
         self.stop = None
         self.line = None
@@ -26,10 +52,15 @@ class DatasetCreator:
         self.timeframe = None
         self.machine_list = machine_list
         self.filename = None
+        self.fetch_mode = fetch_mode
+        self.failed_machines = []
+        self.rate_limiter = RateLimiter(requests_per_second=self.REQUESTS_PER_SECOND)
 
         if self.machine_list is None:
             self.machine_list = self.default_machine_list
 
+        self.cache = DatasetCache(columns=self.df_columns, cache_directory=cache_directory) if use_cache else None
+
         self.client = InfluxDBClient(
             url=self.URL,
             token=self.TOKEN,
@@ -47,27 +78,116 @@ class DatasetCreator:
         self.machine = machine
 
         self.filename = self.create_filename()
-        self.update_query()
+        if self.cache is not None:
+            self.df = self.cache.load(start=start, stop=stop, line=line, machine=machine, timeframe=timeframe, fetch=self.fetch_range)
+        else:
+            self.df = self.fetch_range(start=start, stop=stop)
+        return self.df
+
+
+    def fetch_range(self, start:str, stop:str):
+        if self.fetch_mode == 'pivot':
+            self.query = self.create_pivot_query(start=start, stop=stop)
+            return self.fetch_pivoted_data()
+
+        self.query = self.create_query(start=start, stop=stop)
         self.fetch_data()
-        df = self.create_dataframe()
-        return df
+        return self.create_dataframe()
+
+
+    def main_multiple(self, start:str, stop:str, line:str, timeframe:str, max_workers:int=4, requests_per_second:float=None, combine:bool=True, to_csv:bool=False, allow_partial:bool=False):
+        # a machine that fails after its retries raises at the end (the others are still extracted),
+        # allow_partial=True returns the extracted ones instead and leaves the failed ones in self.failed_machines
+        self.start = start
+        self.stop = stop
+        self.line = line
+        self.timeframe = timeframe
+        self.rate_limiter = RateLimiter(requests_per_second=requests_per_second or self.REQUESTS_PER_SECOND)
+
+        frames = {}
+        self.failed_machines = []
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='influx-extract') as executor:
+            futures = {executor.submit(self.extract_machine, start, stop, line, timeframe, machine): machine for machine in self.machine_list}
+            for future in as_completed(futures):
+                machine = futures[future]
+                try:
+                    frames[machine] = future.result()
+                    self.logger.info(msg=f'{machine} extracted, interval: {timeframe}. Shape: {frames[machine].shape}')
+                except Exception as e:
+                    self.failed_machines.append(machine)
+                    self.logger.error(msg=f'Exception happened while extracting {machine} data, Error: {e}')
+                    self.logger.error(msg=traceback.format_exc())
+
+        if to_csv:
+            for machine, df in frames.items():
+                df.to_csv(f'dataset/{self.create_filename(machine=machine)}', index=False)
+
+        if len(self.failed_machines) > 0:
+            failed = [machine for machine in self.machine_list if machine in self.failed_machines]
+            if not allow_partial:
+                raise RuntimeError(f'{len(failed)}/{len(self.machine_list)} machine(s) could not be extracted, interval: {timeframe}: {failed}')
+            self.logger.warning(msg=f'{len(failed)}/{len(self.machine_list)} machine(s) are missing from the extraction, interval: {timeframe}: {failed}')
+
+        if combine:
+            ordered_frames = [frames[machine] for machine in self.machine_list if machine in frames]
+            return pd.concat(ordered_frames, ignore_index=True) if len(ordered_frames) > 0 else pd.DataFrame(columns=self.df_columns)
+        return frames
+
 
+    def extract_machine(self, start:str, stop:str, line:str, timeframe:str, machine:str):
+        fetch = lambda range_start, range_stop: self.fetch_chunked(start=range_start, stop=range_stop, line=line, timeframe=timeframe, machine=machine)
+        if self.cache is not None:
+            return self.cache.load(start=start, stop=stop, line=line, machine=machine, timeframe=timeframe, fetch=fetch)
+        return fetch(start, stop)
 
-    def main_multiple(self):
-        for machine in self.machine_list:
-            self.machine = machine
-            self.filename = self.create_filename()
-            self.update_query()
-            self.fetch_data()
-            self.convert_to_csv()
-            time.sleep(15)
+
+    def fetch_chunked(self, start:str, stop:str, line:str, timeframe:str, machine:str):
+        # long ranges are split so that a failure only retries one chunk, not the whole history
+        try:
+            boundaries = list(pd.date_range(start=pd.Timestamp(start), end=pd.Timestamp(stop), freq=f'{self.CHUNK_DAYS}D'))
+            if boundaries[-1] != pd.Timestamp(stop):
+                boundaries.append(pd.Timestamp(stop))
+            ranges = [(b1.strftime('%Y-%m-%dT%H:%M:%SZ'), b2.strftime('%Y-%m-%dT%H:%M:%SZ')) for b1, b2 in zip(boundaries[:-1], boundaries[1:])]
+        except ValueError:
+            ranges = [(start, stop)]
+
+        frames = [self.fetch_with_retry(start=range_start, stop=range_stop, line=line, timeframe=timeframe, machine=machine) for range_start, range_stop in ranges]
+        return pd.concat(frames, ignore_index=True) if len(frames) > 0 else pd.DataFrame(columns=self.df_columns)
+
+
+    def fetch_with_retry(self, start:str, stop:str, line:str, timeframe:str, machine:str):
+        if self.fetch_mode == 'pivot':
+            query = self.create_pivot_query(start=start, stop=stop, line=line, machine=machine, timeframe=timeframe)
+            run_query = self.query_pivoted_frame
+        else:
+            query = self.create_query(start=start, stop=stop, line=line, machine=machine, timeframe=timeframe)
+            run_query = self.query_csv_frame
+        for attempt in range(self.MAX_RETRIES + 1):
+            self.rate_limiter.acquire()
+            try:
+                return run_query(query=query)
+            except Exception as e:
+                if attempt == self.MAX_RETRIES:
+                    raise
+                backoff = self.RETRY_BACKOFF_SECONDS * (2 ** attempt)
+                self.logger.warning(msg=f'{machine} {start} - {stop} failed ({e}), retrying in {backoff} seconds. Attempt: {attempt + 1}/{self.MAX_RETRIES}')
+                time.sleep(backoff)
 
 
     def fetch_data(self):
-        rows = self.query_api.query_csv(query=self.query)
-        self.df = pd.DataFrame(rows, columns=self.db_columns).iloc[4:, :]
+        self.df = self.create_long_frame(rows=self.query_api.query_csv(query=self.query))
+        self.logger.info(msg=f'Data fetched successfully from InfluxDB, interval: {self.timeframe}')
+
+
+    def query_csv_frame(self, query:str):
+        # the csv fetch mode without touching self.query / self.df, so machines can be extracted in parallel
+        return self.create_wide_frame(df=self.create_long_frame(rows=self.query_api.query_csv(query=query)))
+
+
+    def create_long_frame(self, rows):
+        df = pd.DataFrame(rows, columns=self.db_columns).iloc[4:, :]
         list_for_df = []
-        for time, field, value, machine_name in zip(self.df['_time'], self.df['_field'], self.df['_value'], self.df['machine']):
+        for time, field, value, machine_name in zip(df['_time'], df['_field'], df['_value'], df['machine']):
             list_for_df.append(
                 {
                     'time': time,
@@ -76,20 +196,45 @@ class DatasetCreator:
                     'machine': machine_name
                 }
             )
-        self.df = pd.DataFrame(list_for_df)
-        self.logger.info(msg=f'Data fetched successfully from InfluxDB, interval: {self.timeframe}')
+        return pd.DataFrame(list_for_df, columns=['time', 'field', 'value', 'machine'])
+
+
+    def fetch_pivoted_data(self):
+        self.df = self.query_pivoted_frame(query=self.query)
+        self.logger.info(msg=f'Pivoted data fetched successfully from InfluxDB, interval: {self.timeframe}. Shape: {self.df.shape}')
+        return self.df
+
+
+    def query_pivoted_frame(self, query:str):
+        # influx returns one wide row per timestamp, streamed in chunks that are narrowed to float32 as they arrive
+        chunks = []
+        for chunk in self.query_api.query_data_frame_stream(query=query):
+            if chunk.empty:
+                continue
+            chunk = chunk.reindex(columns=['_time', 'machine'] + self.field_columns)
+            chunk[self.field_columns] = chunk[self.field_columns].astype('float32')
+            chunk['_time'] = pd.to_datetime(chunk['_time'], utc=True).dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+            chunks.append(chunk.rename(columns={'_time': 'time'}))
+
+        if len(chunks) > 0:
+            return pd.concat(chunks, ignore_index=True)[self.df_columns]
+        return pd.DataFrame(columns=self.df_columns)
 
 
     def create_dataframe(self):
+        self.df = self.create_wide_frame(df=self.df)
+        self.logger.info(msg=f'Data converted to dataframe, interval: {self.timeframe}. Shape: {self.df.shape}')
+        return self.df
+
+
+    def create_wide_frame(self, df:pd.DataFrame):
         data = {}
         for col in self.df_columns:
             if col == 'machine' or col == 'time':
-                data[col] = self.df.loc[self.df['field'] == 'axialAxisRmsVibration'][col].reset_index(drop=True)
+                data[col] = df.loc[df['field'] == 'axialAxisRmsVibration'][col].reset_index(drop=True)
             else:
-                data[col] = self.df.loc[self.df['field'] == col]['value'].reset_index(drop=True)
-        self.df = pd.DataFrame(data)
-        self.logger.info(msg=f'Data converted to dataframe, interval: {self.timeframe}. Shape: {self.df.shape}')
-        return self.df
+                data[col] = df.loc[df['field'] == col]['value'].reset_index(drop=True)
+        return pd.DataFrame(data)
 
 
     def convert_to_csv(self):
@@ -99,34 +244,62 @@ class DatasetCreator:
     
 
     def update_query(self):
-        self.query = f'''
+        self.query = self.create_query(start=self.start, stop=self.stop)
+
+
+    def create_query(self, start:str, stop:str, line:str=None, machine:str=None, timeframe:str=None):
+        line = line or self.line
+        machine = machine or self.machine
+        timeframe = timeframe or self.timeframe
+        return f'''
             from(bucket: "{self.BUCKET}")
-            |> range(start: {self.start}, stop: {self.stop})
+            |> range(start: {start}, stop: {stop})
             |> filter(fn: (r) => r["_measurement"] == "SmartSensor_IC_CHN")
             |> filter(fn: (r) => r["_field"] == "axialAxisRmsVibration" or r["_field"] == "radialAxisKurtosis" or r["_field"] == "radialAxisPeakAcceleration" or r["_field"] == "radialAxisRmsAcceleration" or r["_field"] == "radialAxisRmsVibration" or r["_field"] == "temperature")
             |> filter(fn: (r) => r["host"] == "smart-sensor-china")
-            |> filter(fn: (r) => r["line"] == "{self.line}")
-            |> filter(fn: (r) => r["machine"] == "{self.machine}")
-            |> aggregateWindow(every: {self.timeframe}, fn: last, createEmpty: false)
+            |> filter(fn: (r) => r["line"] == "{line}")
+            |> filter(fn: (r) => r["machine"] == "{machine}")
+            |> aggregateWindow(every: {timeframe}, fn: last, createEmpty: false)
             |> yield(name: "last")
         '''
 
 
-    def create_filename(self):
+    def create_pivot_query(self, start:str, stop:str, line:str=None, machine:str=None, timeframe:str=None):
+        line = line or self.line
+        machine = machine or self.machine
+        timeframe = timeframe or self.timeframe
+        return f'''
+            from(bucket: "{self.BUCKET}")
+            |> range(start: {start}, stop: {stop})
+            |> filter(fn: (r) => r["_measurement"] == "SmartSensor_IC_CHN")
+            |> filter(fn: (r) => r["_field"] == "axialAxisRmsVibration" or r["_field"] == "radialAxisKurtosis" or r["_field"] == "radialAxisPeakAcceleration" or r["_field"] == "radialAxisRmsAcceleration" or r["_field"] == "radialAxisRmsVibration" or r["_field"] == "temperature")
+            |> filter(fn: (r) => r["host"] == "smart-sensor-china")
+            |> filter(fn: (r) => r["line"] == "{line}")
+            |> filter(fn: (r) => r["machine"] == "{machine}")
+            |> aggregateWindow(every: {timeframe}, fn: last, createEmpty: false)
+            |> group(columns: ["machine"])
+            |> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")
+            |> keep(columns: ["_time", "machine", "axialAxisRmsVibration", "radialAxisKurtosis", "radialAxisPeakAcceleration", "radialAxisRmsAcceleration", "radialAxisRmsVibration", "temperature"])
+            |> sort(columns: ["_time"])
+        '''
+
+
+    def create_filename(self, machine:str=None):
         start = self.start.lstrip('-').rstrip('Z').replace(':', '-').replace(':', '-')
         stop = self.stop.lstrip('-').rstrip('Z').replace(':', '-').replace(':', '-')
-        return f'{self.line}-{self.machine}-dataset-{start}-{stop}-{self.timeframe}.csv'
+        return f'{self.line}-{machine or self.machine}-dataset-{start}-{stop}-{self.timeframe}.csv'
 
 
         
 if __name__ == '__main__':
-    dataset_creator = DatasetCreator(
+    dataset_creator = DatasetCreator(machine_list=['Vacuum-Pump-2'])
+    dataset_creator.main_multiple(
         start='2024-01-14T00:00:00Z',
         stop='2024-01-16T00:00:00Z',
-        machine_list=['Vacuum-Pump-2'],
-        line='L302'
+        line='L302',
+        timeframe='1m',
+        to_csv=True
     )
-    dataset_creator.main_multiple()
 
 
 
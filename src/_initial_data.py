@@ -2,14 +2,13 @@ from src._create_dataset import DatasetCreator
 from src.producer import SimpleProducer
 from src.data_processor import DataPreprocessor
 from src.druid_data import DruidDataFetcher
-from datetime import datetime, timedelta
-import time
 import pandas as pd
 from src._logger import ProjectLogger
 
 
 class PrepareInitialData:
     logger = ProjectLogger(class_name='PrepareInitialData').create_logger()
+    READY_TIMEOUT = 3600    # leaves time to introduce the topics to druid by hand
 
     def __init__(self, days_1m:int=14, days_15m:int=90):
         #self.starting_date_1m = str((datetime.now() - timedelta(days=days_1m)).isoformat()).split('T')[0] + 'T00:00:00Z'
@@ -34,8 +33,7 @@ class PrepareInitialData:
         #self.produce_messages(topic='raw-data', df=raw_df_1m) # produce 1m data to raw-data
         #input('After introducing the raw-data topic to Druid, press Enter.')
         self.produce_messages(topic='raw-data-15m', df=raw_df_15m)  # produce 15m data raw-data-15m
-        input('After introducing the raw-data-15m topic to Druid, press Enter.')
-        time.sleep(15)  # wait for druid's data consuming process
+        self.wait_for_druid(topic='raw-data-15m', df=raw_df_15m)
         #input('After introducing the Kafka topics to Druid, press Enter.')
         #df_1m = self.fecth_druid_data(topic='raw-data')     # fetch 1m data from druid raw-data topic
         df_15m = self.fecth_druid_data(topic='raw-data-15m') # fetch 15m data from druid raw-data-15m topic
@@ -44,7 +42,7 @@ class PrepareInitialData:
         #self.produce_messages(topic='processed-data', df=processed_df_1m)   # send processed 1m data to processed-data
         #input('After introducing the processed-data topic to Druid, press Enter.')
         self.produce_messages(topic='processed-data-15m', df=processed_df_15m)  # send processed 15m data to p-d-15m
-        input('After introducing the processed-data-15m topic to Druid, press Enter.')
+        self.wait_for_druid(topic='processed-data-15m', df=processed_df_15m)
 
 
     def prepare_datasets(self, start:str, stop:str, timeframe:str):
@@ -61,6 +59,12 @@ class PrepareInitialData:
             self.logger.warning(msg='Datasource is not valid!')
 
 
+    def wait_for_druid(self, topic:str, df:pd.DataFrame):
+        self.logger.info(msg=f'Introduce the {topic} topic to Druid if it is not ingested yet, the data will be used as soon as it is queryable.')
+        time_column = 'time' if 'time' in df.columns else '__time'
+        self.druid_data_fetcher.wait_until_ready(topic=topic, start=df[time_column].min(), end=df[time_column].max(), expected_rows=len(df), timeout=self.READY_TIMEOUT)
+
+
     def fecth_druid_data(self, topic:str) -> pd.DataFrame:
         return self.druid_data_fetcher.main(topic=topic)
     
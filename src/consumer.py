@@ -1,5 +1,8 @@
-from confluent_kafka import Consumer, KafkaException, KafkaError
+from confluent_kafka import Consumer, KafkaException, KafkaError, TopicPartition
 import json
+import time
+import queue
+import threading
 import traceback
 from src._logger import ProjectLogger
 from dotenv import load_dotenv
@@ -15,24 +18,36 @@ class SimpleConsumer:
     SERVER_IP = os.getenv('GCP_IP')
     logger = ProjectLogger(class_name='SimpleConsumer').create_logger()
 
-    def __init__(self) -> None:
+    RETRY_BACKOFF_SECONDS = 2
+    LAG_REPORT_INTERVAL = 60
+
+    def __init__(self, batching:bool=True, batch_size:int=5000, flush_interval:float=1.0, group_id:str='my-group') -> None:
         self.topic = None
         self.influx_bucket = None
+        self.topic_buckets = {}
+        self.batching = batching
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
         self.influx_db_client = InfluxWriter(token=self.TOKEN, url=self.INFLUX_URL, organization=self.INFLUX_ORG)
 
         self.consumer_config = {
             'bootstrap.servers': f'{self.SERVER_IP}:9092',
-            'group.id': 'my-group',
-            'auto.offset.reset': 'earliest'
+            'group.id': group_id,
+            'auto.offset.reset': 'earliest',
+            'enable.auto.commit': not self.batching     # batches commit their offsets after influx acknowledged the write
         }
         self.consumer = Consumer(self.consumer_config)
 
 
-    def main(self, topics:list, influx_bucket:str):
+    def main(self, topics:list, influx_bucket:str=None, topic_buckets:dict=None):
         try:
-            self.topics = topics
+            self.topics = [topics] if isinstance(topics, str) else list(topics)
             self.influx_bucket = influx_bucket
-            self.consume_messages()
+            self.topic_buckets = topic_buckets or {}
+            if self.batching:
+                self.consume_batches()
+            else:
+                self.consume_messages()
         except Exception as e:
             self.logger.error(msg=f'Exception happened in main function, error: {e}')
             self.logger.error(msg=traceback.format_exc())
@@ -44,8 +59,26 @@ class SimpleConsumer:
         return json.loads(data)
 
 
+    def get_bucket(self, topic:str):
+        # explicit mapping first, then the single bucket of the old one-topic consumers, otherwise the bucket named after the topic
+        return self.topic_buckets.get(topic, self.influx_bucket or topic)
+
+
+    def report_lag(self):
+        lags = {}
+        assignment = self.consumer.assignment()
+        if len(assignment) == 0:
+            return lags
+        for tp in self.consumer.position(assignment):
+            low, high = self.consumer.get_watermark_offsets(tp, timeout=5, cached=False)
+            position = tp.offset if tp.offset >= 0 else low
+            lags[f'{tp.topic}[{tp.partition}]'] = max(high - position, 0)
+        self.logger.info(msg=f'Consumer lag per partition: {lags}')
+        return lags
+
+
     def consume_messages(self):
-        self.consumer.subscribe(topics=[self.topics])
+        self.consumer.subscribe(topics=self.topics)
         while True:
             try:
                 msg = self.consumer.poll(1.0)
@@ -57,12 +90,118 @@ class SimpleConsumer:
                     else:
                         self.logger.error(msg=f'Error: {msg.error()}')
                         break
+                bucket = self.get_bucket(topic=msg.topic())
                 msg = self.deserialize_data(data=msg.value())
                 #self.logger.info(msg=f'Consumed message: {msg}')
-                self.influx_db_client.write_into_influxdb(bucket=self.influx_bucket, data=msg)
+                self.influx_db_client.write_into_influxdb(bucket=bucket, data=msg)
                 
             except KeyboardInterrupt:
                 raise
             except Exception as e:
                 self.logger.error(msg=f'Exception happened when consuming messages, error: {e}')
-                self.logger.error(traceback.format_exc())
\ No newline at end of file
+                self.logger.error(traceback.format_exc())
+
+
+    def consume_batches(self):
+        self.consumer.subscribe(topics=self.topics)
+        self.write_queue = queue.Queue(maxsize=2)    # bounded, a slow influx slows consumption down instead of growing memory
+        self.commit_queue = queue.Queue()           # offsets of written batches, committed by this (the polling) thread
+        writer_thread = threading.Thread(target=self.write_batches, daemon=True)
+        writer_thread.start()
+
+        points = {}
+        offsets = {}
+        number_of_points = 0
+        last_flush = time.monotonic()
+        last_lag_report = time.monotonic()
+        while True:
+            try:
+                messages = self.consumer.consume(num_messages=self.batch_size, timeout=self.flush_interval)
+                for msg in messages:
+                    if msg.error() is not None:
+                        if msg.error().code() == KafkaError._PARTITION_EOF:
+                            continue
+                        raise KafkaException(msg.error())
+
+                    offsets[(msg.topic(), msg.partition())] = msg.offset() + 1
+                    try:
+                        bucket = self.get_bucket(topic=msg.topic())
+                        data = self.deserialize_data(data=msg.value())
+                        points.setdefault(bucket, []).append(self.influx_db_client.create_point(bucket=bucket, data=data))
+                        number_of_points += 1
+                    except Exception as e:
+                        self.logger.error(msg=f'Message skipped, it could not be converted to a point. Offset: {msg.offset()}, error: {e}')
+
+                if len(offsets) > 0 and (number_of_points >= self.batch_size or time.monotonic() - last_flush >= self.flush_interval):
+                    commit_offsets = [TopicPartition(topic, partition, offset) for (topic, partition), offset in offsets.items()]
+                    self.enqueue_batch(batch=(points, commit_offsets))
+                    points = {}
+                    offsets = {}
+                    number_of_points = 0
+                    last_flush = time.monotonic()
+
+                self.commit_written()
+                if time.monotonic() - last_lag_report >= self.LAG_REPORT_INTERVAL:
+                    self.report_lag()
+                    last_lag_report = time.monotonic()
+            except KafkaException as e:
+                self.logger.error(msg=f'Error: {e}')
+                break
+            except KeyboardInterrupt:
+                raise
+            except Exception as e:
+                self.logger.error(msg=f'Exception happened when consuming messages, error: {e}')
+                self.logger.error(traceback.format_exc())
+
+
+    def enqueue_batch(self, batch:tuple):
+        # while the writer is behind, the partitions are paused and poll keeps the group membership alive
+        try:
+            self.write_queue.put(batch, block=False)
+            return
+        except queue.Full:
+            pass
+        assignment = self.consumer.assignment()
+        self.consumer.pause(assignment)
+        try:
+            while True:
+                try:
+                    self.write_queue.put(batch, timeout=1)
+                    break
+                except queue.Full:
+                    self.consumer.poll(0)
+                    self.commit_written()
+        finally:
+            self.consumer.resume(assignment)
+
+
+    def commit_written(self):
+        # a failed commit is only logged, the next commit covers the same offsets and a rebalance replays them
+        while True:
+            try:
+                commit_offsets = self.commit_queue.get(block=False)
+            except queue.Empty:
+                return
+            try:
+                self.consumer.commit(offsets=commit_offsets, asynchronous=False)
+            except Exception as e:
+                self.logger.warning(msg=f'Offsets of a written batch could not be committed, they are covered by the next commit. Error: {e}')
+
+
+    def write_batches(self):
+        # only the influx write is retried here, the consumer itself is never touched from this thread
+        while True:
+            points, commit_offsets = self.write_queue.get()
+            attempt = 0
+            while True:
+                try:
+                    for bucket, bucket_points in points.items():
+                        self.influx_db_client.write_points(bucket=bucket, points=bucket_points)
+                    break
+                except Exception as e:
+                    # offsets are only committed once the points are written, so keep retrying the same batch
+                    attempt += 1
+                    backoff = min(self.RETRY_BACKOFF_SECONDS * (2 ** attempt), 60)
+                    self.logger.error(msg=f'Batch of {sum(len(p) for p in points.values())} points could not be written, retrying in {backoff} seconds. Error: {e}')
+                    time.sleep(backoff)
+            self.commit_queue.put(commit_offsets)
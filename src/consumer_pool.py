@@ -0,0 +1,86 @@
+from confluent_kafka import Consumer, TopicPartition
+from dotenv import load_dotenv
+from src._logger import ProjectLogger
+from src.consumer import SimpleConsumer
+import multiprocessing
+import traceback
+import os
+
+
+def run_consumer_worker(topics:list, topic_buckets:dict, group_id:str, batch_size:int, flush_interval:float):
+    consumer = SimpleConsumer(batch_size=batch_size, flush_interval=flush_interval, group_id=group_id)
+    consumer.main(topics=topics, topic_buckets=topic_buckets)
+
+
+class ConsumerPool:
+    load_dotenv()
+    SERVER_IP = os.getenv('GCP_IP')
+    logger = ProjectLogger(class_name='ConsumerPool').create_logger()
+
+    def __init__(self, topics:list, topic_buckets:dict=None, workers:int=1, group_id:str='my-group', batch_size:int=5000, flush_interval:float=1.0, start_method:str='spawn'):
+        # every worker subscribes to every topic, kafka's group assignment spreads the partitions over workers and hosts
+        self.topics = topics
+        self.topic_buckets = topic_buckets or {topic: topic for topic in topics}
+        self.workers = workers
+        self.group_id = group_id
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.context = multiprocessing.get_context(start_method)
+        self.processes = []
+
+
+    def start(self):
+        for worker_id in range(self.workers):
+            self.processes.append(self.start_worker(worker_id=worker_id))
+        self.logger.info(msg=f'{self.workers} consumer worker(s) started for topics: {self.topics}, group: {self.group_id}')
+
+
+    def start_worker(self, worker_id:int):
+        process = self.context.Process(
+            target=run_consumer_worker,
+            args=(self.topics, self.topic_buckets, self.group_id, self.batch_size, self.flush_interval),
+            name=f'consumer-worker-{worker_id}',
+            daemon=True
+        )
+        process.start()
+        return process
+
+
+    def ensure_alive(self):
+        for worker_id, process in enumerate(self.processes):
+            if not process.is_alive():
+                self.logger.warning(msg=f'{process.name} exited with code {process.exitcode}, restarting it.')
+                self.processes[worker_id] = self.start_worker(worker_id=worker_id)
+
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join(timeout=10)
+        self.processes = []
+        self.logger.info(msg='Consumer workers stopped.')
+
+
+    def report_lag(self):
+        # committed offsets of the whole group against the high watermarks, independent of which worker owns a partition
+        lags = {}
+        consumer = Consumer({'bootstrap.servers': f'{self.SERVER_IP}:9092', 'group.id': self.group_id, 'enable.auto.commit': False})
+        try:
+            metadata = consumer.list_topics(timeout=10)
+            partitions = [
+                TopicPartition(topic, partition)
+                for topic in self.topics if topic in metadata.topics
+                for partition in metadata.topics[topic].partitions
+            ]
+            for tp in consumer.committed(partitions, timeout=10):
+                low, high = consumer.get_watermark_offsets(tp, timeout=10, cached=False)
+                committed = tp.offset if tp.offset >= 0 else low
+                lags.setdefault(tp.topic, {})[tp.partition] = max(high - committed, 0)
+            self.logger.info(msg=f'Consumer group {self.group_id} lag per topic/partition: {lags}')
+        except Exception as e:
+            self.logger.error(msg=f'Exception happened while reporting consumer lag, error: {e}')
+            self.logger.error(msg=traceback.format_exc())
+        finally:
+            consumer.close()
+        return lags
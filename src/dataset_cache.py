@@ -0,0 +1,112 @@
+import os
+import pandas as pd
+from src._logger import ProjectLogger
+
+
+class DatasetCache:
+    logger = ProjectLogger(class_name='DatasetCache').create_logger()
+    retention_days = {'1m': 14, '15m': 90}
+    time_format = '%Y-%m-%dT%H:%M:%SZ'
+    numeric_columns = ['axialAxisRmsVibration', 'radialAxisKurtosis', 'radialAxisPeakAcceleration', 'radialAxisRmsAcceleration', 'radialAxisRmsVibration', 'temperature']
+
+    def __init__(self, columns:list, cache_directory:str=None):
+        self.columns = columns
+        self.cache_directory = cache_directory
+        if self.cache_directory is None:
+            self.cache_directory = os.path.join(os.getcwd(), 'cache')
+
+
+    def load(self, start:str, stop:str, line:str, machine:str, timeframe:str, fetch):
+        # fetch(start, stop) must return the influx frame for [start, stop)
+        try:
+            start_ts = self.to_utc(timestamp=pd.Timestamp(start))
+            stop_ts = self.to_utc(timestamp=pd.Timestamp(stop))
+        except ValueError:
+            self.logger.warning(msg=f'{start} - {stop} is not an absolute range, cache is bypassed.')
+            return self.normalize(df=fetch(start, stop))
+
+        self.evict(line=line, machine=machine, timeframe=timeframe)
+        frames = []
+        hits = 0
+        for segment_start, segment_stop, kind in self.plan_segments(start=start_ts, stop=stop_ts, line=line, machine=machine, timeframe=timeframe):
+            if kind == 'hit':
+                frames.append(pd.read_parquet(self.partition_path(line=line, machine=machine, timeframe=timeframe, day=segment_start)))
+                hits += 1
+            elif kind == 'miss':
+                df = self.normalize(df=fetch(self.format_time(segment_start), self.format_time(segment_stop)))
+                self.write_partitions(df=df, start=segment_start, stop=segment_stop, line=line, machine=machine, timeframe=timeframe)
+                frames.append(df)
+            else:
+                frames.append(self.normalize(df=fetch(self.format_time(segment_start), self.format_time(segment_stop))))
+
+        df = pd.concat(frames, ignore_index=True) if len(frames) > 0 else pd.DataFrame(columns=self.columns)
+        self.logger.info(msg=f'{line}/{machine}/{timeframe} loaded with {hits} cached day(s), {len(frames) - hits} influx request(s). Shape: {df.shape}')
+        return df
+
+
+    def plan_segments(self, start:pd.Timestamp, stop:pd.Timestamp, line:str, machine:str, timeframe:str):
+        # full past days are served from (or written to) the cache, consecutive missing days are merged into one request
+        now = pd.Timestamp.now(tz='UTC')
+        segments = []
+        day = start.floor('D')
+        while day < stop:
+            day_end = day + pd.Timedelta(days=1)
+            if day >= start and day_end <= stop and day_end <= now:
+                kind = 'hit' if os.path.exists(self.partition_path(line=line, machine=machine, timeframe=timeframe, day=day)) else 'miss'
+                if kind == 'miss' and len(segments) > 0 and segments[-1][2] == 'miss':
+                    segments[-1] = (segments[-1][0], day_end, 'miss')
+                else:
+                    segments.append((day, day_end, kind))
+            else:
+                segments.append((max(day, start), min(day_end, stop), 'partial'))
+            day = day_end
+        return segments
+
+
+    def write_partitions(self, df:pd.DataFrame, start:pd.Timestamp, stop:pd.Timestamp, line:str, machine:str, timeframe:str):
+        # aggregateWindow stamps rows with the window stop, so a row belongs to the day its window started in
+        # a day without rows is not written, it is fetched again next time (late influx data, failed fetch)
+        days = (pd.to_datetime(df['time'], utc=True) - pd.Timedelta(nanoseconds=1)).dt.floor('D')
+        day = start
+        while day < stop:
+            day_df = df.loc[(days == day).to_numpy()]
+            if len(day_df) > 0:
+                path = self.partition_path(line=line, machine=machine, timeframe=timeframe, day=day)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                day_df.to_parquet(path + '.tmp', index=False)
+                os.replace(path + '.tmp', path)
+            day = day + pd.Timedelta(days=1)
+
+
+    def evict(self, line:str, machine:str, timeframe:str):
+        directory = os.path.dirname(self.partition_path(line=line, machine=machine, timeframe=timeframe, day=pd.Timestamp.now()))
+        if not os.path.exists(directory):
+            return
+
+        oldest_day = (pd.Timestamp.now() - pd.Timedelta(days=self.retention_days.get(timeframe, 90) + 1)).date().isoformat()
+        evicted = [f for f in os.listdir(directory) if f.endswith('.parquet') and f.split('.')[0] < oldest_day]
+        for f in evicted:
+            os.remove(os.path.join(directory, f))
+        if len(evicted) > 0:
+            self.logger.info(msg=f'{len(evicted)} cached day(s) evicted from {directory}')
+
+
+    def normalize(self, df:pd.DataFrame):
+        df = df.reindex(columns=self.columns)
+        for col in self.numeric_columns:
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+        return df.reset_index(drop=True)
+
+
+    def partition_path(self, line:str, machine:str, timeframe:str, day:pd.Timestamp):
+        return os.path.join(self.cache_directory, line, machine, timeframe, f'{day.date().isoformat()}.parquet')
+
+
+    def to_utc(self, timestamp:pd.Timestamp):
+        if timestamp.tz is None:
+            return timestamp.tz_localize('UTC')
+        return timestamp.tz_convert('UTC')
+
+
+    def format_time(self, timestamp:pd.Timestamp):
+        return timestamp.strftime(self.time_format)
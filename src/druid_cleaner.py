@@ -2,6 +2,7 @@ import time
 import requests
 from datetime import timedelta, datetime
 import os
+import pandas as pd
 from dotenv import load_dotenv
 from src._logger import ProjectLogger
 import traceback
@@ -10,36 +11,127 @@ import traceback
 class DruidCleaner:
     load_dotenv()
     SERVER_IP = os.getenv('GCP_IP')
-    COORDINATOR_PORT = 8081
+    COORDINATOR_PORT = 8081     # coordinator-overlord, task and rule endpoints are served from the same process
+    ROUTER_PORT = 8888
     RETENTION_DAYS = 10
+    SKIP_OFFSET_DAYS = 2        # the nightly run still ingests the last two days through kafka, they are never compacted
+    MAX_COMPACTION_TASKS = 5    # per datasource and run, a backlog of small segments is worked off over several nights
+    REQUEST_TIMEOUT = 30
     logger = ProjectLogger(class_name='DruidCleaner').create_logger()
 
 
-    def __init__(self, datasource:str='processed-data') -> None:
-        self.datasource = datasource
-        self.DRUID_COORDINATOR_URL = f'http://{self.SERVER_IP}:{self.COORDINATOR_PORT}/druid/coordinator/v1/datasources'
+    def __init__(self, datasource:str=None, retention:dict=None) -> None:
+        # retention: {datasource: days}, a single datasource keeps the old RETENTION_DAYS behaviour
+        self.retention = retention or {datasource or 'processed-data': self.RETENTION_DAYS}
+        self.DRUID_COORDINATOR_URL = f'http://{self.SERVER_IP}:{self.COORDINATOR_PORT}/druid/coordinator/v1'
+        self.DRUID_OVERLORD_URL = f'http://{self.SERVER_IP}:{self.COORDINATOR_PORT}/druid/indexer/v1'
+        self.DRUID_SQL_URL = f'http://{self.SERVER_IP}:{self.ROUTER_PORT}/druid/v2/sql'
 
 
     def main(self):
-        try:
-            payload = self.create_payload()
-            self.clean(payload=payload)
-            self.logger.info(msg=f'Old data cleaned from {self.datasource} named datasource successfully.')
-        except Exception as e:
-            self.logger.error(msg=f'Exception happened while cleaning old data from {self.datasource} named datasource!')
-            self.logger.error(msg=traceback.format_exc())
-
-
-    def create_payload(self):
-        max_timestamp = (datetime.utcnow() - timedelta(days=self.RETENTION_DAYS)).isoformat() + 'Z'
-        payload = {'interval': f'0000-01-01T00:00:00Z/{max_timestamp}'}
+        # rules -> mark unused -> kill -> compaction for every datasource, one failing datasource does not stop the others
+        summary = {}
+        for datasource, retention_days in self.retention.items():
+            try:
+                summary[datasource] = self.clean_datasource(datasource=datasource, retention_days=retention_days)
+                self.logger.info(msg=f'Retention and compaction done for {datasource} named datasource: {summary[datasource]}')
+            except Exception as e:
+                self.logger.error(msg=f'Exception happened while cleaning old data from {datasource} named datasource!')
+                self.logger.error(msg=traceback.format_exc())
+                summary[datasource] = None
+        return summary
+
+
+    def clean_datasource(self, datasource:str, retention_days:int):
+        cutoff = (datetime.utcnow() - timedelta(days=retention_days)).replace(hour=0, minute=0, second=0, microsecond=0)
+        self.set_retention_rules(datasource=datasource, retention_days=retention_days)
+        self.clean(datasource=datasource, payload=self.create_payload(cutoff=cutoff))
+        kill_task = self.submit_task(task=self.create_kill_task(datasource=datasource, cutoff=cutoff))
+        compaction_tasks = [self.submit_task(task=task) for task in self.create_compaction_tasks(datasource=datasource, cutoff=cutoff)]
+        return {'cutoff': cutoff.isoformat() + 'Z', 'kill_task': kill_task, 'compaction_tasks': [task for task in compaction_tasks if task is not None]}
+
+
+    def set_retention_rules(self, datasource:str, retention_days:int):
+        # historicals load the retention period and drop the rest, the coordinator enforces it between our runs too
+        rules = [
+            {'type': 'loadByPeriod', 'period': f'P{retention_days}D', 'includeFuture': True, 'tieredReplicants': {'_default_tier': 1}},
+            {'type': 'dropForever'}
+        ]
+        response = requests.post(f'{self.DRUID_COORDINATOR_URL}/rules/{datasource}', json=rules, timeout=self.REQUEST_TIMEOUT)
+        if response.status_code == 200:
+            self.logger.info(msg=f'{datasource} retention rules set to {retention_days} days.')
+        else:
+            self.logger.warning(msg=f'Failed to set {datasource} retention rules. Status code: {response.status_code}, Response: {response.text}')
+
+
+    def create_payload(self, cutoff:datetime):
+        payload = {'interval': f'0000-01-01T00:00:00Z/{cutoff.isoformat()}Z'}
         return payload
 
 
-    def clean(self, payload):
-        response = requests.post(f'{self.DRUID_COORDINATOR_URL}/{self.datasource}/markUnused', json=payload)
+    def clean(self, datasource:str, payload):
+        response = requests.post(f'{self.DRUID_COORDINATOR_URL}/datasources/{datasource}/markUnused', json=payload, timeout=self.REQUEST_TIMEOUT)
 
         if response.status_code == 200:
-            self.logger.info(msg='Old data deletion initiated successfully.')
+            self.logger.info(msg=f'Old {datasource} data deletion initiated successfully.')
         else:
-            self.logger.warning(msg=f'Failed to initiate data deletion. Status code: {response.status_code}, Response: {response.text}')
+            self.logger.warning(msg=f'Failed to initiate {datasource} data deletion. Status code: {response.status_code}, Response: {response.text}')
+
+
+    def create_kill_task(self, datasource:str, cutoff:datetime):
+        # marking unused only hides segments, the kill task removes them from deep storage and the metadata store
+        return {
+            'type': 'kill',
+            'id': f'kill_{datasource}_{cutoff.strftime("%Y%m%d")}_{int(time.time())}',
+            'dataSource': datasource,
+            'interval': f'0000-01-01T00:00:00Z/{cutoff.isoformat()}Z'
+        }
+
+
+    def fetch_segments(self, datasource:str):
+        query = '''
+            SELECT "start", "end", "num_rows", "size" FROM sys.segments
+            WHERE "datasource" = ? AND "is_published" = 1 AND "is_overshadowed" = 0
+        '''
+        payload = {'query': query, 'parameters': [{'type': 'VARCHAR', 'value': datasource}]}
+        response = requests.post(self.DRUID_SQL_URL, json=payload, timeout=self.REQUEST_TIMEOUT)
+        if response.status_code != 200:
+            raise requests.HTTPError(f'Segments of {datasource} could not be fetched. Status code: {response.status_code}, Response: {response.text}')
+        return pd.DataFrame(data=response.json(), columns=['start', 'end', 'num_rows', 'size'])
+
+
+    def create_compaction_tasks(self, datasource:str, cutoff:datetime):
+        # only days inside the retention that are split into more than one segment are compacted, already compacted days are skipped
+        segments = self.fetch_segments(datasource=datasource)
+        if len(segments) == 0:
+            return []
+        segments['day'] = pd.to_datetime(segments['start'], utc=True, format='ISO8601').dt.floor('D')
+        latest_day = pd.Timestamp(datetime.utcnow() - timedelta(days=self.SKIP_OFFSET_DAYS), tz='UTC').floor('D')
+        segments = segments[(segments['day'] >= pd.Timestamp(cutoff, tz='UTC')) & (segments['day'] < latest_day)]
+        counts = segments.groupby('day').size()
+        days = sorted(counts[counts > 1].index)[:self.MAX_COMPACTION_TASKS]
+        self.logger.info(msg=f'{datasource} has {int((counts > 1).sum())} day(s) with small segments, {len(days)} will be compacted in this run.')
+        return [self.create_compaction_task(datasource=datasource, day=day) for day in days]
+
+
+    def create_compaction_task(self, datasource:str, day:pd.Timestamp):
+        interval = f'{day.strftime("%Y-%m-%dT%H:%M:%SZ")}/{(day + pd.Timedelta(days=1)).strftime("%Y-%m-%dT%H:%M:%SZ")}'
+        return {
+            'type': 'compact',
+            'id': f'compact_{datasource}_{day.strftime("%Y%m%d")}_{int(time.time())}',
+            'dataSource': datasource,
+            'ioConfig': {'type': 'compact', 'inputSpec': {'type': 'interval', 'interval': interval}},
+            'granularitySpec': {'segmentGranularity': 'DAY'},
+            'tuningConfig': {'type': 'index_parallel', 'partitionsSpec': {'type': 'dynamic'}}
+        }
+
+
+    def submit_task(self, task:dict):
+        # fire and forget, the overlord runs the task in the background and the pipeline does not wait for it
+        response = requests.post(f'{self.DRUID_OVERLORD_URL}/task', json=task, timeout=self.REQUEST_TIMEOUT)
+        if response.status_code == 200:
+            task_id = response.json().get('task')
+            self.logger.info(msg=f'{task["type"]} task submitted for {task["dataSource"]}. Task id: {task_id}')
+            return task_id
+        self.logger.warning(msg=f'Failed to submit {task["type"]} task for {task["dataSource"]}. Status code: {response.status_code}, Response: {response.text}')
+        return None
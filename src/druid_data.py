@@ -12,21 +12,44 @@ class DruidDataFetcher:
     load_dotenv()
     SERVER_IP = os.getenv('GCP_IP')
     PORT = 8888
+    CHUNK_ROWS = 50000
+    READY_TIMEOUT = 600
+    POLL_INTERVAL = 5
 
     logger = ProjectLogger(class_name='DruidDataFetcher').create_logger()
+    dtypes = {
+        'axialAxisRmsVibration': 'float32',
+        'radialAxisKurtosis': 'float32',
+        'radialAxisPeakAcceleration': 'float32',
+        'radialAxisRmsAcceleration': 'float32',
+        'radialAxisRmsVibration': 'float32',
+        'temperature': 'float32',
+        'is_running': 'int8',
+        'PredictedAxialAxisRmsVibration': 'float32'
+    }
+    columns_to_drop = ['kafka.timestamp', 'kafka.key', 'kafka.topic']
+    sensor_columns = ['axialAxisRmsVibration', 'radialAxisKurtosis', 'radialAxisPeakAcceleration', 'radialAxisRmsAcceleration', 'radialAxisRmsVibration', 'temperature']
+    # columns of an empty result by topic prefix, so callers that select or check columns work on a range without rows
+    topic_schemas = {
+        'raw': ['__time', 'line', 'machine'] + sensor_columns,
+        'processed': ['__time', 'line', 'machine'] + sensor_columns + ['is_running'],
+        'predicted': ['__time', 'line', 'machine', 'PredictedAxialAxisRmsVibration']
+    }
 
     def __init__(self):
         self.topic = None
         self.url = f'http://{self.SERVER_IP}:{self.PORT}/druid/v2/sql'
 
 
-    def main(self, topic:str):
+    def main(self, topic:str, start:str=None, end:str=None, columns:list=None, chunk:str=None, filters:dict=None):
+        # start/end bound __time as [start, end), chunk (e.g. '1D') pages the range into that many separate queries
+        # filters are column equality conditions, e.g. {'machine': 'Blower-Pump-1'} when topics are shared by the fleet
         try:
             self.topic = topic
-
-            data = self.fetch()
-            df = self.convert_to_df(data=data)
-            return df
+            if start is None and end is None and columns is None and chunk is None and filters is None:
+                data = self.fetch()
+                return self.convert_to_df(data=data)
+            return self.fetch_range(start=start, end=end, columns=columns, chunk=chunk, filters=filters)
         except Exception as e:
             self.logger.error(msg=f'Exception happened while fetching data from {self.topic} named table!')
             self.logger.error(msg=traceback.format_exc())
@@ -45,6 +68,158 @@ class DruidDataFetcher:
             self.logger.warning(msg=f'Exception happened while fetching data from {self.topic} named table. That might cause an error.')
 
 
+    def fetch_range(self, start:str=None, end:str=None, columns:list=None, chunk:str=None, filters:dict=None):
+        if chunk is None or start is None or end is None:
+            ranges = [(start, end)]
+        else:
+            boundaries = list(pd.date_range(start=pd.Timestamp(start), end=pd.Timestamp(end), freq=chunk))
+            if boundaries[-1] != pd.Timestamp(end):
+                boundaries.append(pd.Timestamp(end))
+            ranges = [(b1.isoformat(), b2.isoformat()) for b1, b2 in zip(boundaries[:-1], boundaries[1:])]
+
+        frames = []
+        for range_start, range_end in ranges:
+            query, parameters = self.create_query(start=range_start, end=range_end, columns=columns, filters=filters)
+            range_frames = self.stream_query(query=query, parameters=parameters)
+            if len(range_frames) > 0:
+                range_df = pd.concat(range_frames, ignore_index=True)
+                frames.append(range_df.sort_values('__time', kind='stable') if '__time' in range_df.columns else range_df)
+        df = pd.concat(frames, ignore_index=True) if len(frames) > 0 else self.empty_frame(columns=columns)
+        self.logger.info(msg=f'Data fetched from {self.topic} named table in {len(ranges)} time chunk(s). Shape: {df.shape}')
+        return df
+
+
+    def empty_frame(self, columns:list=None):
+        if columns is None:
+            columns = self.topic_schemas.get(self.topic.split('-')[0], self.topic_schemas['processed'])
+        return pd.DataFrame(columns=columns).astype({col: dtype for col, dtype in self.dtypes.items() if col in columns})
+
+
+    def create_query(self, start:str=None, end:str=None, columns:list=None, filters:dict=None):
+        projection = ', '.join(f'"{col}"' for col in columns) if columns is not None else '*'
+        conditions = []
+        parameters = []
+        if start is not None:
+            conditions.append('__time >= TIME_PARSE(?)')
+            parameters.append({'type': 'VARCHAR', 'value': str(start)})
+        if end is not None:
+            conditions.append('__time < TIME_PARSE(?)')
+            parameters.append({'type': 'VARCHAR', 'value': str(end)})
+        self.add_filters(conditions=conditions, parameters=parameters, filters=filters)
+        where = f' WHERE {" AND ".join(conditions)}' if len(conditions) > 0 else ''
+        return f'SELECT {projection} FROM "{self.topic}"{where}', parameters
+
+
+    def add_filters(self, conditions:list, parameters:list, filters:dict=None):
+        # a value is matched with =, a tuple matches any of its values and None in it matches rows without the column
+        for col, value in (filters or {}).items():
+            values = value if isinstance(value, tuple) else (value,)
+            alternatives = []
+            for v in values:
+                if v is None:
+                    alternatives.append(f'"{col}" IS NULL')
+                else:
+                    alternatives.append(f'"{col}" = ?')
+                    parameters.append({'type': 'VARCHAR', 'value': str(v)})
+            conditions.append(alternatives[0] if len(alternatives) == 1 else f'({" OR ".join(alternatives)})')
+
+
+    def fetch_latest(self, topic:str, limit:int, filters:dict=None):
+        # the latest `limit` rows whatever their age, in ascending __time order
+        self.topic = topic
+        query, parameters = self.create_query(filters=filters)
+        frames = self.stream_query(query=f'{query} ORDER BY __time DESC LIMIT {int(limit)}', parameters=parameters)
+        if len(frames) == 0:
+            return pd.DataFrame()
+        df = pd.concat(frames, ignore_index=True).iloc[::-1].reset_index(drop=True)
+        self.logger.info(msg=f'Latest {len(df)} rows fetched from {topic} named table.')
+        return df
+
+
+    def stream_query(self, query:str, parameters:list):
+        # objectLines keeps the response a stream of rows, only CHUNK_ROWS of them are held as python objects at once
+        payload = {'query': query, 'parameters': parameters, 'resultFormat': 'objectLines'}
+        frames = []
+        rows = []
+        with requests.post(self.url, json=payload, stream=True) as response:
+            if response.status_code != 200:
+                raise requests.HTTPError(f'Druid query failed for {self.topic}. Status code: {response.status_code}, Response: {response.text}')
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                rows.append(json.loads(line))
+                if len(rows) >= self.CHUNK_ROWS:
+                    frames.append(self.convert_chunk(rows=rows))
+                    rows = []
+        if len(rows) > 0:
+            frames.append(self.convert_chunk(rows=rows))
+        return frames
+
+
+    def convert_chunk(self, rows:list):
+        df = pd.DataFrame(data=rows)
+        df = df.drop([col for col in self.columns_to_drop if col in df.columns], axis=1)
+        for col, dtype in self.dtypes.items():
+            if col in df.columns:
+                values = pd.to_numeric(df[col], errors='coerce')
+                df[col] = values.fillna(0).astype(dtype) if dtype.startswith('int') else values.astype(dtype)
+        return df
+
+
+    def wait_until_ready(self, topic:str, start:str=None, end:str=None, expected_rows:int=None, timeout:float=None, poll_interval:float=None, filters:dict=None):
+        # returns as soon as rows up to `end` (and at least expected_rows of them) are queryable, raises TimeoutError otherwise
+        # filters narrow the check to one series (e.g. {'machine': ...}) when the topic is shared by the fleet
+        timeout = timeout or self.READY_TIMEOUT
+        poll_interval = poll_interval or self.POLL_INTERVAL
+        started = time.monotonic()
+        while True:
+            try:
+                self.check_supervisor(topic=topic)
+                rows, max_time = self.query_progress(topic=topic, start=start, end=end, filters=filters)
+                if (expected_rows is None or rows >= expected_rows) and (end is None or (max_time is not None and pd.Timestamp(max_time) >= pd.Timestamp(end))):
+                    self.logger.info(msg=f'{topic} is ready after {time.monotonic() - started:.1f} seconds. Rows: {rows}, max __time: {max_time}')
+                    return rows
+                self.logger.info(msg=f'Waiting for {topic} ingestion. Rows: {rows}/{expected_rows}, max __time: {max_time}, expected: {end}')
+            except Exception as e:
+                self.logger.info(msg=f'{topic} is not queryable yet: {e}')
+
+            if time.monotonic() - started >= timeout:
+                raise TimeoutError(f'{topic} was not ingested by Druid within {timeout} seconds. Expected {expected_rows} rows up to {end}.')
+            time.sleep(poll_interval)
+
+
+    def query_progress(self, topic:str, start:str=None, end:str=None, filters:dict=None):
+        conditions = []
+        parameters = []
+        if start is not None:
+            conditions.append('__time >= TIME_PARSE(?)')
+            parameters.append({'type': 'VARCHAR', 'value': str(start)})
+        if end is not None:
+            conditions.append('__time <= TIME_PARSE(?)')
+            parameters.append({'type': 'VARCHAR', 'value': str(end)})
+        self.add_filters(conditions=conditions, parameters=parameters, filters=filters)
+        where = f' WHERE {" AND ".join(conditions)}' if len(conditions) > 0 else ''
+        query = f'SELECT COUNT(*) AS "rows", MAX(__time) AS "max_time" FROM "{topic}"{where}'
+        response = requests.post(self.url, json={'query': query, 'parameters': parameters})
+        if response.status_code != 200:
+            raise requests.HTTPError(f'Status code: {response.status_code}, Response: {response.text}')
+        data = response.json()
+        if len(data) == 0:
+            return 0, None
+        return int(data[0]['rows']), data[0]['max_time']
+
+
+    def check_supervisor(self, topic:str):
+        response = requests.get(f'http://{self.SERVER_IP}:{self.PORT}/druid/indexer/v1/supervisor/{topic}/status')
+        if response.status_code != 200:
+            return None
+        payload = response.json().get('payload', {})
+        state = payload.get('state')
+        if state is not None and state != 'RUNNING':
+            self.logger.warning(msg=f'{topic} supervisor state is {state}, detailed state: {payload.get("detailedState")}')
+        return state
+
+
     def convert_to_df(self, data:list):
         df = pd.DataFrame(data=data)
         columns_to_drop = ['kafka.timestamp', 'kafka.key', 'kafka.topic']
@@ -55,5 +230,5 @@ class DruidDataFetcher:
 
 
 if __name__ == '__main__':
-    druid_fetcher = DruidDataFetcher(topic='raw-data')
-    druid_fetcher.main()
\ No newline at end of file
+    druid_fetcher = DruidDataFetcher()
+    druid_fetcher.main(topic='raw-data', start='2024-01-14T00:00:00Z', end='2024-01-16T00:00:00Z', chunk='1D')
@@ -0,0 +1,120 @@
+import time
+import threading
+import numpy as np
+from collections import OrderedDict
+import tensorflow as tf
+from src._logger import ProjectLogger
+
+
+class AutoregressiveForecaster:
+    logger = ProjectLogger(class_name='AutoregressiveForecaster').create_logger()
+    CACHE_SIZE = 8
+
+    # one forecaster (and so one traced rollout) per model, scaler params and stats are tensors passed on every call
+    cache = OrderedDict()
+    cache_lock = threading.Lock()
+
+    def __init__(self, model, columns:list, target_column:str, thresholds:dict, stats:dict=None, feature_scaler=None, target_scaler=None, seed:int=None):
+        self.model = model
+        self.columns = list(columns)
+        self.target_column = target_column
+        self.buffer = None
+
+        target_mask = np.array([col == target_column for col in self.columns])
+        running_mask = np.array([col == 'is_running' for col in self.columns])
+        self.target_mask = tf.constant(target_mask[np.newaxis, :])
+        self.running_mask = tf.constant(running_mask[np.newaxis, :])
+        self.threshold = tf.constant(float(thresholds[target_column]), dtype=tf.float32)
+        self.params = None
+        if feature_scaler is not None and target_scaler is not None:
+            self.params = self.create_params(
+                stats=stats or {}, feature_mean=feature_scaler.mean_, feature_scale=feature_scaler.scale_,
+                target_mean=target_scaler.mean_[0], target_scale=target_scaler.scale_[0])
+
+        if seed is None:
+            self.generator = tf.random.Generator.from_non_deterministic_state()
+        else:
+            self.generator = tf.random.Generator.from_seed(seed)
+        self.compiled_rollout = tf.function(self.rollout, reduce_retracing=True)     # batch size changes with n_samples and fleet size
+
+
+    @classmethod
+    def for_model(cls, model, columns:list, target_column:str, thresholds:dict):
+        # the same model object (e.g. from ModelRegistry's artifact cache) reuses its compiled rollout instead of tracing again
+        key = (id(model), tuple(columns), target_column, float(thresholds[target_column]))
+        with cls.cache_lock:
+            forecaster = cls.cache.get(key)
+            if forecaster is not None and forecaster.model is model:
+                cls.cache.move_to_end(key)
+                return forecaster
+            forecaster = cls(model=model, columns=columns, target_column=target_column, thresholds=thresholds)
+            cls.cache[key] = forecaster
+            while len(cls.cache) > cls.CACHE_SIZE:
+                cls.cache.popitem(last=False)
+        return forecaster
+
+
+    def create_params(self, stats:dict, feature_mean, feature_scale, target_mean:float, target_scale:float):
+        # every step is computed in raw units and mapped into the feature scaler's space before it enters the window
+        lower = np.array([0.0 if col not in stats else stats[col]['mean'] - stats[col]['std'] for col in self.columns])
+        upper = np.array([0.0 if col not in stats else stats[col]['mean'] + stats[col]['std'] for col in self.columns])
+        return {
+            'lower': np.nan_to_num(lower)[np.newaxis, :].astype(np.float32),
+            'upper': np.nan_to_num(upper)[np.newaxis, :].astype(np.float32),
+            'feature_mean': np.asarray(feature_mean, dtype=np.float32)[np.newaxis, :],
+            'feature_scale': np.asarray(feature_scale, dtype=np.float32)[np.newaxis, :],
+            'target_mean': np.array([target_mean], dtype=np.float32),
+            'target_scale': np.array([target_scale], dtype=np.float32),
+        }
+
+
+    def stack_params(self, params_list:list):
+        # one row of params per window, so windows of different series can share one rollout
+        return {key: np.concatenate([params[key] for params in params_list], axis=0) for key in params_list[0]}
+
+
+    def forecast(self, window:np.ndarray, output_steps:int, n_samples:int=1, params:dict=None):
+        # window: (window_size, n_features) or (batch, window_size, n_features), already feature-scaled
+        # n_samples > 1 runs that many Monte-Carlo rollouts per window as one batch, rows are grouped per window
+        # params defaults to this forecaster's series, per-window params come from stack_params
+        window = np.asarray(window, dtype=np.float32)
+        if window.ndim == 2:
+            window = window[np.newaxis, :, :]
+        params = params or self.params
+        if n_samples > 1:
+            window = np.repeat(window, n_samples, axis=0)
+            params = {key: np.repeat(value, n_samples, axis=0) if len(value) > 1 else value for key, value in params.items()}
+
+        buffer_shape = (window.shape[0], window.shape[1] + output_steps, window.shape[2])
+        if self.buffer is None or tuple(self.buffer.shape) != buffer_shape:
+            self.buffer = tf.Variable(tf.zeros(buffer_shape, dtype=tf.float32), trainable=False)
+
+        started = time.perf_counter()
+        params = {key: tf.constant(value) for key, value in params.items()}
+        predictions = self.compiled_rollout(self.buffer, tf.constant(window), tf.constant(output_steps, dtype=tf.int32), params)
+        self.logger.info(msg=f'{output_steps} steps forecasted for {window.shape[0]} window(s) in {time.perf_counter() - started:.2f} seconds.')
+        return predictions.numpy()
+
+
+    def rollout(self, buffer, window, output_steps, params):
+        # the buffer is preallocated for window + horizon, so each step reads a slice and writes one row without shifting
+        window_size = window.shape[1]
+        batch_size = tf.shape(window)[0]
+        n_features = window.shape[2]
+        buffer[:, :window_size, :].assign(window)
+
+        predictions = tf.TensorArray(dtype=tf.float32, size=output_steps)
+        for step in tf.range(output_steps):
+            current_window = buffer[:, step:step + window_size, :]
+            pred_scaled = tf.reshape(self.model(current_window, training=False), [batch_size])
+            pred = pred_scaled * params['target_scale'] + params['target_mean']
+
+            sampled = params['lower'] + (params['upper'] - params['lower']) * self.generator.uniform(shape=[batch_size, n_features])
+            is_running = tf.cast(pred > self.threshold, tf.float32)
+            new_row = tf.where(self.running_mask, is_running[:, tf.newaxis], sampled)
+            new_row = tf.where(self.target_mask, pred[:, tf.newaxis], new_row)
+            new_row = (new_row - params['feature_mean']) / params['feature_scale']
+
+            buffer[:, step + window_size, :].assign(new_row)
+            predictions = predictions.write(step, pred)
+        return tf.transpose(predictions.stack())
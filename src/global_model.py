@@ -0,0 +1,275 @@
+import os
+import math
+import time
+import traceback
+import numpy as np
+import tensorflow as tf
+from datetime import datetime
+from sklearn.preprocessing import StandardScaler
+from tensorflow.keras.callbacks import ModelCheckpoint, EarlyStopping
+from tensorflow.keras.losses import MeanSquaredError
+from tensorflow.keras.metrics import RootMeanSquaredError
+from tensorflow.keras.optimizers import Adam
+from src._logger import ProjectLogger
+from src.model import RNNModel
+from src.windowing import SlidingWindowBuilder, configure_threading
+from src.forecaster import AutoregressiveForecaster
+from src.model_artifact import ModelArtifact
+from src.model_registry import ModelRegistry
+
+
+def run_global_model(threads:int=None, batch_size:int=None, use_registry:bool=True, **kwargs):
+    # entry point for process pools, same as run_model but one training for the whole fleet
+    configure_threading(intra_op_threads=threads, inter_op_threads=2 if threads is not None else None)
+    registry = ModelRegistry() if use_registry else None
+    return GlobalRNNModel(batch_size=batch_size, threads=threads, registry=registry).main(**kwargs)
+
+
+class GlobalRNNModel(RNNModel):
+    logger = ProjectLogger(class_name='GlobalRNNModel').create_logger()
+    machine_prefix = 'machine_'
+
+    def __init__(self, batch_size:int=None, threads:int=None, registry:ModelRegistry=None):
+        super().__init__(batch_size=batch_size, threads=threads, registry=registry)
+        self.machines = []
+        self.frames = {}
+        self.stats = {}
+        self.feature_scalers = {}
+        self.target_scalers = {}
+
+
+    def main(self, frames:dict, input_days:int, output_days:int, interval_minute:int, n_samples:int=1, load_best_model:bool=False):
+        # frames: {machine: model input dataframe}, one model is trained on the windows of every machine
+        # the machine is a one-hot input next to the sensor columns, scalers and stats stay per machine
+        # returns {machine: (results, predictions)} like RNNModel.main returns for a single machine
+        # load_best_model reuses the best registered global model as long as it was trained on the same machines
+        self.machines = sorted(machine for machine, df in frames.items() if df is not None and len(df) > 0)
+        self.frames = {machine: self.preprocess(df=frames[machine].copy()) for machine in self.machines}
+        self.stats = {machine: self.calculate_stats(df=df, multiplier=3) for machine, df in self.frames.items()}
+        self.window_size = min(math.floor(len(df) / 20) for df in self.frames.values())
+        self.interval_minute = interval_minute
+        self.n_samples = n_samples
+
+        self.input_steps = int((input_days - output_days) * 24 * (60 / interval_minute))
+        self.output_steps = int(output_days * 24 * (60 / interval_minute))
+
+        # registered with line and machine None, the directory keeps it apart from per-machine models
+        self.model_directory_path = self.global_model_directory(interval_minute=interval_minute)
+        if not os.path.exists(self.model_directory_path):
+            os.makedirs(self.model_directory_path)
+        outputs = self.load_existing_model_and_predict() if load_best_model else None
+        if outputs is None:
+            outputs = self.train_new_model_and_predict()
+        self.manage_model(job='delete')     # delete old models if len(model_files) > 5
+        return outputs
+
+
+    @staticmethod
+    def global_model_directory(interval_minute:int):
+        return os.path.join(os.getcwd(), 'models', 'global', f'{interval_minute}m')
+
+
+    def machine_columns(self):
+        return [f'{self.machine_prefix}{machine}' for machine in self.machines]
+
+
+    def load_state(self, artifact:ModelArtifact):
+        # a global artifact keeps {machine: scaler} dicts and stats, the one-hot columns fix the machine order
+        self.machines = [col[len(self.machine_prefix):] for col in artifact.columns if col.startswith(self.machine_prefix)]
+        self.feature_scalers = dict(artifact.feature_scaler)
+        self.target_scalers = dict(artifact.target_scaler)
+        self.stats = dict(artifact.stats)
+        self.window_size = artifact.window_size
+
+
+    def load_existing_model_and_predict(self):
+        # None when there is nothing to reuse, the caller trains a new model then
+        best = self.registry.select_best(interval_minute=self.interval_minute) if self.registry is not None else None
+        if best is None:
+            self.logger.info(msg=f'No registered global {self.interval_minute}m model, a new one will be trained.')
+            return None
+        try:
+            artifact = ModelRegistry.load_artifact(directory=self.model_directory_path, model_name=best['model_name'])
+        except Exception as e:
+            self.logger.error(msg=f'Exception happened while loading {best["model_name"]} named global model, a new one will be trained!')
+            self.logger.error(msg=traceback.format_exc())
+            return None
+        if artifact.columns != self.input_columns + self.machine_columns():
+            self.logger.warning(msg=f'{best["model_name"]} was trained on other machines, a new global model will be trained.')
+            return None
+        if artifact.window_size >= min(len(df) for df in self.frames.values()):
+            self.logger.warning(msg=f'{best["model_name"]} window is longer than the data, a new global model will be trained.')
+            return None
+
+        self.model_name = best['model_name']
+        self.load_state(artifact=artifact)
+        self.logger.info(msg=f'Global model {self.model_name} (val_RMSE: {best["val_rmse"]}) will be used for predictions!')
+        rows, targets, splits, machine_splits = self.prepare_rows(fit_scalers=False)
+        return self.evaluate_and_predict(model=artifact.model, rows=rows, rows_tensor=tf.constant(rows), targets=targets, splits=splits, machine_splits=machine_splits)
+
+
+    def prepare_rows(self, fit_scalers:bool=True):
+        # every machine's rows are scaled with its own scalers, the one-hot block is left unscaled so it keeps the identity
+        # windows never cross a machine boundary, each split keeps its chronological order within a machine
+        self.window_builder = SlidingWindowBuilder(window_size=self.window_size, threads=self.threads)
+        target_index = self.input_columns.index(self.target_column)
+        rows, targets = [], []
+        splits = {'train': [], 'test': [], 'val': []}
+        machine_splits = {}
+        offset = 0
+        for machine_index, machine in enumerate(self.machines):
+            data = self.frames[machine].to_numpy(dtype=np.float32)
+            n_windows = len(data) - self.window_size
+            train_size = int(n_windows * self.train_size)
+            test_size = int(n_windows * self.test_size)
+
+            if fit_scalers:
+                feature_scaler = StandardScaler().fit(data[:train_size + self.window_size - 1])
+                target_scaler = StandardScaler().fit(data[self.window_size:self.window_size + train_size, target_index].reshape(-1, 1))
+            else:
+                feature_scaler, target_scaler = self.feature_scalers[machine], self.target_scalers[machine]
+            one_hot = np.zeros((len(data), len(self.machines)), dtype=np.float32)
+            one_hot[:, machine_index] = 1.0
+            rows.append(np.concatenate([feature_scaler.transform(data), one_hot], axis=1).astype(np.float32))
+            # target of the window starting at row i is row i + window_size
+            targets.append(np.concatenate([target_scaler.transform(data[self.window_size:, target_index].reshape(-1, 1))[:, 0], np.zeros(self.window_size, dtype=np.float32)]))
+
+            starts = offset + np.arange(n_windows)
+            machine_splits[machine] = {
+                'train': starts[:train_size],
+                'test': starts[train_size:train_size + test_size],
+                'val': starts[train_size + test_size:],
+                'last': offset + len(data) - self.window_size
+            }
+            for split in splits:
+                splits[split].append(machine_splits[machine][split])
+            self.feature_scalers[machine] = feature_scaler
+            self.target_scalers[machine] = target_scaler
+            offset += len(data)
+
+        rows = np.concatenate(rows, axis=0)
+        targets = np.concatenate(targets).astype(np.float32)
+        splits = {split: np.concatenate(starts) for split, starts in splits.items()}
+        self.logger.info(msg=f'{len(self.machines)} machines, {len(rows)} rows, train/test/val windows: {[len(starts) for starts in splits.values()]}')
+        return rows, targets, splits, machine_splits
+
+
+    def train_new_model_and_predict(self):
+        rows, targets, splits, machine_splits = self.prepare_rows()
+        rows_tensor = tf.constant(rows)     # one copy on the tf side, shared by every dataset below
+        train_dataset = self.window_builder.dataset(rows=rows_tensor, starts=splits['train'], targets=targets[splits['train']], batch_size=self.batch_size, shuffle=True)
+        val_dataset = self.window_builder.dataset(rows=rows_tensor, starts=splits['val'], targets=targets[splits['val']], batch_size=self.batch_size, cache=True)
+        test_dataset = self.window_builder.dataset(rows=rows_tensor, starts=splits['test'], targets=targets[splits['test']], batch_size=self.batch_size)
+
+        lstm_model = self.create_lstm(window_size=self.window_size, n_features=rows.shape[1])
+        early_stopping = EarlyStopping(monitor='val_loss', patience=5, restore_best_weights=True)
+        self.model_name = f'model_{int(time.time())}_{self.interval_minute}m.keras'
+        checkpoint = ModelCheckpoint(f'{self.model_directory_path}/{self.model_name}', save_best_only=True)
+        lstm_model.compile(loss=MeanSquaredError(), optimizer=Adam(learning_rate=0.0001), metrics=[RootMeanSquaredError()])
+        history = lstm_model.fit(train_dataset, validation_data=val_dataset, epochs=self.EPOCHS, callbacks=[checkpoint, early_stopping])
+        val_rmse_history = history.history.get('val_root_mean_squared_error', [])
+        self.val_RMSE = float(min(val_rmse_history)) if len(val_rmse_history) > 0 else None
+
+        outputs = self.evaluate_and_predict(model=lstm_model, rows=rows, rows_tensor=rows_tensor, targets=targets, splits=splits, machine_splits=machine_splits, test_dataset=test_dataset)
+        self.save_global_artifact(model=lstm_model, outputs=outputs)
+        return outputs
+
+
+    def evaluate_and_predict(self, model, rows:np.ndarray, rows_tensor, targets:np.ndarray, splits:dict, machine_splits:dict, test_dataset=None):
+        lstm_model = model
+        if test_dataset is None:
+            test_dataset = self.window_builder.dataset(rows=rows_tensor, starts=splits['test'], targets=targets[splits['test']], batch_size=self.batch_size)
+        test_MSE, test_RMSE = lstm_model.evaluate(test_dataset)
+        self.test_MSE, self.test_RMSE = test_MSE, test_RMSE
+
+        predictions = self.predict_future_values(rows=rows, model=lstm_model, machine_splits=machine_splits)
+        outputs = {}
+        for machine in self.machines:
+            try:
+                outputs[machine] = self.create_results(
+                    machine=machine, model=lstm_model, rows=rows_tensor, targets=targets, starts=machine_splits[machine]['test'],
+                    predictions=predictions[machine], test_MSE=test_MSE, test_RMSE=test_RMSE)
+            except Exception as e:
+                self.logger.error(msg=f'Exception happened while creating {machine} results!')
+                self.logger.error(msg=traceback.format_exc())
+                outputs[machine] = (None, None)
+        return outputs
+
+
+    def save_global_artifact(self, model, outputs:dict):
+        # per-machine scalers and stats travel as {machine: ...} dicts, the columns keep the one-hot order
+        if all(results is None for results, _ in outputs.values()):
+            return
+        metrics = {'test_MSE': self.test_MSE, 'test_RMSE': self.test_RMSE, 'val_RMSE': self.val_RMSE}
+        try:
+            artifact = ModelArtifact(
+                model=model, feature_scaler=dict(self.feature_scalers), target_scaler=dict(self.target_scalers), stats=dict(self.stats),
+                window_size=self.window_size, columns=self.input_columns + self.machine_columns(), target_column=self.target_column,
+                metrics=self.convert_numpy_types(data=metrics))
+            artifact.save(directory=self.model_directory_path, model_name=self.model_name, save_model=not os.path.exists(os.path.join(self.model_directory_path, self.model_name)))
+        except Exception as e:
+            self.logger.error(msg=f'Exception happened while saving {self.model_name} global artifact!')
+            self.logger.error(msg=traceback.format_exc())
+            return
+        if self.registry is not None:
+            self.registry.register(
+                directory=self.model_directory_path, model_name=self.model_name, interval_minute=self.interval_minute, metrics=self.convert_numpy_types(data=metrics),
+                train_start=min(df.index[0] for df in self.frames.values()).to_pydatetime(), train_end=max(df.index[-1] for df in self.frames.values()).to_pydatetime())
+
+
+    def machine_params(self, forecaster:AutoregressiveForecaster, machine:str):
+        # the machine's own scaler and stats, extended with an identity block for the one-hot columns
+        machine_index = self.machines.index(machine)
+        stats = dict(self.stats[machine])
+        for column_index, column in enumerate(self.machine_columns()):
+            stats[column] = {'mean': float(column_index == machine_index), 'std': 0.0}
+        return forecaster.create_params(
+            stats=stats,
+            feature_mean=np.concatenate([self.feature_scalers[machine].mean_, np.zeros(len(self.machines))]),
+            feature_scale=np.concatenate([self.feature_scalers[machine].scale_, np.ones(len(self.machines))]),
+            target_mean=self.target_scalers[machine].mean_[0],
+            target_scale=self.target_scalers[machine].scale_[0])
+
+
+    def forecast_machine(self, model, machine:str, window:np.ndarray, output_steps:int):
+        # one machine's raw input_columns window through the global model, used by streaming inference after load_state
+        one_hot = np.zeros((len(window), len(self.machines)), dtype=np.float32)
+        one_hot[:, self.machines.index(machine)] = 1.0
+        scaled = np.concatenate([self.feature_scalers[machine].transform(window), one_hot], axis=1).astype(np.float32)
+        forecaster = AutoregressiveForecaster.for_model(model=model, columns=self.input_columns + self.machine_columns(), target_column=self.target_column, thresholds=self.thresholds)
+        return forecaster.forecast(window=scaled, output_steps=output_steps, n_samples=self.n_samples, params=self.machine_params(forecaster=forecaster, machine=machine))
+
+
+    def predict_future_values(self, rows:np.ndarray, model, machine_splits:dict):
+        # one rollout for the whole fleet, every window carries its own machine's scaler and stats rows
+        columns = self.input_columns + self.machine_columns()
+        forecaster = AutoregressiveForecaster.for_model(model=model, columns=columns, target_column=self.target_column, thresholds=self.thresholds)
+        windows, params = [], []
+        for machine in self.machines:
+            last = machine_splits[machine]['last']
+            windows.append(rows[last:last + self.window_size])
+            params.append(self.machine_params(forecaster=forecaster, machine=machine))
+
+        predictions = forecaster.forecast(window=np.stack(windows), output_steps=self.output_steps, n_samples=self.n_samples, params=forecaster.stack_params(params_list=params))
+        predictions = predictions.reshape(len(self.machines), self.n_samples, self.output_steps)
+        return {machine: predictions[machine_index] for machine_index, machine in enumerate(self.machines)}
+
+
+    def create_results(self, machine:str, model, rows, targets:np.ndarray, starts:np.ndarray, predictions:np.ndarray, test_MSE:float, test_RMSE:float):
+        target_scaler = self.target_scalers[machine]
+        y_pred_scaled = model.predict(self.window_builder.dataset(rows=rows, starts=starts, batch_size=self.batch_size), verbose=0)
+        y_test = target_scaler.inverse_transform(targets[starts].reshape(-1, 1))
+        y_pred = target_scaler.inverse_transform(y_pred_scaled)
+
+        timestamped_predictions = self.add_time_column_to_predicted_values(predictions=predictions, interval_minute=self.interval_minute)
+        results = self.calculate_metrics(y_test=y_test, y_pred=y_pred)
+        results['test_MSE'] = test_MSE
+        results['test_RMSE'] = test_RMSE
+        results['breakdown_probability'] = self.calculate_breakdown_probability(predictions=timestamped_predictions, column=self.target_column)
+        results['peak_breakdown_probability'] = self.calculate_peak_breakdown_probability(predictions=timestamped_predictions, column=self.target_column)
+        results['n_samples'] = self.n_samples
+        results['timestamp'] = datetime.now().replace(second=0, microsecond=0)
+        results['model_name'] = f'global/{self.model_name}'
+        results = self.convert_numpy_types(data=results)
+        self.logger.info(msg=f'{machine} results:\n{results}')
+        return results, timestamped_predictions
@@ -5,6 +5,7 @@ from src._logger import ProjectLogger
 import traceback
 import os
 import time
+import math
 from pytz import timezone, UTC
 from datetime import datetime
 
@@ -13,6 +14,9 @@ class InfluxWriter:
     load_dotenv()
     TOKEN = os.getenv('MY_INFLUX_TOKEN')
     logger = ProjectLogger(class_name='InfluxWriter').create_logger()
+    prediction_band_fields = ['PredictedAxialAxisRmsVibrationP05', 'PredictedAxialAxisRmsVibrationP95', 'BreakdownProbability']
+    fleet_tags = ['line', 'machine']
+    sensor_fields = ['axialAxisRmsVibration', 'radialAxisKurtosis', 'radialAxisPeakAcceleration', 'radialAxisRmsAcceleration', 'radialAxisRmsVibration', 'temperature']
 
     def __init__(self, token:str, url:str, organization:str):
         self.token = token
@@ -27,31 +31,8 @@ class InfluxWriter:
 
     def write_into_influxdb(self, bucket:str, data:dict):
         try:
-            self.bucket = bucket       
-            data['time'] = datetime.fromisoformat(str(data['time']).rstrip('Z'))
-            nanosecond_timestamp = int(data['time'].astimezone(UTC).timestamp() * 1e9)
-            if self.bucket == 'predicted-data' or self.bucket == 'predicted-data-15m':
-                point = (
-                    Point(measurement_name='prediction')
-                    .time(nanosecond_timestamp, WritePrecision.NS)
-                    .tag('topic', bucket)
-                    .field('PredictedAxialAxisRmsVibration', float(data['PredictedAxialAxisRmsVibration']))
-                )
-            else:
-                data['is_running'] = int(data['is_running'])
-                point = (
-                    Point(measurement_name='sensor_data')
-                    .time(nanosecond_timestamp, WritePrecision.NS)
-                    .tag('topic', bucket)
-                    .field('machine', data['machine'])
-                    .field('axialAxisRmsVibration', float(data['axialAxisRmsVibration']))
-                    .field('radialAxisKurtosis', float(data['radialAxisKurtosis']))
-                    .field('radialAxisPeakAcceleration', float(data['radialAxisPeakAcceleration']))
-                    .field('radialAxisRmsAcceleration', float(data['radialAxisRmsAcceleration']))
-                    .field('radialAxisRmsVibration', float(data['radialAxisRmsVibration']))
-                    .field('temperature', float(data['temperature']))
-                    .field('is_running', data['is_running'])
-                )
+            self.bucket = bucket
+            point = self.create_point(bucket=bucket, data=data)
             self.write_api.write(bucket=self.bucket, org=self.organization, record=point, write_precision=WritePrecision.NS)
             #self.logger.info(msg=f'Data uploaded successfully into {self.bucket} named Influx DB bucket.')
         except Exception as e:
@@ -59,5 +40,52 @@ class InfluxWriter:
             self.logger.error(msg=traceback.format_exc())
 
 
+    def write_points(self, bucket:str, points:list):
+        # one request for the whole batch, raises so that the caller can decide whether to commit offsets
+        self.write_api.write(bucket=bucket, org=self.organization, record=points, write_precision=WritePrecision.NS)
+
+
+    def create_point(self, bucket:str, data:dict):
+        data['time'] = datetime.fromisoformat(str(data['time']).rstrip('Z'))
+        nanosecond_timestamp = int(data['time'].astimezone(UTC).timestamp() * 1e9)
+        if bucket == 'predicted-data' or bucket == 'predicted-data-15m':
+            point = (
+                Point(measurement_name='prediction')
+                .time(nanosecond_timestamp, WritePrecision.NS)
+                .tag('topic', bucket)
+            )
+            fields = ['PredictedAxialAxisRmsVibration'] + self.prediction_band_fields
+        else:
+            point = (
+                Point(measurement_name='sensor_data')
+                .time(nanosecond_timestamp, WritePrecision.NS)
+                .tag('topic', bucket)
+                .field('machine_name', str(data['machine']))  # the machine tag below is the series key, a same-named field would shadow it in flux
+            )
+            if self.is_missing(data.get('is_running')) == False:
+                point.field('is_running', int(data['is_running']))
+            fields = self.sensor_fields
+
+        # missing values arrive as null (bulk serializer) or "nan" (row serializer), the field is left out like before
+        for field in fields:
+            if self.is_missing(data.get(field)) == False:
+                point.field(field, float(data[field]))
+
+        # fleet mode: every machine's series is kept apart by its tags
+        for tag in self.fleet_tags:
+            if data.get(tag) is not None:
+                point.tag(tag, str(data[tag]))
+        return point
+
+
+    def is_missing(self, value):
+        if value is None:
+            return True
+        try:
+            return math.isnan(float(value))
+        except (TypeError, ValueError):
+            return True
+
+
     def close_connection(self):
         self.client.close()
\ No newline at end of file
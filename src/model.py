@@ -12,6 +12,10 @@ from tensorflow.keras.optimizers import Adam
 from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
 from sklearn.preprocessing import StandardScaler
 from src._logger import ProjectLogger
+from src.windowing import SlidingWindowBuilder, configure_threading
+from src.forecaster import AutoregressiveForecaster
+from src.model_artifact import ModelArtifact
+from src.model_registry import ModelRegistry
 from datetime import datetime
 import math
 import traceback
@@ -19,6 +23,14 @@ import time
 from typing import Literal
 
 
+def run_model(threads:int=None, batch_size:int=None, use_registry:bool=True, **kwargs):
+    # entry point for process pools, the model is built in the worker so nothing tf related crosses the process boundary
+    # threads splits the host's cores between the model workers running side by side
+    configure_threading(intra_op_threads=threads, inter_op_threads=2 if threads is not None else None)
+    registry = ModelRegistry() if use_registry else None
+    return RNNModel(batch_size=batch_size, threads=threads, registry=registry).main(**kwargs)
+
+
 class RNNModel:
     logger = ProjectLogger(class_name='RNNModel').create_logger()
     thresholds = {
@@ -30,9 +42,21 @@ class RNNModel:
     input_columns = ['axialAxisRmsVibration', 'radialAxisKurtosis', 'radialAxisPeakAcceleration', 'radialAxisRmsAcceleration', 'radialAxisRmsVibration', 'temperature', 'is_running']
     target_column = 'axialAxisRmsVibration'
     EPOCHS = 10
-
-    def __init__(self):
+    BATCH_SIZE = 32
+    FINE_TUNE_EPOCHS = 3
+    FINE_TUNE_LEARNING_RATE = 0.00005
+    REPLAY_RATIO = 1.0      # old windows replayed per new window while fine-tuning
+    HOLDOUT_RATIO = 0.2     # share of the new windows kept for the promotion check, never seen by fit
+    VALIDATION_RATIO = 0.1  # share of the new windows early stopping monitors while fine-tuning
+
+    def __init__(self, batch_size:int=None, threads:int=None, registry:ModelRegistry=None):
         self.df = None
+        self.batch_size = batch_size or self.BATCH_SIZE
+        self.threads = threads
+        self.registry = registry
+        self.line = None
+        self.machine = None
+        self.val_RMSE = None
         self.input_steps = None
         self.output_steps = None
         self.window_size = None
@@ -40,21 +64,28 @@ class RNNModel:
         self.model_directory_path = None
         self.train_size = 0.7   # percentage
         self.test_size = 0.2     # percentage
+        self.n_samples = 1
         self.start_time = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
 
 
-    def main(self, load_best_model:bool, df:pd.DataFrame, input_days:int, output_days:int, interval_minute:int, model_name:str=None):
+    def main(self, load_best_model:bool, df:pd.DataFrame, input_days:int, output_days:int, interval_minute:int, model_name:str=None, n_samples:int=1, machine:str=None, incremental:bool=False, line:str=None):
+        # incremental fine-tunes the latest saved model on the days that arrived since it was trained
         self.df = self.preprocess(df=df)
         self.stats = self.calculate_stats(df=self.df, multiplier=3)
         self.window_size = math.floor(len(self.df) / 20)
         self.interval_minute = interval_minute
         self.model_name = model_name
         self.load_best_model = load_best_model
+        self.incremental = incremental
+        self.line = line
+        self.machine = machine
+        self.n_samples = n_samples
 
         self.input_steps = int((input_days - output_days) * 24 * (60 / interval_minute))
         self.output_steps = int(output_days * 24 * (60 / interval_minute))
 
-        self.model_directory_path = os.path.join(os.getcwd(), 'models', f'{interval_minute}m')
+        # fleet mode keeps one model directory per (line, machine), the same machine name can exist on several lines
+        self.model_directory_path = ModelRegistry.model_directory(interval_minute=interval_minute, line=line, machine=machine)
         if not os.path.exists(self.model_directory_path):
             os.makedirs(self.model_directory_path)
         results, predictions = self.manage_model(job='select')     # select model, make predictions, save best model
@@ -63,6 +94,17 @@ class RNNModel:
 
 
     def load_existing_model_and_predict(self, model_name:str):
+        if ModelArtifact.exists(directory=self.model_directory_path, model_name=model_name):
+            try:
+                artifact = ModelRegistry.load_artifact(directory=self.model_directory_path, model_name=model_name)
+                self.logger.info(msg=f'{model_name} named model successfully loaded with its scalers!')
+            except Exception as e:
+                self.logger.error(msg=f'Exception happened while loading {model_name} named model!')
+                self.logger.error(msg=traceback.format_exc())
+                return None, None
+            return self.predict_with_artifact(artifact=artifact)
+
+        # models saved before the artifact format need their scalers refitted once, the artifact is written afterwards
         try:
             lstm_model = tf.keras.models.load_model(f'{self.model_directory_path}/{model_name}')
             self.logger.info(msg=f'{model_name} named model successfully loaded!')
@@ -71,18 +113,25 @@ class RNNModel:
             self.logger.error(msg=traceback.format_exc())
             return None, None
 
+        self.window_size = lstm_model.input_shape[1]
         X, y = self.prepare_data(df=self.df, window_size=self.window_size)
         X_train, y_train, X_test, y_test, X_val, y_val = self.split_data(X=X, y=y, train_size=self.train_size, test_size=self.test_size)
         X_train_scaled, X_test_scaled, X_val_scaled, feature_scaler = self.scale_features(X_train=X_train, X_test=X_test, X_val=X_val)
         y_train_scaled, y_test_scaled, y_val_scaled, target_scaler = self.scale_targets(y_train=y_train, y_test=y_test, y_val=y_val)
 
-        predictions = self.predict_future_values(X=X, model=lstm_model, output_steps=self.output_steps, feature_scaler=feature_scaler, target_scaler=target_scaler)
+        predictions = self.predict_future_values(window=self.last_window(), model=lstm_model, output_steps=self.output_steps, feature_scaler=feature_scaler, target_scaler=target_scaler)
         timestamped_predictions = self.add_time_column_to_predicted_values(predictions=predictions, interval_minute=self.interval_minute)
         breakdown_probability = self.calculate_breakdown_probability(predictions=timestamped_predictions, column=self.target_column)
         results = self.calculate_model_performance(model=lstm_model, X_test_scaled=X_test_scaled, y_test=y_test, target_scaler=target_scaler)
         results['test_MSE'] = 0
         results['test_RMSE'] = 0
+        # the file name carries the real training time, fine-tuning must still see the days since then as new
+        self.save_artifact(model=lstm_model, model_name=model_name, feature_scaler=feature_scaler, target_scaler=target_scaler, results=results,
+                           trained_at=self.model_trained_at(model_name=model_name).to_pydatetime())
+        self.register_model(model_name=model_name, results=results)
         results['breakdown_probability'] = breakdown_probability
+        results['peak_breakdown_probability'] = self.calculate_peak_breakdown_probability(predictions=timestamped_predictions, column=self.target_column)
+        results['n_samples'] = self.n_samples
         results['timestamp'] = datetime.now().replace(second=0, microsecond=0)
         results['model_name'] = str(self.model_name)
         results = self.convert_numpy_types(data=results)
@@ -100,13 +149,18 @@ class RNNModel:
             X_train_scaled=X_train_scaled, X_test_scaled=X_test_scaled, X_val_scaled=X_val_scaled,
             y_train_scaled=y_train_scaled, y_test_scaled=y_test_scaled, y_val_scaled=y_val_scaled)
         
-        predictions = self.predict_future_values(X=X, model=lstm_model, output_steps=self.output_steps, feature_scaler=feature_scaler, target_scaler=target_scaler)
+        predictions = self.predict_future_values(window=self.last_window(), model=lstm_model, output_steps=self.output_steps, feature_scaler=feature_scaler, target_scaler=target_scaler)
         timestamped_predictions = self.add_time_column_to_predicted_values(predictions=predictions, interval_minute=self.interval_minute)
         breakdown_probability = self.calculate_breakdown_probability(predictions=timestamped_predictions, column=self.target_column)
         results = self.calculate_model_performance(model=lstm_model, X_test_scaled=X_test_scaled, y_test=y_test, target_scaler=target_scaler)
         results['test_MSE'] = test_MSE
         results['test_RMSE'] = test_RMSE
+        results['val_RMSE'] = self.val_RMSE
+        self.save_artifact(model=lstm_model, model_name=self.model_name, feature_scaler=feature_scaler, target_scaler=target_scaler, results=results)
+        self.register_model(model_name=self.model_name, results=results)
         results['breakdown_probability'] = breakdown_probability
+        results['peak_breakdown_probability'] = self.calculate_peak_breakdown_probability(predictions=timestamped_predictions, column=self.target_column)
+        results['n_samples'] = self.n_samples
         results['timestamp'] = datetime.now().replace(second=0, microsecond=0)
         results['model_name'] = str(self.model_name)
         results = self.convert_numpy_types(data=results)
@@ -114,6 +168,117 @@ class RNNModel:
         return results, timestamped_predictions
 
 
+    def fine_tune_model_and_predict(self, model_name:str):
+        # the model keeps the scalers it was trained with when it has an artifact, older models get them refitted
+        artifact = None
+        try:
+            if ModelArtifact.exists(directory=self.model_directory_path, model_name=model_name):
+                artifact = ModelArtifact.load(directory=self.model_directory_path, model_name=model_name)
+                lstm_model = artifact.model
+            else:
+                lstm_model = tf.keras.models.load_model(f'{self.model_directory_path}/{model_name}')
+            self.logger.info(msg=f'{model_name} named model successfully loaded!')
+        except Exception as e:
+            self.logger.error(msg=f'Exception happened while loading {model_name} named model, new model will be trained!')
+            self.logger.error(msg=traceback.format_exc())
+            return self.train_new_model_and_predict()
+
+        # the saved model fixes the window size, the data window is cut to match it
+        self.window_size = lstm_model.input_shape[1]
+        X, y = self.prepare_data(df=self.df, window_size=self.window_size)
+        X_train, y_train, X_test, y_test, X_val, y_val = self.split_data(X=X, y=y, train_size=self.train_size, test_size=self.test_size)
+        if artifact is not None:
+            feature_scaler, target_scaler = artifact.feature_scaler, artifact.target_scaler
+            X_test_scaled = self.window_builder.transform(X=X_test, scaler=feature_scaler)
+            y_test_scaled = target_scaler.transform(y_test.reshape(-1, 1))
+        else:
+            X_train_scaled, X_test_scaled, X_val_scaled, feature_scaler = self.scale_features(X_train=X_train, X_test=X_test, X_val=X_val)
+            y_train_scaled, y_test_scaled, y_val_scaled, target_scaler = self.scale_targets(y_train=y_train, y_test=y_test, y_val=y_val)
+
+        rows = np.ascontiguousarray(feature_scaler.transform(self.window_builder.rows(X=X)), dtype=np.float32)
+        targets = target_scaler.transform(y.reshape(-1, 1))[:, 0]
+        trained_at = pd.Timestamp(artifact.trained_at) if artifact is not None else self.model_trained_at(model_name=model_name)
+        train_starts, validation_starts, holdout_starts = self.select_fine_tune_windows(n_windows=len(X), trained_at=trained_at)
+        if len(train_starts) == 0:
+            self.logger.info(msg=f'No new data since {model_name} was trained, it will be used as it is.')
+            self.model_name = model_name
+            return self.load_existing_model_and_predict(model_name=model_name)
+
+        # early stopping picks its epoch on the validation windows, the holdout only scores baseline and candidate
+        validation = self.window_builder.dataset(rows=rows, starts=validation_starts, targets=targets[validation_starts], batch_size=self.batch_size, cache=True)
+        holdout = self.window_builder.dataset(rows=rows, starts=holdout_starts, targets=targets[holdout_starts], batch_size=self.batch_size, cache=True)
+        baseline_loss = lstm_model.evaluate(holdout, verbose=0)[0]
+        baseline_weights = lstm_model.get_weights()
+
+        lstm_model.compile(loss=MeanSquaredError(), optimizer=Adam(learning_rate=self.FINE_TUNE_LEARNING_RATE), metrics=[RootMeanSquaredError()])
+        lstm_model.fit(
+            self.window_builder.dataset(rows=rows, starts=train_starts, targets=targets[train_starts], batch_size=self.batch_size, shuffle=True),
+            validation_data=validation, epochs=self.FINE_TUNE_EPOCHS,
+            callbacks=[EarlyStopping(monitor='val_loss', patience=1, restore_best_weights=True)])
+        fine_tuned_loss = lstm_model.evaluate(holdout, verbose=0)[0]
+
+        # promote only if the holdout (new days + replayed old days) does not get worse, otherwise keep the previous model
+        promoted = fine_tuned_loss <= baseline_loss
+        if promoted:
+            self.model_name = f'model_{int(time.time())}_{self.interval_minute}m.keras'
+            self.logger.info(msg=f'Fine-tuned model promoted as {self.model_name}. Holdout loss: {baseline_loss:.5f} -> {fine_tuned_loss:.5f}')
+        else:
+            lstm_model.set_weights(baseline_weights)
+            self.model_name = model_name
+            self.logger.warning(msg=f'Fine-tuned model was not promoted, {model_name} is kept. Holdout loss: {baseline_loss:.5f} -> {fine_tuned_loss:.5f}')
+
+        test_MSE, test_RMSE = lstm_model.evaluate(self.window_builder.from_windows(X=X_test_scaled, y=y_test_scaled, batch_size=self.batch_size), verbose=0)
+        predictions = self.predict_future_values(window=self.last_window(), model=lstm_model, output_steps=self.output_steps, feature_scaler=feature_scaler, target_scaler=target_scaler)
+        timestamped_predictions = self.add_time_column_to_predicted_values(predictions=predictions, interval_minute=self.interval_minute)
+        breakdown_probability = self.calculate_breakdown_probability(predictions=timestamped_predictions, column=self.target_column)
+        results = self.calculate_model_performance(model=lstm_model, X_test_scaled=X_test_scaled, y_test=y_test, target_scaler=target_scaler)
+        results['test_MSE'] = test_MSE
+        results['test_RMSE'] = test_RMSE
+        results['holdout_RMSE'] = float(np.sqrt(min(fine_tuned_loss, baseline_loss)))     # new + replayed holdout, not comparable with val_RMSE
+        if promoted:
+            self.save_artifact(model=lstm_model, model_name=self.model_name, feature_scaler=feature_scaler, target_scaler=target_scaler, results=results, save_model=True)
+            self.register_model(model_name=self.model_name, results=results)
+        results['breakdown_probability'] = breakdown_probability
+        results['peak_breakdown_probability'] = self.calculate_peak_breakdown_probability(predictions=timestamped_predictions, column=self.target_column)
+        results['n_samples'] = self.n_samples
+        results['timestamp'] = datetime.now().replace(second=0, microsecond=0)
+        results['model_name'] = str(self.model_name)
+        results = self.convert_numpy_types(data=results)
+        self.logger.info(msg=f'results:\n{results}')
+        return results, timestamped_predictions
+
+
+    def model_trained_at(self, model_name:str, prefix='model_'):
+        # model files are named model_{unix seconds}_{interval}m.keras
+        return pd.Timestamp(int(model_name.split(prefix)[1].split('_')[0]), unit='s', tz='UTC')
+
+
+    def select_fine_tune_windows(self, n_windows:int, trained_at:pd.Timestamp, seed:int=None):
+        # new windows are the ones whose target arrived after the model was trained, split in time into train | validation | holdout
+        # the same number of old windows is replayed next to each part, so forgetting shows up in early stopping and in the check
+        empty = np.empty(0, dtype=np.int64)
+        target_times = self.df.index[self.window_size:self.window_size + n_windows]
+        if target_times.tz is None:
+            target_times = target_times.tz_localize('UTC')
+        new_starts = np.flatnonzero(target_times > trained_at)
+        old_starts = np.flatnonzero(target_times <= trained_at)
+        n_holdout = int(len(new_starts) * self.HOLDOUT_RATIO)
+        n_validation = int(len(new_starts) * self.VALIDATION_RATIO)
+        n_train = len(new_starts) - n_validation - n_holdout
+        if n_train <= 0 or n_validation == 0 or n_holdout == 0:
+            return empty, empty, empty
+
+        rng = np.random.default_rng(seed)
+        new_train, new_validation, new_holdout = new_starts[:n_train], new_starts[n_train:n_train + n_validation], new_starts[n_train + n_validation:]
+        n_replay = min(int(n_train * self.REPLAY_RATIO), max(len(old_starts) - n_validation - n_holdout, 0))
+        old_sample = rng.permutation(old_starts)[:n_replay + n_validation + n_holdout]
+        train_starts = np.sort(np.concatenate([new_train, old_sample[:n_replay]]))
+        validation_starts = np.sort(np.concatenate([new_validation, old_sample[n_replay:n_replay + n_validation]]))
+        holdout_starts = np.sort(np.concatenate([new_holdout, old_sample[n_replay + n_validation:]]))
+        self.logger.info(msg=f'Fine-tuning on {len(new_train)} new and {n_replay} replayed windows, validation: {len(validation_starts)}, holdout: {len(holdout_starts)} windows.')
+        return train_starts, validation_starts, holdout_starts
+
+
     def preprocess(self, df):
         df.index = pd.to_datetime(df['__time'], format='ISO8601')
         df.drop(inplace=True, axis=1, columns=['__time', 'machine'])
@@ -148,15 +313,9 @@ class RNNModel:
 
 
     def prepare_data(self, df:pd.DataFrame, window_size:int):
-        target_index = df.columns.tolist().index(self.target_column)
-        df = df.to_numpy()
-        X = []
-        y = []
-
-        for index in range(len(df) - window_size):
-            X.append([window for window in df[index:index + window_size]])
-            y.append(df[index + window_size][target_index])
-        return np.array(X), np.array(y)
+        self.window_builder = SlidingWindowBuilder(window_size=window_size, threads=self.threads)
+        X, y = self.window_builder.build(df=df, target_column=self.target_column)
+        return X, y
     
 
     def split_data(self, X, y, train_size:float=0.7, test_size:float=0.2):
@@ -174,9 +333,10 @@ class RNNModel:
 
     def scale_features(self, X_train, X_test, X_val):
         feature_scaler = StandardScaler()
-        X_train_scaled = feature_scaler.fit_transform(X_train.reshape(-1, X_train.shape[2])).reshape(X_train.shape)
-        X_val_scaled = feature_scaler.transform(X_val.reshape(-1, X_val.shape[2])).reshape(X_val.shape)
-        X_test_scaled = feature_scaler.transform(X_test.reshape(-1, X_test.shape[2])).reshape(X_test.shape)
+        feature_scaler.fit(self.window_builder.rows(X=X_train))
+        X_train_scaled = self.window_builder.transform(X=X_train, scaler=feature_scaler)
+        X_val_scaled = self.window_builder.transform(X=X_val, scaler=feature_scaler)
+        X_test_scaled = self.window_builder.transform(X=X_test, scaler=feature_scaler)
         return X_train_scaled, X_test_scaled, X_val_scaled, feature_scaler
     
 
@@ -188,9 +348,9 @@ class RNNModel:
         return y_train_scaled, y_test_scaled, y_val_scaled, target_scaler
     
 
-    def LSTM_Model(self, X_train_scaled, y_train_scaled, X_test_scaled, y_test_scaled, X_val_scaled, y_val_scaled):
+    def create_lstm(self, window_size:int, n_features:int):
         lstm_model = Sequential()
-        lstm_model.add(Input(shape=(X_train_scaled.shape[1], X_train_scaled.shape[2])))
+        lstm_model.add(Input(shape=(window_size, n_features)))
         lstm_model.add(LSTM(100, return_sequences=True))
         lstm_model.add(Dropout(0.3))
         lstm_model.add(LSTM(50))
@@ -198,49 +358,124 @@ class RNNModel:
         lstm_model.add(Dense(8, 'relu'))
         lstm_model.add(Dense(1, 'linear'))
         lstm_model.summary()
+        return lstm_model
+
+
+    def LSTM_Model(self, X_train_scaled, y_train_scaled, X_test_scaled, y_test_scaled, X_val_scaled, y_val_scaled):
+        lstm_model = self.create_lstm(window_size=X_train_scaled.shape[1], n_features=X_train_scaled.shape[2])
 
         early_stopping = EarlyStopping(monitor='val_loss', patience=5, restore_best_weights=True)
         self.model_name = f'model_{int(time.time())}_{self.interval_minute}m.keras'
         checkpoint = ModelCheckpoint(f'{self.model_directory_path}/{self.model_name}', save_best_only=True)
         lstm_model.compile(loss=MeanSquaredError(), optimizer=Adam(learning_rate=0.0001), metrics=[RootMeanSquaredError()])
-        lstm_model.fit(X_train_scaled, y_train_scaled, validation_data=(X_val_scaled, y_val_scaled), epochs=self.EPOCHS, batch_size=32, callbacks=[checkpoint, early_stopping])
-        test_MSE, test_RMSE = lstm_model.evaluate(X_test_scaled, y_test_scaled)
+        history = lstm_model.fit(
+            self.window_builder.from_windows(X=X_train_scaled, y=y_train_scaled, batch_size=self.batch_size, shuffle=True),
+            validation_data=self.window_builder.from_windows(X=X_val_scaled, y=y_val_scaled, batch_size=self.batch_size, cache=True),
+            epochs=self.EPOCHS, callbacks=[checkpoint, early_stopping])
+        val_rmse_history = history.history.get('val_root_mean_squared_error', [])
+        self.val_RMSE = float(min(val_rmse_history)) if len(val_rmse_history) > 0 else None
+        test_MSE, test_RMSE = lstm_model.evaluate(self.window_builder.from_windows(X=X_test_scaled, y=y_test_scaled, batch_size=self.batch_size))
         return lstm_model, test_MSE, test_RMSE
     
 
-    def predict_future_values(self, X, model, output_steps:int, feature_scaler, target_scaler):
-        X_scaled = feature_scaler.fit_transform(X.reshape(-1, X.shape[2])).reshape(X.shape)
-        predictions = []
-        last_sequence = X_scaled[-1]
-
-        for _ in range(output_steps):
-            pred = model.predict(last_sequence.reshape(1, last_sequence.shape[0], last_sequence.shape[1]))[0][0]
-            predictions.append(pred)
-            
-            new_row = last_sequence[-1].copy()
-            for col_idx, col_name in enumerate(self.df.columns):
-                if col_name == self.target_column:
-                    new_row[col_idx] = pred
-                elif col_name == 'is_running':
-                    new_row[col_idx] = 1 if pred > self.thresholds[self.target_column] else 0
-                else:
-                    mean = self.stats[col_name]['mean']
-                    std = self.stats[col_name]['std']
-                    lower_bound = mean - std
-                    upper_bound = mean + std
-                    new_row[col_idx] = np.random.uniform(lower_bound, upper_bound)
-            last_sequence = np.vstack((last_sequence[1:], new_row))
-        predictions_rescaled = target_scaler.inverse_transform(np.array(predictions).reshape(-1, 1)).flatten()
-        return predictions_rescaled
-    
+    def predict_future_values(self, window:np.ndarray, model, output_steps:int, feature_scaler, target_scaler, stats:dict=None):
+        # window is the latest window_size raw rows, it is scaled with the scaler the model was trained with
+        last_sequence = feature_scaler.transform(window)
+        forecaster = AutoregressiveForecaster.for_model(model=model, columns=self.input_columns, target_column=self.target_column, thresholds=self.thresholds)
+        params = forecaster.create_params(
+            stats=stats or self.stats, feature_mean=feature_scaler.mean_, feature_scale=feature_scaler.scale_,
+            target_mean=target_scaler.mean_[0], target_scale=target_scaler.scale_[0])
+        predictions = forecaster.forecast(window=last_sequence, output_steps=output_steps, n_samples=self.n_samples, params=params)
+        return predictions
+
+
+    def last_window(self, window_size:int=None, columns:list=None):
+        window_size = window_size or self.window_size
+        return self.df[columns or self.input_columns].to_numpy(dtype=np.float32)[-window_size:]
+
+
+    def predict_with_artifact(self, artifact:ModelArtifact):
+        # only the last window is scaled and rolled out, metrics are the ones measured when the model was trained
+        predictions = self.predict_future_values(
+            window=self.last_window(window_size=artifact.window_size, columns=artifact.columns), model=artifact.model, output_steps=self.output_steps,
+            feature_scaler=artifact.feature_scaler, target_scaler=artifact.target_scaler, stats=artifact.stats)
+        timestamped_predictions = self.add_time_column_to_predicted_values(predictions=predictions, interval_minute=self.interval_minute)
+        results = dict(artifact.metrics)
+        results['breakdown_probability'] = self.calculate_breakdown_probability(predictions=timestamped_predictions, column=self.target_column)
+        results['peak_breakdown_probability'] = self.calculate_peak_breakdown_probability(predictions=timestamped_predictions, column=self.target_column)
+        results['n_samples'] = self.n_samples
+        results['timestamp'] = datetime.now().replace(second=0, microsecond=0)
+        results['model_name'] = str(self.model_name)
+        results = self.convert_numpy_types(data=results)
+        self.logger.info(msg=f'results:\n{results}')
+        return results, timestamped_predictions
+
+
+    def backfill_registry(self, model_files:list):
+        # files saved before the registry existed are registered once, so select_best ranks them and prune can delete them
+        if self.registry is None or len(model_files) == 0:
+            return
+        registered = self.registry.registered_paths(interval_minute=self.interval_minute, line=self.line, machine=self.machine)
+        if registered is None:
+            return
+        for model_name in model_files:
+            if os.path.join(self.model_directory_path, model_name) in registered:
+                continue
+            metrics = {}
+            if ModelArtifact.exists(directory=self.model_directory_path, model_name=model_name):
+                try:
+                    metrics = ModelArtifact.load_metadata(directory=self.model_directory_path, model_name=model_name)['metrics']
+                except Exception as e:
+                    self.logger.warning(msg=f'{model_name} metadata could not be read, it is registered without metrics. Error: {e}')
+            self.registry.register(
+                directory=self.model_directory_path, model_name=model_name, interval_minute=self.interval_minute, line=self.line, machine=self.machine,
+                metrics=self.convert_numpy_types(data=metrics), train_end=self.model_trained_at(model_name=model_name).to_pydatetime())
+            self.logger.info(msg=f'{model_name} was saved before the registry, it is registered now.')
+
+
+    def register_model(self, model_name:str, results:dict):
+        if self.registry is None:
+            return
+        metrics = {key: results[key] for key in ['MAE', 'MSE', 'RMSE', 'MAPE', 'R2', 'test_MSE', 'test_RMSE', 'val_RMSE', 'holdout_RMSE'] if key in results}
+        self.registry.register(
+            directory=self.model_directory_path, model_name=model_name, interval_minute=self.interval_minute, line=self.line, machine=self.machine,
+            metrics=self.convert_numpy_types(data=metrics), train_start=self.df.index[0].to_pydatetime(), train_end=self.df.index[-1].to_pydatetime())
+
+
+    def save_artifact(self, model, model_name:str, feature_scaler, target_scaler, results:dict, save_model:bool=None, trained_at:datetime=None):
+        # the .keras file is usually written by ModelCheckpoint already, save_model=None writes it only when missing
+        if save_model is None:
+            save_model = not os.path.exists(os.path.join(self.model_directory_path, model_name))
+        metrics = {key: results[key] for key in ['MAE', 'MSE', 'RMSE', 'MAPE', 'R2', 'test_MSE', 'test_RMSE', 'val_RMSE', 'holdout_RMSE'] if key in results}
+        try:
+            artifact = ModelArtifact(
+                model=model, feature_scaler=feature_scaler, target_scaler=target_scaler, stats=self.stats, window_size=self.window_size,
+                columns=self.input_columns, target_column=self.target_column, metrics=self.convert_numpy_types(data=metrics), trained_at=trained_at)
+            artifact.save(directory=self.model_directory_path, model_name=model_name, save_model=save_model)
+        except Exception as e:
+            self.logger.error(msg=f'Exception happened while saving {model_name} artifact!')
+            self.logger.error(msg=traceback.format_exc())
+
 
     def add_time_column_to_predicted_values(self, predictions, interval_minute):
         try:
-            timestamps = pd.date_range(start=self.start_time, periods=len(predictions), freq=f'{interval_minute}min')
-            timestamped_data = pd.DataFrame({
-                'time': timestamps,
-                'PredictedAxialAxisRmsVibration': predictions
-            })
+            predictions = np.atleast_2d(predictions)
+            timestamps = pd.date_range(start=self.start_time, periods=predictions.shape[1], freq=f'{interval_minute}min')
+            if predictions.shape[0] == 1:
+                timestamped_data = pd.DataFrame({
+                    'time': timestamps,
+                    'PredictedAxialAxisRmsVibration': predictions[0]
+                })
+            else:
+                p05, p50, p95 = np.percentile(predictions, [5, 50, 95], axis=0)
+                breakdowns = predictions < self.thresholds[self.target_column]
+                timestamped_data = pd.DataFrame({
+                    'time': timestamps,
+                    'PredictedAxialAxisRmsVibration': p50,
+                    'PredictedAxialAxisRmsVibrationP05': p05,
+                    'PredictedAxialAxisRmsVibrationP95': p95,
+                    'BreakdownProbability': np.round(breakdowns.mean(axis=0) * 100, 2)
+                })
         except Exception as e:
             self.logger.error(msg='Exception happened while adding time column to the predicted values!')
             self.logger.error(msg=traceback.format_exc())
@@ -249,6 +484,11 @@ class RNNModel:
 
     def calculate_breakdown_probability(self, predictions, column:str):
         try:
+            if isinstance(predictions, pd.DataFrame) and 'BreakdownProbability' in predictions.columns:
+                breakdown_probability = round(float(predictions['BreakdownProbability'].mean()), 2)
+                self.logger.info(msg=f'Breakdown probability calculated as {breakdown_probability}% over {self.n_samples} rollouts')
+                return breakdown_probability
+
             if isinstance(predictions, pd.DataFrame):
                 predictions_column = predictions['PredictedAxialAxisRmsVibration']
             else:
@@ -264,10 +504,19 @@ class RNNModel:
         return breakdown_probability
     
 
+    def calculate_peak_breakdown_probability(self, predictions:pd.DataFrame, column:str):
+        if 'BreakdownProbability' in predictions.columns:
+            return round(float(predictions['BreakdownProbability'].max()), 2)
+        return 100.0 if bool((predictions['PredictedAxialAxisRmsVibration'] < self.thresholds[column]).any()) else 0.0
+    
+
     def calculate_model_performance(self, model, X_test_scaled, y_test, target_scaler):
-        y_pred_scaled = model.predict(X_test_scaled, verbose=0)
+        y_pred_scaled = model.predict(self.window_builder.from_windows(X=X_test_scaled, batch_size=self.batch_size), verbose=0)
         y_pred = target_scaler.inverse_transform(y_pred_scaled)
+        return self.calculate_metrics(y_test=y_test, y_pred=y_pred)
+
 
+    def calculate_metrics(self, y_test, y_pred):
         mae = mean_absolute_error(y_test, y_pred)
         mse = mean_squared_error(y_test, y_pred)
         rmse = np.sqrt(mse)
@@ -297,10 +546,23 @@ class RNNModel:
         model_files.sort(key=lambda x: int(x.split(prefix)[1].split(suffix)[0]), reverse=True)
 
         if job == 'select':
-            if self.load_best_model == True:
+            self.backfill_registry(model_files=model_files)
+            # the registry picks by validation RMSE, without it (or with an empty one) the newest file is used
+            # fine-tuning continues from the newest model, the head of the chain, whatever its metrics
+            best = self.registry.select_best(interval_minute=self.interval_minute, line=self.line, machine=self.machine) if self.registry is not None else None
+            latest = self.registry.select_latest(interval_minute=self.interval_minute, line=self.line, machine=self.machine) if self.registry is not None else None
+            if self.incremental == True and (latest is not None or len(model_files) > 0):
+                base_model = latest['model_name'] if latest is not None else model_files[0]
+                self.logger.info(msg=f'Model {base_model} will be fine-tuned on the new data!')
+                return self.fine_tune_model_and_predict(model_name=base_model)
+            elif self.load_best_model == True:
                 if self.model_name is not None and self.model_name in model_files:
                     self.logger.info(msg=f'Selected model ({self.model_name}) will be used for predictions!')
                     return self.load_existing_model_and_predict(model_name=self.model_name)
+                elif best is not None:
+                    self.model_name = best['model_name']
+                    self.logger.info(msg=f'Best model ({self.model_name}, val_RMSE: {best["val_rmse"]}) will be used for predictions!')
+                    return self.load_existing_model_and_predict(model_name=self.model_name)
                 elif len(model_files) > 0:
                     self.model_name = model_files[0]
                     self.logger.info(msg=f'Latest model ({self.model_name}) will be used for predictions!')
@@ -312,8 +574,14 @@ class RNNModel:
                 self.logger.info(msg='New model will be trained...')
                 return self.train_new_model_and_predict()
         elif job == 'delete':
-            if len(model_files) > max_models:
+            pruned = self.registry.prune(interval_minute=self.interval_minute, line=self.line, machine=self.machine, keep=max_models) if self.registry is not None else None
+            if pruned is not None:
+                for f in pruned:
+                    ModelArtifact.remove(directory=self.model_directory_path, model_name=f)
+                if len(pruned) > 0:
+                    self.logger.info(msg=f'Models outside the best {max_models} deleted! Deleted models: \n{pruned}')
+            elif len(model_files) > max_models:
                 files_to_remove = model_files[5:]
                 for f in files_to_remove:
-                    os.remove(os.path.join(self.model_directory_path, f))
+                    ModelArtifact.remove(directory=self.model_directory_path, model_name=f)
                 self.logger.info(msg=f'Old models deleted! Deleted models: \n{files_to_remove}')
\ No newline at end of file
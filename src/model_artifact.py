@@ -0,0 +1,87 @@
+import os
+import joblib
+import tensorflow as tf
+from datetime import datetime, timezone
+from src._logger import ProjectLogger
+
+
+class ModelArtifact:
+    logger = ProjectLogger(class_name='ModelArtifact').create_logger()
+    VERSION = 1
+
+    def __init__(self, model, feature_scaler, target_scaler, stats:dict, window_size:int, columns:list, target_column:str, metrics:dict=None, trained_at:datetime=None):
+        # a saved model is only usable together with the scalers and stats it was trained with, so they are kept together
+        self.model = model
+        self.feature_scaler = feature_scaler
+        self.target_scaler = target_scaler
+        self.stats = stats
+        self.window_size = window_size
+        self.columns = list(columns)
+        self.target_column = target_column
+        self.metrics = metrics or {}
+        self.trained_at = trained_at or datetime.now(timezone.utc)
+
+
+    @staticmethod
+    def metadata_path(directory:str, model_name:str):
+        # model_{ts}_{interval}m.keras -> model_{ts}_{interval}m.joblib
+        return os.path.join(directory, os.path.splitext(model_name)[0] + '.joblib')
+
+
+    @classmethod
+    def exists(cls, directory:str, model_name:str):
+        return os.path.exists(cls.metadata_path(directory=directory, model_name=model_name))
+
+
+    def save(self, directory:str, model_name:str, save_model:bool=True):
+        # save_model=False when the .keras file is already written, e.g. by ModelCheckpoint
+        if save_model:
+            self.model.save(os.path.join(directory, model_name))
+        path = self.metadata_path(directory=directory, model_name=model_name)
+        metadata = {
+            'version': self.VERSION,
+            'feature_scaler': self.feature_scaler,
+            'target_scaler': self.target_scaler,
+            'stats': self.stats,
+            'window_size': self.window_size,
+            'columns': self.columns,
+            'target_column': self.target_column,
+            'metrics': self.metrics,
+            'trained_at': self.trained_at
+        }
+        joblib.dump(metadata, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        self.logger.info(msg=f'{model_name} saved with its scalers and stats.')
+
+
+    @classmethod
+    def load_metadata(cls, directory:str, model_name:str):
+        # scalers, stats and metrics without loading the model itself
+        metadata = joblib.load(cls.metadata_path(directory=directory, model_name=model_name))
+        if metadata.get('version') != cls.VERSION:
+            raise ValueError(f'{model_name} metadata version {metadata.get("version")} is not supported.')
+        return metadata
+
+
+    @classmethod
+    def load(cls, directory:str, model_name:str):
+        metadata = cls.load_metadata(directory=directory, model_name=model_name)
+        model = tf.keras.models.load_model(os.path.join(directory, model_name))
+        return cls(
+            model=model,
+            feature_scaler=metadata['feature_scaler'],
+            target_scaler=metadata['target_scaler'],
+            stats=metadata['stats'],
+            window_size=metadata['window_size'],
+            columns=metadata['columns'],
+            target_column=metadata['target_column'],
+            metrics=metadata['metrics'],
+            trained_at=metadata['trained_at']
+        )
+
+
+    @classmethod
+    def remove(cls, directory:str, model_name:str):
+        for path in [os.path.join(directory, model_name), cls.metadata_path(directory=directory, model_name=model_name)]:
+            if os.path.exists(path):
+                os.remove(path)
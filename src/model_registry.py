@@ -0,0 +1,220 @@
+import os
+import json
+import hashlib
+import threading
+import traceback
+from collections import OrderedDict
+from src._logger import ProjectLogger
+from src.postgre_db import PostgreClient
+from src.model_artifact import ModelArtifact
+
+
+class ModelRegistry:
+    logger = ProjectLogger(class_name='ModelRegistry').create_logger()
+    TABLE_NAME = 'model_registry'
+    CACHE_SIZE = 8
+
+    # loaded artifacts are kept per process, the cache pays off in long-lived processes:
+    # RunPipeline's model workers are kept between nightly runs and streaming inference asks for the same artifacts every tick
+    cache = OrderedDict()
+    cache_lock = threading.Lock()
+
+    def __init__(self, table_name:str=None):
+        # the connection is opened on first use and never pickled, the registry can be handed to process pools
+        self.table_name = table_name or self.TABLE_NAME
+        self.postgre_client = None
+
+
+    @staticmethod
+    def model_directory(interval_minute:int, line:str=None, machine:str=None):
+        # fleet models live in models/{line}/{machine}/{interval}m, single machine runs keep models/{interval}m
+        parts = [part for part in [line, machine] if part is not None]
+        return os.path.join(os.getcwd(), 'models', *parts, f'{interval_minute}m')
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['postgre_client'] = None
+        return state
+
+
+    def get_client(self):
+        if self.postgre_client is None:
+            self.postgre_client = PostgreClient(max_connections=2)
+            self.create_table()
+        return self.postgre_client
+
+
+    def create_table(self):
+        query = f'''
+            CREATE TABLE IF NOT EXISTS {self.table_name}(
+                id SERIAL PRIMARY KEY,
+                model_name TEXT NOT NULL,
+                path TEXT NOT NULL UNIQUE,
+                sha256 TEXT NOT NULL,
+                interval_minute INTEGER NOT NULL,
+                line TEXT,
+                machine TEXT,
+                metrics JSONB,
+                val_rmse FLOAT,
+                holdout_rmse FLOAT,
+                train_start TIMESTAMPTZ,
+                train_end TIMESTAMPTZ,
+                active BOOLEAN DEFAULT TRUE,
+                created_at TIMESTAMP DEFAULT NOW()
+            );
+            ALTER TABLE {self.table_name} ADD COLUMN IF NOT EXISTS holdout_rmse FLOAT;
+            ALTER TABLE {self.table_name} ADD COLUMN IF NOT EXISTS line TEXT;
+            CREATE INDEX IF NOT EXISTS {self.table_name}_select_idx ON {self.table_name} (interval_minute, machine, active, val_rmse);
+            CREATE INDEX IF NOT EXISTS {self.table_name}_line_select_idx ON {self.table_name} (interval_minute, line, machine, active, val_rmse);
+        '''
+        self.postgre_client.execute(query=query)
+
+
+    def register(self, directory:str, model_name:str, interval_minute:int, machine:str=None, metrics:dict=None, train_start=None, train_end=None, line:str=None):
+        try:
+            path = os.path.join(directory, model_name)
+            metrics = metrics or {}
+            client = self.get_client()
+            query = f'''
+                INSERT INTO {self.table_name} (model_name, path, sha256, interval_minute, line, machine, metrics, val_rmse, holdout_rmse, train_start, train_end)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (path) DO UPDATE SET sha256 = EXCLUDED.sha256, metrics = EXCLUDED.metrics, val_rmse = EXCLUDED.val_rmse,
+                    holdout_rmse = EXCLUDED.holdout_rmse, train_start = EXCLUDED.train_start, train_end = EXCLUDED.train_end, active = TRUE;
+            '''
+            values = (model_name, path, self.file_hash(path=path), interval_minute, line, machine, json.dumps(metrics), metrics.get('val_RMSE'), metrics.get('holdout_RMSE'), train_start, train_end)
+            client.execute(query=query, parameters=values)
+            self.logger.info(msg=f'{model_name} registered, val_RMSE: {metrics.get("val_RMSE")}, holdout_RMSE: {metrics.get("holdout_RMSE")}')
+        except Exception as e:
+            self.logger.error(msg=f'Exception happened while registering {model_name}, Error: {e}')
+            self.logger.error(msg=traceback.format_exc())
+
+
+    def select_best(self, interval_minute:int, machine:str=None, line:str=None):
+        # lowest validation RMSE among the active models whose file is still on disk, None if the registry has nothing
+        # fine-tuned models are measured on another split (holdout_rmse) and are not ranked here
+        try:
+            client = self.get_client()
+            query = f'''
+                SELECT model_name, path, sha256, val_rmse FROM {self.table_name}
+                WHERE interval_minute = %s AND line IS NOT DISTINCT FROM %s AND machine IS NOT DISTINCT FROM %s AND active
+                ORDER BY val_rmse ASC NULLS LAST, created_at DESC;
+            '''
+            rows = client.execute(query=query, parameters=(interval_minute, line, machine), fetch=True)
+            for model_name, path, sha256, val_rmse in rows:
+                if os.path.exists(path):
+                    return {'model_name': model_name, 'path': path, 'sha256': sha256, 'val_rmse': val_rmse}
+        except Exception as e:
+            self.logger.error(msg=f'Exception happened while selecting the best {interval_minute}m model, Error: {e}')
+            self.logger.error(msg=traceback.format_exc())
+        return None
+
+
+    def registered_paths(self, interval_minute:int, machine:str=None, line:str=None):
+        # every registered path of the series, active or not, None if the registry can not be read
+        try:
+            client = self.get_client()
+            query = f'''
+                SELECT path FROM {self.table_name}
+                WHERE interval_minute = %s AND line IS NOT DISTINCT FROM %s AND machine IS NOT DISTINCT FROM %s;
+            '''
+            return {row[0] for row in client.execute(query=query, parameters=(interval_minute, line, machine), fetch=True)}
+        except Exception as e:
+            self.logger.error(msg=f'Exception happened while listing the registered {interval_minute}m models, Error: {e}')
+            self.logger.error(msg=traceback.format_exc())
+        return None
+
+
+    def select_latest(self, interval_minute:int, machine:str=None, line:str=None):
+        # newest active model whose file is still on disk, the head of a fine-tuning chain
+        try:
+            client = self.get_client()
+            query = f'''
+                SELECT model_name, path, sha256, val_rmse FROM {self.table_name}
+                WHERE interval_minute = %s AND line IS NOT DISTINCT FROM %s AND machine IS NOT DISTINCT FROM %s AND active
+                ORDER BY created_at DESC;
+            '''
+            rows = client.execute(query=query, parameters=(interval_minute, line, machine), fetch=True)
+            for model_name, path, sha256, val_rmse in rows:
+                if os.path.exists(path):
+                    return {'model_name': model_name, 'path': path, 'sha256': sha256, 'val_rmse': val_rmse}
+        except Exception as e:
+            self.logger.error(msg=f'Exception happened while selecting the latest {interval_minute}m model, Error: {e}')
+            self.logger.error(msg=traceback.format_exc())
+        return None
+
+
+    def prune(self, interval_minute:int, machine:str=None, keep:int=5, line:str=None):
+        # models that are neither among the best `keep` by val_RMSE nor among the newest `keep` are deactivated,
+        # fine-tuned models only have a holdout_RMSE and are kept by recency, the caller removes the returned files
+        try:
+            client = self.get_client()
+            query = f'''
+                UPDATE {self.table_name} SET active = FALSE
+                WHERE id IN (
+                    SELECT id FROM {self.table_name}
+                    WHERE interval_minute = %(interval_minute)s AND line IS NOT DISTINCT FROM %(line)s AND machine IS NOT DISTINCT FROM %(machine)s AND active
+                    EXCEPT (
+                        SELECT id FROM {self.table_name}
+                        WHERE interval_minute = %(interval_minute)s AND line IS NOT DISTINCT FROM %(line)s AND machine IS NOT DISTINCT FROM %(machine)s AND active AND val_rmse IS NOT NULL
+                        ORDER BY val_rmse ASC LIMIT %(keep)s
+                    )
+                    EXCEPT (
+                        SELECT id FROM {self.table_name}
+                        WHERE interval_minute = %(interval_minute)s AND line IS NOT DISTINCT FROM %(line)s AND machine IS NOT DISTINCT FROM %(machine)s AND active
+                        ORDER BY created_at DESC LIMIT %(keep)s
+                    )
+                )
+                RETURNING model_name;
+            '''
+            rows = client.execute(query=query, parameters={'interval_minute': interval_minute, 'line': line, 'machine': machine, 'keep': keep}, fetch=True)
+            return [row[0] for row in rows]
+        except Exception as e:
+            self.logger.error(msg=f'Exception happened while pruning {interval_minute}m models, Error: {e}')
+            self.logger.error(msg=traceback.format_exc())
+        return None
+
+
+    def relocate(self, source_directory:str, target_directory:str, line:str=None, machine:str=None):
+        # files moved by a directory migration keep their registry rows, only the path prefix and the owner change
+        try:
+            client = self.get_client()
+            query = f'''
+                UPDATE {self.table_name}
+                SET path = %(target)s || substr(path, length(%(source)s) + 1), line = %(line)s, machine = %(machine)s
+                WHERE left(path, length(%(source)s) + 1) = %(source)s || %(sep)s;
+            '''
+            parameters = {'source': source_directory, 'target': target_directory, 'line': line, 'machine': machine, 'sep': os.sep}
+            return client.execute(query=query, parameters=parameters)
+        except Exception as e:
+            self.logger.error(msg=f'Exception happened while relocating the models of {source_directory}, Error: {e}')
+            self.logger.error(msg=traceback.format_exc())
+        return None
+
+
+    def file_hash(self, path:str):
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha256.update(block)
+        return sha256.hexdigest()
+
+
+    @classmethod
+    def load_artifact(cls, directory:str, model_name:str):
+        # keyed by path and modification time, a file rewritten under the same name is loaded again
+        path = os.path.join(directory, model_name)
+        key = (path, os.stat(path).st_mtime_ns)
+        with cls.cache_lock:
+            if key in cls.cache:
+                cls.cache.move_to_end(key)
+                cls.logger.info(msg=f'{model_name} served from the model cache.')
+                return cls.cache[key]
+
+        artifact = ModelArtifact.load(directory=directory, model_name=model_name)
+        with cls.cache_lock:
+            cls.cache[key] = artifact
+            cls.cache.move_to_end(key)
+            while len(cls.cache) > cls.CACHE_SIZE:
+                cls.cache.popitem(last=False)
+        return artifact
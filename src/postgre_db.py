@@ -1,5 +1,13 @@
 import psycopg2
+from psycopg2 import pool, extras, errors
 import os
+import io
+import time
+import uuid
+import threading
+import pandas as pd
+from datetime import datetime, timedelta
+from contextlib import contextmanager
 from dotenv import load_dotenv
 from src._logger import ProjectLogger
 import traceback
@@ -14,15 +22,99 @@ class PostgreClient:
     POSTGRE_HOST = os.getenv('POSTGRE_HOST')
     POSTGRE_PORT = os.getenv('POSTGRE_PORT')
     POSTGRE_DB_NAME = os.getenv('POSTGRE_DB_NAME')
+    MIN_CONNECTIONS = 1
+    MAX_CONNECTIONS = 8
+    HEALTH_CHECK_INTERVAL = 60      # seconds a connection may sit idle before it is pinged again
+    MAX_RETRIES = 3
+    FETCH_BATCH_SIZE = 10000
+    PAGE_SIZE = 1000
 
-    def __init__(self):
-        self.db_client = psycopg2.connect(
+    FORECAST_TABLE = 'forecasts'
+    forecast_columns = ['line', 'machine', 'model_name', 'interval_minute', 'forecast_ts', 'horizon_ts', 'value', 'p05', 'p95', 'breakdown_probability']
+    forecast_value_columns = {
+        'PredictedAxialAxisRmsVibration': 'value',
+        'PredictedAxialAxisRmsVibrationP05': 'p05',
+        'PredictedAxialAxisRmsVibrationP95': 'p95',
+        'BreakdownProbability': 'breakdown_probability'
+    }
+    results_columns = [
+        'timestamp', 'model_name', 'test_MSE', 'test_RMSE', 'MAE', 'MSE', 'RMSE', 'MAPE', 'R2', 'breakdown_probability',
+        'peak_breakdown_probability', 'n_samples', 'line', 'machine'
+    ]
+
+    def __init__(self, min_connections:int=None, max_connections:int=None):
+        # a thread-safe pool, the semaphore makes callers wait for a free connection instead of failing when all are in use
+        self.max_connections = max_connections or self.MAX_CONNECTIONS
+        self.pool = pool.ThreadedConnectionPool(
+            min_connections or self.MIN_CONNECTIONS,
+            self.max_connections,
             user=self.POSTGRE_USERNAME,
             password=self.POSTGRE_PASSWORD,
             host=self.POSTGRE_HOST,
-            port=self.POSTGRE_PORT
+            port=self.POSTGRE_PORT,
+            connect_timeout=10,
+            keepalives=1
         )
-        self.cursor = self.db_client.cursor()
+        self.available = threading.BoundedSemaphore(self.max_connections)
+        self.last_used = {}     # backend pid -> last release time, an entry lives as long as its pooled connection
+
+
+    @contextmanager
+    def connection(self):
+        # commits when the block finishes, rolls back on errors, a broken connection is closed instead of going back to the pool
+        self.available.acquire()
+        conn = None
+        backend_pid = None
+        broken = False
+        try:
+            conn = self.get_connection()
+            backend_pid = conn.get_backend_pid()
+            with conn:
+                yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            if conn is not None:
+                close = broken or conn.closed != 0
+                if close:
+                    self.last_used.pop(backend_pid, None)
+                else:
+                    self.last_used[backend_pid] = time.monotonic()
+                self.pool.putconn(conn, close=close)
+                if conn.closed != 0:
+                    # the pool may also close a returned connection (e.g. above minconn), its pid must not linger
+                    self.last_used.pop(backend_pid, None)
+            self.available.release()
+
+
+    def get_connection(self):
+        for attempt in range(self.MAX_RETRIES + 1):
+            conn = self.pool.getconn()
+            backend_pid = conn.get_backend_pid() if conn.closed == 0 else None
+            idle = time.monotonic() - self.last_used.get(backend_pid, 0)
+            if conn.closed == 0 and (idle < self.HEALTH_CHECK_INTERVAL or self.is_healthy(conn=conn)):
+                return conn
+            self.logger.warning(msg=f'Postgres connection is broken, reconnecting. Attempt: {attempt + 1}/{self.MAX_RETRIES}')
+            self.last_used.pop(backend_pid, None)
+            self.pool.putconn(conn, close=True)
+            time.sleep(attempt)
+        raise psycopg2.OperationalError('No healthy Postgres connection could be created.')
+
+
+    def is_healthy(self, conn):
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1;')
+            conn.rollback()
+            return True
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return False
+
+
+    def close(self):
+        self.pool.closeall()
+        self.last_used.clear()
 
 
     def create_table(self, table_name:str):
@@ -40,58 +132,206 @@ class PostgreClient:
                     MAPE FLOAT NOT NULL,
                     R2 FLOAT NOT NULL,
                     breakdown_probability FLOAT NOT NULL,
+                    peak_breakdown_probability FLOAT,
+                    n_samples INTEGER DEFAULT 1,
+                    line TEXT,
+                    machine TEXT,
                     created_at TIMESTAMP DEFAULT NOW()
                 );
+                ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS peak_breakdown_probability FLOAT;
+                ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS n_samples INTEGER DEFAULT 1;
+                ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS line TEXT;
+                ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS machine TEXT;
+                CREATE INDEX IF NOT EXISTS {table_name}_machine_idx ON {table_name} (machine, timestamp);
+                CREATE INDEX IF NOT EXISTS {table_name}_timestamp_idx ON {table_name} (timestamp);
+                CREATE INDEX IF NOT EXISTS {table_name}_model_name_idx ON {table_name} (model_name);
             '''
-            
-            with self.db_client:
-                self.cursor.execute(query=query)
+
+            with self.connection() as conn, conn.cursor() as cursor:
+                cursor.execute(query=query)
                 self.logger.info(msg=f'{table_name} named table already exists or created successfully.')
         except Exception as e:
             self.logger.error(msg=f'Exception happened while creating {table_name} named table, Error: {e}')
             self.logger.error(msg=traceback.format_exc())
 
 
-    def insert_data(self, table_name:str, results:dict):
+    def create_forecast_table(self, table_name:str=None):
+        # one row per forecasted timestep, range-partitioned by day on horizon_ts so retention is a DROP of old partitions
+        table_name = table_name or self.FORECAST_TABLE
         try:
             query = f'''
-                INSERT INTO {table_name} (
-                    timestamp, model_name, test_MSE, test_RMSE, MAE, MSE, RMSE, MAPE, R2, breakdown_probability
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
+                CREATE TABLE IF NOT EXISTS {table_name}(
+                    line TEXT,
+                    machine TEXT NOT NULL,
+                    model_name TEXT NOT NULL,
+                    interval_minute INTEGER NOT NULL,
+                    forecast_ts TIMESTAMP NOT NULL,
+                    horizon_ts TIMESTAMP NOT NULL,
+                    value FLOAT NOT NULL,
+                    p05 FLOAT,
+                    p95 FLOAT,
+                    breakdown_probability FLOAT
+                ) PARTITION BY RANGE (horizon_ts);
+                CREATE INDEX IF NOT EXISTS {table_name}_machine_horizon_idx ON {table_name} (machine, horizon_ts);
             '''
-            values = (
-                results["timestamp"],
-                results["model_name"],
-                results["test_MSE"],
-                results["test_RMSE"],
-                results["MAE"],
-                results["MSE"],
-                results["RMSE"],
-                results["MAPE"],
-                results["R2"],
-                results["breakdown_probability"]
-            )
-
-            with self.db_client:
-                self.cursor.execute(query, values)
-                self.logger.info(msg=f'Data successfully inserted into {table_name}.')
+            self.execute(query=query)
+            self.logger.info(msg=f'{table_name} named partitioned table already exists or created successfully.')
+        except Exception as e:
+            self.logger.error(msg=f'Exception happened while creating {table_name} named table, Error: {e}')
+            self.logger.error(msg=traceback.format_exc())
+
+
+    def partition_name(self, table_name:str, day):
+        return f'{table_name}_p{day.strftime("%Y%m%d")}'
+
+
+    def ensure_partitions(self, table_name:str, start, end):
+        # daily partitions covering [start, end], existing ones are left as they are
+        # two sessions creating the same partition at once can both pass IF NOT EXISTS, the loser retries and finds it
+        days = pd.date_range(start=pd.Timestamp(start).normalize(), end=pd.Timestamp(end).normalize(), freq='D')
+        query = ''.join(
+            f'''CREATE TABLE IF NOT EXISTS {self.partition_name(table_name=table_name, day=day)} PARTITION OF {table_name}
+                FOR VALUES FROM ('{day.strftime("%Y-%m-%d")}') TO ('{(day + pd.Timedelta(days=1)).strftime("%Y-%m-%d")}');'''
+            for day in days
+        )
+        if len(query) == 0:
+            return 0
+        for attempt in range(self.MAX_RETRIES + 1):
+            try:
+                self.execute(query=query)
+                break
+            except (errors.DuplicateTable, errors.UniqueViolation) as e:
+                if attempt == self.MAX_RETRIES:
+                    raise
+                self.logger.warning(msg=f'{table_name} partitions were created concurrently, retrying. Attempt: {attempt + 1}/{self.MAX_RETRIES}, error: {e}')
+                time.sleep(0.1 * (attempt + 1))
+        return len(days)
+
+
+    def copy_forecasts(self, predictions:pd.DataFrame, results:dict, interval_minute:int, table_name:str=None):
+        # predictions as produced by the model (time + predicted columns), loaded with COPY into the day partitions
+        table_name = table_name or self.FORECAST_TABLE
+        try:
+            df = predictions.rename(columns=self.forecast_value_columns)
+            df['horizon_ts'] = pd.to_datetime(predictions['time'])
+            df['forecast_ts'] = results['timestamp']
+            df['model_name'] = results['model_name']
+            df['interval_minute'] = interval_minute
+            df['line'] = results.get('line')
+            df['machine'] = results.get('machine') or 'unknown'
+            df = df.reindex(columns=self.forecast_columns)
+            self.ensure_partitions(table_name=table_name, start=df['horizon_ts'].min(), end=df['horizon_ts'].max())
+            return self.copy_dataframe(table_name=table_name, df=df)
+        except Exception as e:
+            self.logger.error(msg=f'Exception happened while copying forecasts into {table_name}, Error: {e}')
+            self.logger.error(msg=traceback.format_exc())
+            raise
+
+
+    def drop_old_partitions(self, table_name:str=None, retention_days:int=180):
+        # partitions whose whole day is older than the retention are dropped, no row-by-row DELETE or vacuum needed
+        table_name = table_name or self.FORECAST_TABLE
+        try:
+            query = '''
+                SELECT child.relname FROM pg_inherits
+                JOIN pg_class parent ON pg_inherits.inhparent = parent.oid
+                JOIN pg_class child ON pg_inherits.inhrelid = child.oid
+                WHERE parent.relname = %s;
+            '''
+            cutoff = (datetime.now() - timedelta(days=retention_days)).strftime('%Y%m%d')
+            partitions = [row[0] for row in self.execute(query=query, parameters=(table_name,), fetch=True)]
+            expired = sorted(partition for partition in partitions if partition.rsplit('_p', 1)[-1] < cutoff)
+            if len(expired) > 0:
+                self.execute(query=''.join(f'DROP TABLE IF EXISTS {partition};' for partition in expired))
+                self.logger.info(msg=f'{len(expired)} partition(s) older than {retention_days} days dropped from {table_name}: {expired}')
+            return expired
+        except Exception as e:
+            self.logger.error(msg=f'Exception happened while dropping old partitions of {table_name}, Error: {e}')
+            self.logger.error(msg=traceback.format_exc())
+
+
+    def insert_data(self, table_name:str, results:dict):
+        self.insert_many(table_name=table_name, results_list=[results])
+
+
+    def insert_many(self, table_name:str, results_list:list):
+        # one round trip per PAGE_SIZE rows, e.g. a whole fleet's results at once
+        try:
+            query = f'INSERT INTO {table_name} ({", ".join(self.results_columns)}) VALUES %s;'
+            values = [
+                (
+                    results["timestamp"],
+                    results["model_name"],
+                    results["test_MSE"],
+                    results["test_RMSE"],
+                    results["MAE"],
+                    results["MSE"],
+                    results["RMSE"],
+                    results["MAPE"],
+                    results["R2"],
+                    results["breakdown_probability"],
+                    results.get("peak_breakdown_probability"),
+                    results.get("n_samples", 1),
+                    results.get("line"),
+                    results.get("machine")
+                )
+                for results in results_list
+            ]
+
+            with self.connection() as conn, conn.cursor() as cursor:
+                extras.execute_values(cursor, query, values, page_size=self.PAGE_SIZE)
+                self.logger.info(msg=f'{len(values)} row(s) successfully inserted into {table_name}.')
         except Exception as e:
             self.logger.error(msg=f'Exception happened while inserting the data into {table_name}, Error: {e}')
             self.logger.error(msg=traceback.format_exc())
 
 
+    def copy_dataframe(self, table_name:str, df, columns:list=None):
+        # COPY streams the frame as csv, meant for per-timestep rows where even execute_values is too chatty
+        columns = columns or df.columns.tolist()
+        buffer = io.StringIO()
+        df[columns].to_csv(buffer, index=False, header=False, na_rep='\\N')
+        buffer.seek(0)
+        query = f'COPY {table_name} ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv, NULL \'\\N\')'
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.copy_expert(sql=query, file=buffer)
+            self.logger.info(msg=f'{len(df)} row(s) copied into {table_name}.')
+        return len(df)
+
+
+    def stream_query(self, query:str, parameters:tuple=None, batch_size:int=None):
+        # server-side named cursor, only batch_size rows are on the client at a time, the connection is held until the generator ends
+        batch_size = batch_size or self.FETCH_BATCH_SIZE
+        with self.connection() as conn, conn.cursor(name=f'stream_{uuid.uuid4().hex}') as cursor:
+            cursor.itersize = batch_size
+            cursor.execute(query, parameters)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if len(rows) == 0:
+                    break
+                yield rows
+
+
+    def iter_data(self, table_name:str, batch_size:int=None):
+        yield from self.stream_query(query=f'SELECT * FROM {table_name};', batch_size=batch_size)
+
+
     def fetch_data(self, table_name:str):
-        query = f'SELECT * FROM {table_name};'
-        self.cursor.execute(query=query)
-        results = self.cursor.fetchall()
-        return results
+        return [row for rows in self.iter_data(table_name=table_name) for row in rows]
+
+
+    def execute(self, query:str, parameters:tuple=None, fetch:bool=False):
+        # small statements (ddl, lookups, updates), fetch=True returns all rows so it is not meant for large results
+        with self.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(query, parameters)
+            if fetch:
+                return cursor.fetchall()
+            return cursor.rowcount
 
 
     def update_data(self, table_name:str, column_name:str, new_value, _id:int):
         try:
-            query = f'UPDATE {table_name} SET {column_name}={new_value} WHERE id={_id};'
-            self.cursor.execute(query=query)
-            self.db_client.commit()
+            self.execute(query=f'UPDATE {table_name} SET {column_name}=%s WHERE id=%s;', parameters=(new_value, _id))
             self.logger.info(msg='Data updated successfully!')
         except Exception as e:
             self.logger.error(msg=f'Exception happened while updating the data, Error: {e}')
@@ -100,9 +340,7 @@ class PostgreClient:
 
     def delete_data(self, table_name:str, _id:int):
         try:
-            query = f'DELETE FROM {table_name} WHERE id={_id};'
-            self.cursor.execute(query=query)
-            self.db_client.commit()
+            self.execute(query=f'DELETE FROM {table_name} WHERE id=%s;', parameters=(_id,))
             self.logger.info(msg='Data successfully deleted!')
         except Exception as e:
             self.logger.error(msg=f'Exception happened while deleting the data, Error: {e}')
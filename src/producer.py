@@ -3,10 +3,13 @@ import time
 import json
 import traceback
 import pandas as pd
+import numpy as np
+from typing import Literal
 from src._logger import ProjectLogger
 from src._create_dataset import DatasetCreator
 from dotenv import load_dotenv
 import os
+import threading
 
 
 class SimpleProducer:
@@ -14,12 +17,20 @@ class SimpleProducer:
     SERVER_IP = os.getenv('GCP_IP')
     logger = ProjectLogger(class_name='SimpleProducer').create_logger()
 
-    def __init__(self) -> None:
+    def __init__(self, serialization:Literal['bulk', 'row']='bulk', linger_ms:int=50, batch_size:int=1048576, compression:Literal['lz4', 'zstd', 'none']='lz4') -> None:
+        self.serialization = serialization
         self.topic = None
         self.data_filename = None
         self.df = None
+        self.producer = None
+        self.metrics = {}
+        self.metrics_lock = threading.Lock()
         self.producer_config = {
-            'bootstrap.servers': f'{self.SERVER_IP}:9092'
+            'bootstrap.servers': f'{self.SERVER_IP}:9092',
+            'linger.ms': linger_ms,
+            'batch.size': batch_size,
+            'compression.type': compression,
+            'queue.buffering.max.messages': 500000
         }
 
 
@@ -30,10 +41,7 @@ class SimpleProducer:
             self.df = df
 
             self.prepare_messages()
-
-            # create producer object using config dict
-            self.producer  = Producer(self.producer_config)
-
+            self.get_producer()
             self.produce_messages(topic=topic)
         except Exception as e:
             self.logger.error(msg=f'Exception happened in main function, error: {e}')
@@ -42,6 +50,22 @@ class SimpleProducer:
             raise
 
 
+    def get_producer(self):
+        # one producer is kept for the lifetime of the object, so its connections and batches are reused between calls
+        if self.producer is None:
+            self.producer = Producer(self.producer_config)
+            self.logger.info(msg=f'Kafka producer created with config: {self.producer_config}')
+        return self.producer
+
+
+    def close(self):
+        if self.producer is not None:
+            remaining = self.producer.flush(30)
+            if remaining > 0:
+                self.logger.warning(msg=f'{remaining} messages were still in the queue when the producer was closed!')
+            self.producer = None
+
+
     def prepare_messages(self):
         if self.df is not None:
             self.messages = self.df
@@ -58,32 +82,144 @@ class SimpleProducer:
 
 
     def delivery_report(self, err, msg):
+        with self.metrics_lock:
+            topic_metrics = self.metrics.setdefault(msg.topic(), {'produced': 0, 'delivered': 0, 'failed': 0, 'buffer_full': 0})
+            if err is not None:
+                topic_metrics['failed'] += 1
+            else:
+                topic_metrics['delivered'] += 1
         if err is not None:
             self.logger.warning(msg=f'Delivery failed for {msg.key()}, error: {err}')
             return
         #self.logger.info(msg=f'Record: {msg.key()} successfully produced to topic: {msg.topic()} partition: [{msg.partition()}] at offset: {msg.offset()}')
 
 
+    def create_keys(self):
+        # one key per machine, so all rows of a machine land on one partition in produce order
+        # (streaming inference drops rows older than its buffer), the fleet still spreads over partitions
+        if 'machine' in self.messages.columns:
+            return self.messages['machine'].astype(str)
+        if 'time' not in self.messages.columns:
+            return pd.Series(self.messages.index.astype(str), index=self.messages.index)
+        return self.topic + '|' + self.messages['time'].astype(str)
+
+
     def serialize_data(self, index:int):
         data = {col: str(self.messages.loc[index, col]) for col in self.messages.columns}
-        key = str(int(time.time()))
+        if 'machine' in self.messages.columns:
+            key = str(self.messages.loc[index, 'machine'])
+        else:
+            key = f"{self.topic}|{self.messages.loc[index, 'time']}" if 'time' in self.messages.columns else str(index)
         value = json.dumps(data).encode(encoding='utf-8')
         return key, value
+
+
+    def serialize_messages(self):
+        # the whole frame is encoded in one to_json pass, numbers stay numbers in the payload
+        messages = self.messages.copy(deep=False)
+        for col in messages.select_dtypes(include=['datetime', 'datetimetz']).columns:
+            messages[col] = messages[col].astype(str)
+        for col in messages.select_dtypes(include='float32').columns:
+            messages[col] = messages[col].to_numpy().astype(str).astype('float64')    # keep float32's shortest repr, 0.128 not 0.1280000061
+
+        keys = self.create_keys().tolist()
+        lines = messages.to_json(orient='records', lines=True, double_precision=15).splitlines()
+        return [(key, line.encode(encoding='utf-8')) for key, line in zip(keys, lines)]
+
+
+    def serialize_frame(self, topic:str, df:pd.DataFrame):
+        # (key, value) pairs for callers that produce through their own (e.g. transactional) producer
+        self.topic = topic
+        self.messages = df.rename(columns={'__time': 'time'})
+        return self.serialize_messages()
+
+
+    def benchmark_serialization(self, df:pd.DataFrame, repeat:int=3):
+        self.messages = df
+        results = {}
+        for mode in ['row', 'bulk']:
+            started = time.perf_counter()
+            for _ in range(repeat):
+                if mode == 'row':
+                    [self.serialize_data(index=index) for index in range(len(self.messages))]
+                else:
+                    self.serialize_messages()
+            results[mode] = round(len(df) * repeat / (time.perf_counter() - started), 1)
+        self.logger.info(msg=f'Serialization throughput (rows/sec) for {len(df)} rows x {len(df.columns)} columns: {results}')
+        return results
     
 
     def produce_messages(self, topic:str):
         self.logger.info(msg=f'Messages are going to produce to the {topic} named topic.')
-        for index in range(len(self.messages)):
+        with self.metrics_lock:
+            topic_metrics = self.metrics.setdefault(topic, {'produced': 0, 'delivered': 0, 'failed': 0, 'buffer_full': 0})
+            delivered_before = topic_metrics['delivered']
+        started = time.perf_counter()
+
+        if self.serialization == 'bulk':
+            serialized_messages = self.serialize_messages()
+        else:
+            serialized_messages = (self.serialize_data(index=index) for index in range(len(self.messages)))
+
+        max_queue_depth = 0     # read while producing, the queue is always empty after flush()
+        for index, (msg_key, msg_value) in enumerate(serialized_messages):
             try:
-                msg_key, msg_value = self.serialize_data(index=index)
-                self.producer.produce(key=msg_key, value=msg_value, topic=self.topic, on_delivery=self.delivery_report)
-            except BufferError:
-                self.producer.poll(0.1)
+                self.produce_with_retry(
+                    producer=self.producer, topic=self.topic, key=msg_key, value=msg_value, on_delivery=self.delivery_report,
+                    on_buffer_full=lambda: self.count_buffer_full(topic_metrics=topic_metrics))
+                with self.metrics_lock:
+                    topic_metrics['produced'] += 1
+                self.producer.poll(0)
+                max_queue_depth = max(max_queue_depth, len(self.producer))
             except Exception as e:
                 self.logger.error(msg=f'Exception while producing message - index: {index}, Err: {e}')
                 self.logger.error(msg=traceback.format_exc())
             except KeyboardInterrupt:
                 raise
-        self.logger.info(msg=f'Messages successfully produced to the {topic} named topic!')
         self.producer.flush()
-        time.sleep(3)
\ No newline at end of file
+        self.log_metrics(topic=topic, delivered_before=delivered_before, elapsed=time.perf_counter() - started, max_queue_depth=max_queue_depth)
+        self.logger.info(msg=f'Messages successfully produced to the {topic} named topic!')
+
+
+    @staticmethod
+    def produce_with_retry(producer:Producer, topic:str, key:str, value:bytes, on_delivery=None, on_buffer_full=None):
+        # shared with the transactional streaming preprocessor, a full local queue never drops a row
+        callbacks = {'on_delivery': on_delivery} if on_delivery is not None else {}
+        while True:
+            try:
+                producer.produce(topic=topic, key=key, value=value, **callbacks)
+                return
+            except BufferError:
+                # local queue is full, serve delivery callbacks until there is room and retry the same row
+                if on_buffer_full is not None:
+                    on_buffer_full()
+                producer.poll(0.5)
+
+
+    def count_buffer_full(self, topic_metrics:dict):
+        with self.metrics_lock:
+            topic_metrics['buffer_full'] += 1
+
+
+    def log_metrics(self, topic:str, delivered_before:int, elapsed:float, max_queue_depth:int=0):
+        with self.metrics_lock:
+            topic_metrics = self.metrics[topic]
+            topic_metrics['messages_per_second'] = round((topic_metrics['delivered'] - delivered_before) / elapsed, 1) if elapsed > 0 else 0.0
+            topic_metrics['max_queue_depth'] = max_queue_depth
+            self.logger.info(msg=f'{topic} delivery metrics: {topic_metrics}')
+
+
+if __name__ == '__main__':
+    rows = 20000
+    df = pd.DataFrame({
+        'machine': 'Blower-Pump-1',
+        'time': pd.date_range(start='2024-01-14', periods=rows, freq='1min').strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'axialAxisRmsVibration': np.random.uniform(0, 0.3, rows).astype('float32'),
+        'radialAxisKurtosis': np.random.uniform(2, 4, rows).astype('float32'),
+        'radialAxisPeakAcceleration': np.random.uniform(0, 0.1, rows).astype('float32'),
+        'radialAxisRmsAcceleration': np.random.uniform(0, 0.02, rows).astype('float32'),
+        'radialAxisRmsVibration': np.random.uniform(0, 0.3, rows).astype('float32'),
+        'temperature': np.random.uniform(20, 40, rows).astype('float32')
+    })
+    producer = SimpleProducer()
+    producer.benchmark_serialization(df=df)
@@ -0,0 +1,209 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import nullcontext
+from src._logger import ProjectLogger
+from typing import Literal
+import multiprocessing
+import traceback
+import pickle
+import shutil
+import time
+import os
+
+
+class StageScheduler:
+    logger = ProjectLogger(class_name='StageScheduler').create_logger()
+    CHECKPOINT_RETENTION_DAYS = 7
+
+    def __init__(self, run_id:str, checkpoint_directory:str=None, max_threads:int=4, max_processes:int=2, process_start_method:str='spawn', memory_limit_mb:int=None, process_pool:ProcessPoolExecutor=None, checkpoint_retention_days:int=None):
+        # stages run as soon as their inputs are ready, io stages on threads and heavy stages (tf training) on processes
+        # memory_limit_mb caps the summed memory_mb estimates of the running stages, None means no cap
+        # process_pool is a caller owned pool that outlives the run (e.g. warm model workers), it is not shut down here
+        self.run_id = run_id
+        self.checkpoint_directory = checkpoint_directory or self.default_checkpoint_directory()
+        self.checkpoint_retention_days = checkpoint_retention_days or self.CHECKPOINT_RETENTION_DAYS     # leftovers of failed runs are kept this long
+        self.max_threads = max_threads
+        self.max_processes = max_processes
+        self.process_start_method = process_start_method
+        self.memory_limit_mb = memory_limit_mb
+        self.stages = {}
+        self.results = {}
+        self.timings = {}
+        self.failed = []
+        self.process_pool = process_pool
+        self.broken_process_pool = False
+
+
+    def add_stage(self, name:str, func, inputs:dict=None, after:list=None, kwargs:dict=None, executor:Literal['thread', 'process']='thread', memory_mb:int=0):
+        # inputs maps func's keyword arguments to upstream stage names, after only orders stages without passing results
+        if name in self.stages:
+            raise ValueError(f'Stage {name} is already added.')
+        if executor not in ['thread', 'process']:
+            raise ValueError(f'Invalid executor: {executor}. executor must be "thread" or "process".')
+        self.stages[name] = {
+            'func': func,
+            'inputs': inputs or {},
+            'after': after or [],
+            'kwargs': kwargs or {},
+            'executor': executor,
+            'memory_mb': memory_mb
+        }
+
+
+    def dependencies(self, name:str):
+        stage = self.stages[name]
+        return set(stage['inputs'].values()) | set(stage['after'])
+
+
+    def validate(self):
+        for name in self.stages:
+            unknown = self.dependencies(name=name) - set(self.stages)
+            if len(unknown) > 0:
+                raise ValueError(f'Stage {name} depends on unknown stage(s): {unknown}')
+
+        visited = set()
+        visiting = set()
+        def visit(name):
+            if name in visiting:
+                raise ValueError(f'Stage graph has a cycle through {name}.')
+            if name not in visited:
+                visiting.add(name)
+                for dependency in self.dependencies(name=name):
+                    visit(dependency)
+                visiting.remove(name)
+                visited.add(name)
+        for name in self.stages:
+            visit(name)
+
+
+    def run(self, raise_on_failure:bool=True):
+        # with raise_on_failure=False the caller gets the partial results and reads self.failed itself
+        self.validate()
+        self.prune_checkpoints()
+        self.load_checkpoints()
+        pending = [name for name in self.stages if name not in self.results]
+        blocked = set()
+        running = {}
+        started = time.perf_counter()
+
+        if self.process_pool is not None:
+            process_pool_context = nullcontext(self.process_pool)
+        else:
+            process_pool_context = ProcessPoolExecutor(max_workers=self.max_processes, mp_context=multiprocessing.get_context(self.process_start_method))
+        with ThreadPoolExecutor(max_workers=self.max_threads, thread_name_prefix='stage') as thread_pool, process_pool_context as process_pool:
+            while len(pending) > 0 or len(running) > 0:
+                for name in list(pending):
+                    dependencies = self.dependencies(name=name)
+                    if len(dependencies & blocked) > 0:
+                        pending.remove(name)
+                        blocked.add(name)
+                        self.logger.warning(msg=f'Stage {name} skipped, an upstream stage failed.')
+                    elif dependencies.issubset(self.results) and self.fits_in_memory(name=name, running=running):
+                        pending.remove(name)
+                        stage = self.stages[name]
+                        arguments = {argument: self.results[upstream] for argument, upstream in stage['inputs'].items()}
+                        pool = process_pool if stage['executor'] == 'process' else thread_pool
+                        running[pool.submit(stage['func'], **stage['kwargs'], **arguments)] = (name, time.perf_counter())
+                        self.logger.info(msg=f'Stage {name} started on a {stage["executor"]}.')
+
+                if len(running) == 0:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name, stage_started = running.pop(future)
+                    self.timings[name] = round(time.perf_counter() - stage_started, 2)
+                    try:
+                        self.results[name] = future.result()
+                        self.save_checkpoint(name=name)
+                        self.logger.info(msg=f'Stage {name} finished in {self.timings[name]} seconds.')
+                    except Exception as e:
+                        if isinstance(e, BrokenProcessPool):
+                            self.broken_process_pool = True
+                        blocked.add(name)
+                        self.failed.append(name)
+                        self.logger.error(msg=f'Stage {name} failed after {self.timings[name]} seconds, error: {e}')
+                        self.logger.error(msg=traceback.format_exc())
+
+        self.logger.info(msg=f'Run {self.run_id} finished in {time.perf_counter() - started:.2f} seconds. Stage timings: {self.timings}')
+        if len(self.failed) > 0:
+            if raise_on_failure:
+                raise RuntimeError(f'Stage(s) failed: {self.failed}. Completed stages are checkpointed and will be resumed.')
+            self.logger.warning(msg=f'Stage(s) failed: {self.failed}. Completed stages are checkpointed and will be resumed.')
+            return self.results
+        self.clear_checkpoints()
+        return self.results
+
+
+    def fits_in_memory(self, name:str, running:dict):
+        # a stage waits while the running ones use up the budget, a stage alone is always allowed so that nothing starves
+        if self.memory_limit_mb is None or len(running) == 0:
+            return True
+        in_use = sum(self.stages[running_name]['memory_mb'] for running_name, _ in running.values())
+        return in_use + self.stages[name]['memory_mb'] <= self.memory_limit_mb
+
+
+    @staticmethod
+    def default_checkpoint_directory():
+        return os.path.join(os.getcwd(), 'checkpoints')
+
+
+    @classmethod
+    def latest_incomplete_run(cls, checkpoint_directory:str=None):
+        # a run's directory is removed when it finishes, so every directory left belongs to a run that crashed or had failed stages
+        checkpoint_directory = checkpoint_directory or cls.default_checkpoint_directory()
+        if not os.path.exists(checkpoint_directory):
+            return None
+        cutoff = time.time() - cls.CHECKPOINT_RETENTION_DAYS * 24 * 3600
+        runs = [
+            run for run in os.listdir(checkpoint_directory)
+            if os.path.isdir(os.path.join(checkpoint_directory, run)) and os.path.getmtime(os.path.join(checkpoint_directory, run)) >= cutoff
+        ]
+        if len(runs) == 0:
+            return None
+        return max(runs, key=lambda run: os.path.getmtime(os.path.join(checkpoint_directory, run)))
+
+
+    def run_directory(self):
+        return os.path.join(self.checkpoint_directory, self.run_id)
+
+
+    def save_checkpoint(self, name:str):
+        os.makedirs(self.run_directory(), exist_ok=True)
+        path = os.path.join(self.run_directory(), f'{name}.pkl')
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(self.results[name], f)
+        os.replace(path + '.tmp', path)
+
+
+    def load_checkpoints(self):
+        if not os.path.exists(self.run_directory()):
+            return
+        for name in self.stages:
+            path = os.path.join(self.run_directory(), f'{name}.pkl')
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    self.results[name] = pickle.load(f)
+        if len(self.results) > 0:
+            self.logger.info(msg=f'Run {self.run_id} resumed, completed stages: {list(self.results)}')
+
+
+    def clear_checkpoints(self):
+        # a finished run does not need its checkpoints
+        if os.path.exists(self.run_directory()):
+            shutil.rmtree(self.run_directory(), ignore_errors=True)
+
+
+    def prune_checkpoints(self):
+        # other runs' directories not touched for checkpoint_retention_days are removed whether they finished or not
+        if not os.path.exists(self.checkpoint_directory):
+            return []
+        cutoff = time.time() - self.checkpoint_retention_days * 24 * 3600
+        pruned = []
+        for run in os.listdir(self.checkpoint_directory):
+            path = os.path.join(self.checkpoint_directory, run)
+            if run != self.run_id and os.path.isdir(path) and os.path.getmtime(path) < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
+                pruned.append(run)
+        if len(pruned) > 0:
+            self.logger.info(msg=f'{len(pruned)} checkpoint run(s) older than {self.checkpoint_retention_days} days removed: {pruned}')
+        return pruned
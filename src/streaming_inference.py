@@ -0,0 +1,308 @@
+from confluent_kafka import Consumer, KafkaException, KafkaError
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from dotenv import load_dotenv
+from src._logger import ProjectLogger
+from src.model import RNNModel
+from src.global_model import GlobalRNNModel
+from src.model_artifact import ModelArtifact
+from src.model_registry import ModelRegistry
+from src.druid_data import DruidDataFetcher
+from src.producer import SimpleProducer
+from src.windowing import configure_threading
+import pandas as pd
+import numpy as np
+import threading
+import traceback
+import json
+import time
+import os
+
+
+def run_streaming_inference(fleet:list, timeframes:dict, cadence_minutes:int=15, n_samples:int=100, threads:int=None, global_model:bool=False):
+    # entry point for a spawned process, tf is only imported and configured inside it
+    configure_threading(intra_op_threads=threads, inter_op_threads=2 if threads is not None else None)
+    StreamingInference(fleet=fleet, timeframes=timeframes, cadence_minutes=cadence_minutes, n_samples=n_samples, threads=threads, global_model=global_model).main()
+
+
+class RingBuffer:
+    def __init__(self, capacity:int, n_columns:int):
+        # fixed size, the oldest row is overwritten, nothing is reallocated while the stream runs
+        self.capacity = capacity
+        self.rows = np.zeros((capacity, n_columns), dtype=np.float32)
+        self.times = np.zeros(capacity, dtype='datetime64[ns]')
+        self.position = 0
+        self.count = 0
+        self.appended = 0       # rows appended since the last forecast
+
+
+    def last_time(self):
+        if self.count == 0:
+            return None
+        return self.times[(self.position - 1) % self.capacity]
+
+
+    def append(self, rows:np.ndarray, times:np.ndarray):
+        # rows must be sorted by time, rows that are not newer than the buffer's last row (redeliveries) are dropped
+        last_time = self.last_time()
+        if last_time is not None:
+            newer = times > last_time
+            rows, times = rows[newer], times[newer]
+        rows, times = rows[-self.capacity:], times[-self.capacity:]
+        indices = (self.position + np.arange(len(rows))) % self.capacity
+        self.rows[indices] = rows
+        self.times[indices] = times
+        self.position = (self.position + len(rows)) % self.capacity
+        self.count = min(self.count + len(rows), self.capacity)
+        self.appended += len(rows)
+        return len(rows)
+
+
+    def window(self):
+        # a chronological copy of the buffered rows, safe to hand to another thread
+        indices = (self.position - self.count + np.arange(self.count)) % self.capacity
+        return self.rows[indices].copy(), self.times[indices].copy()
+
+
+    def is_full(self):
+        return self.count == self.capacity
+
+
+class StreamingInference:
+    load_dotenv()
+    SERVER_IP = os.getenv('GCP_IP')
+    logger = ProjectLogger(class_name='StreamingInference').create_logger()
+    BATCH_SIZE = 5000
+    POLL_TIMEOUT = 1.0
+
+    def __init__(self, fleet:list, timeframes:dict, cadence_minutes:int=15, n_samples:int=100, threads:int=None, group_id:str='streaming-inference', global_model:bool=False):
+        # timeframes is RunPipeline.timeframes, every processed topic gets its own per-machine buffers and forecasts
+        # forecasts only move forward when something produces to the processed topics between the nightly runs,
+        # e.g. the streaming preprocessor fed by a continuous raw-data source, otherwise every night's data is forecast once
+        self.fleet = [(line, machine) for line, machine in fleet]     # the same machine name can exist on several lines
+        self.topics = {config['processed_topic']: config for config in timeframes.values()}
+        self.incremental = {config['interval_minute']: config.get('incremental', False) for config in timeframes.values()}
+        self.global_model = global_model    # every machine is served by the timeframe's global model
+        self.cadence = timedelta(minutes=cadence_minutes)
+        self.n_samples = n_samples
+        self.threads = threads
+        self.registry = ModelRegistry()
+        self.producer = SimpleProducer()
+        self.buffers = {}       # (line, machine, interval_minute) -> RingBuffer
+        self.artifacts = {}     # (line, machine, interval_minute) -> (model_name, ModelArtifact)
+        self.missing = {}       # (line, machine, interval_minute) -> monotonic time of the last failed buffer creation
+        self.buffers_lock = threading.Lock()
+        self.inference = ThreadPoolExecutor(max_workers=1, thread_name_prefix='streaming-inference')
+        self.running = None
+
+        # state is rebuilt from druid on start, so there is no reason to replay old offsets
+        self.consumer_config = {
+            'bootstrap.servers': f'{self.SERVER_IP}:9092',
+            'group.id': group_id,
+            'auto.offset.reset': 'latest',
+            'enable.auto.commit': True
+        }
+        self.consumer = Consumer(self.consumer_config)
+
+
+    def main(self):
+        try:
+            self.consumer.subscribe(topics=list(self.topics))
+            self.logger.info(msg=f'Streaming inference started for topics: {list(self.topics)}, cadence: {self.cadence}, machines: {self.fleet}')
+            self.create_buffers()
+            next_run = datetime.now(timezone.utc) + self.cadence
+            while True:
+                messages = self.consumer.consume(num_messages=self.BATCH_SIZE, timeout=self.POLL_TIMEOUT)
+                rows = {}
+                for msg in messages:
+                    if msg.error() is not None:
+                        if msg.error().code() == KafkaError._PARTITION_EOF:
+                            continue
+                        raise KafkaException(msg.error())
+                    try:
+                        rows.setdefault(msg.topic(), []).append(json.loads(msg.value()))
+                    except Exception as e:
+                        self.logger.error(msg=f'Message skipped, it could not be deserialized. Offset: {msg.offset()}, error: {e}')
+                for topic, topic_rows in rows.items():
+                    self.append_rows(config=self.topics[topic], rows=topic_rows)
+
+                # the rollout runs on its own thread so the consumer keeps polling, a tick is skipped while the last one still runs
+                if datetime.now(timezone.utc) >= next_run:
+                    self.create_buffers()
+                    if self.running is None or self.running.done():
+                        self.running = self.inference.submit(self.forecast_all)
+                    else:
+                        self.logger.warning(msg='Previous forecast round is still running, this round is skipped.')
+                    next_run += self.cadence
+        except KeyboardInterrupt:
+            raise
+        except Exception as e:
+            self.logger.error(msg=f'Exception happened in streaming inference, error: {e}')
+            self.logger.error(msg=traceback.format_exc())
+        finally:
+            self.consumer.close()
+            self.inference.shutdown(wait=True)
+            self.producer.close()
+
+
+    def create_buffers(self):
+        # every fleet machine gets its buffer up front, machines without a model are retried once per cadence
+        for config in self.topics.values():
+            for line, machine in self.fleet:
+                self.ensure_buffer(config=config, line=line, machine=machine)
+
+
+    def ensure_buffer(self, config:dict, line:str, machine:str):
+        key = (line, machine, config['interval_minute'])
+        if key in self.buffers:
+            return True
+        if time.monotonic() - self.missing.get(key, -np.inf) < self.cadence.total_seconds():
+            return False
+        if not self.create_buffer(config=config, line=line, machine=machine):
+            self.missing[key] = time.monotonic()
+            return False
+        self.missing.pop(key, None)
+        return True
+
+
+    def append_rows(self, config:dict, rows:list):
+        df = pd.DataFrame(data=rows)
+        # rows without a line column were published before it existed, they can not be told apart and are skipped
+        if 'line' not in df.columns or 'machine' not in df.columns or 'time' not in df.columns:
+            return
+        for (line, machine), machine_df in df.groupby(['line', 'machine']):
+            if (line, machine) not in self.fleet:
+                continue
+            key = (line, machine, config['interval_minute'])
+            if not self.ensure_buffer(config=config, line=line, machine=machine):
+                continue
+            rows, times = self.prepare_rows(df=machine_df, columns=self.buffer_columns(artifact=self.artifacts[key][1]))
+            with self.buffers_lock:
+                if key in self.buffers:
+                    self.buffers[key].append(rows=rows, times=times)
+
+
+    def prepare_rows(self, df:pd.DataFrame, columns:list):
+        # same is_running rule and column order as the nightly model input
+        df = df.rename(columns={'time': '__time'}).copy()
+        for column in RNNModel.input_columns:
+            if column != 'is_running':
+                df[column] = pd.to_numeric(df[column], errors='coerce')
+        df = RNNModel().preprocess(df=df).dropna()
+        df = df[~df.index.duplicated(keep='last')].sort_index()
+        times = df.index.tz_convert(None) if df.index.tz is not None else df.index     # naive utc in the buffer
+        return df[columns].to_numpy(dtype=np.float32), times.to_numpy(dtype='datetime64[ns]')
+
+
+    def buffer_columns(self, artifact:ModelArtifact):
+        # a global artifact's columns end with the one-hot machine block, the buffer only keeps the sensor columns
+        return [column for column in artifact.columns if not (self.global_model and column.startswith(GlobalRNNModel.machine_prefix))]
+
+
+    def select_model(self, line:str, machine:str, interval_minute:int):
+        # best registered model first, then the newest saved artifact, the same models the nightly run keeps
+        if self.global_model:
+            directory = GlobalRNNModel.global_model_directory(interval_minute=interval_minute)
+            line, machine = None, None      # global models are registered without an owner
+        else:
+            directory = ModelRegistry.model_directory(interval_minute=interval_minute, line=line, machine=machine)
+        if not os.path.exists(directory):
+            return None, None
+        # incremental timeframes serve the newest fine-tuned model, the others the one with the best val_RMSE
+        if self.incremental.get(interval_minute, False) and not self.global_model:
+            best = self.registry.select_latest(interval_minute=interval_minute, line=line, machine=machine)
+        else:
+            best = self.registry.select_best(interval_minute=interval_minute, line=line, machine=machine)
+        if best is not None and ModelArtifact.exists(directory=directory, model_name=best['model_name']):
+            return directory, best['model_name']
+        prefix, suffix = 'model_', f'_{interval_minute}m.keras'
+        model_files = [f for f in os.listdir(directory) if f.startswith(prefix) and f.endswith(suffix) and ModelArtifact.exists(directory=directory, model_name=f)]
+        if len(model_files) == 0:
+            return directory, None
+        return directory, max(model_files, key=lambda x: int(x.split(prefix)[1].split(suffix)[0]))
+
+
+    def load_model(self, line:str, machine:str, interval_minute:int):
+        # called on every tick, the artifact cache makes this a stat call unless the nightly run saved a better model
+        directory, model_name = self.select_model(line=line, machine=machine, interval_minute=interval_minute)
+        if model_name is None:
+            self.logger.warning(msg=f'No saved {interval_minute}m model with scalers found for {line} {machine}, streaming forecasts wait for the nightly run.')
+            return None
+        artifact = ModelRegistry.load_artifact(directory=directory, model_name=model_name)
+        if self.global_model and f'{GlobalRNNModel.machine_prefix}{line}/{machine}' not in artifact.columns:
+            self.logger.warning(msg=f'{model_name} global model was not trained on {line} {machine}, streaming forecasts wait for the nightly run.')
+            return None
+        self.artifacts[(line, machine, interval_minute)] = (model_name, artifact)
+        return artifact
+
+
+    def create_buffer(self, config:dict, line:str, machine:str):
+        # the buffer is as long as the model's window and is filled from druid once, the stream keeps it current afterwards
+        interval_minute = config['interval_minute']
+        try:
+            artifact = self.load_model(line=line, machine=machine, interval_minute=interval_minute)
+            if artifact is None:
+                return False
+            columns = self.buffer_columns(artifact=artifact)
+            buffer = RingBuffer(capacity=artifact.window_size, n_columns=len(columns))
+            # druid only holds data up to the last nightly run, so the latest rows are taken whatever their age
+            history = DruidDataFetcher().fetch_latest(topic=config['processed_topic'], limit=artifact.window_size, filters={'line': (line, None), 'machine': machine})
+            if history is not None and len(history) > 0:
+                rows, times = self.prepare_rows(df=history.rename(columns={'__time': 'time'}), columns=columns)     # druid rows look like the topic's rows
+                buffer.append(rows=rows, times=times)
+            with self.buffers_lock:
+                self.buffers[(line, machine, interval_minute)] = buffer
+            self.logger.info(msg=f'{line} {machine} {interval_minute}m buffer created with {buffer.count}/{buffer.capacity} rows from druid.')
+            return True
+        except Exception as e:
+            self.logger.error(msg=f'Exception happened while creating the {line} {machine} {interval_minute}m buffer!')
+            self.logger.error(msg=traceback.format_exc())
+            return False
+
+
+    def forecast_all(self):
+        configs = {config['interval_minute']: config for config in self.topics.values()}
+        with self.buffers_lock:
+            buffers = list(self.buffers.items())
+        for (line, machine, interval_minute), buffer in buffers:
+            with self.buffers_lock:
+                if not buffer.is_full() or buffer.appended == 0:
+                    continue
+                window, times = buffer.window()
+                buffer.appended = 0
+            try:
+                self.forecast(config=configs[interval_minute], line=line, machine=machine, window=window, last_time=times[-1])
+            except Exception as e:
+                self.logger.error(msg=f'Exception happened while forecasting {line} {machine} {interval_minute}m!')
+                self.logger.error(msg=traceback.format_exc())
+
+
+    def forecast(self, config:dict, line:str, machine:str, window:np.ndarray, last_time):
+        key = (line, machine, config['interval_minute'])
+        artifact = self.load_model(line=line, machine=machine, interval_minute=config['interval_minute'])
+        if artifact is None:
+            return
+        if len(window) != artifact.window_size:
+            # a newly selected model has another window size, the buffer is rebuilt from druid on the next message
+            with self.buffers_lock:
+                self.buffers.pop(key, None)
+            return
+
+        # RNNModel's rollout, band and breakdown helpers, the forecast starts right after the latest streamed row
+        model = GlobalRNNModel(threads=self.threads) if self.global_model else RNNModel(threads=self.threads)
+        model.n_samples = self.n_samples
+        model.start_time = pd.Timestamp(last_time, tz='UTC') + pd.Timedelta(minutes=config['interval_minute'])
+        output_steps = int(config['output_days'] * 24 * (60 / config['interval_minute']))
+        if self.global_model:
+            # the machine's own scalers and stats, the one-hot block picks it inside the global model
+            model.load_state(artifact=artifact)
+            predictions = model.forecast_machine(model=artifact.model, machine=f'{line}/{machine}', window=window, output_steps=output_steps)
+        else:
+            predictions = model.predict_future_values(
+                window=window, model=artifact.model, output_steps=output_steps,
+                feature_scaler=artifact.feature_scaler, target_scaler=artifact.target_scaler, stats=artifact.stats)
+        timestamped_predictions = model.add_time_column_to_predicted_values(predictions=predictions, interval_minute=config['interval_minute'])
+        breakdown_probability = model.calculate_breakdown_probability(predictions=timestamped_predictions, column=model.target_column)
+
+        self.producer.main(topic=config['predicted_topic'], df=timestamped_predictions.assign(line=line, machine=machine))
+        self.logger.info(msg=f'{line} {machine} {config["interval_minute"]}m forecast published from {model.start_time} with {self.artifacts[key][0]}. Breakdown probability: {breakdown_probability}%')
@@ -0,0 +1,143 @@
+from confluent_kafka import Consumer, Producer, KafkaException, KafkaError, TopicPartition
+from dotenv import load_dotenv
+from src._logger import ProjectLogger
+from src.data_processor import DataPreprocessor
+from src.producer import SimpleProducer
+import pandas as pd
+import traceback
+import json
+import time
+import os
+
+
+def run_streaming_preprocessor(topics:dict, worker_id:int=0):
+    # entry point for a spawned process, topics maps raw topics to their processed topics
+    # main() returns after a fatal or fenced transaction, a new instance re-inits the transactional producer and consumer
+    # so the stream is down for the backoff only, not until start_services runs again after the nightly pipeline
+    while True:
+        StreamingPreprocessor(topics=topics, worker_id=worker_id).main()
+        StreamingPreprocessor.logger.warning(msg=f'Streaming preprocessor {worker_id} stopped, restarting in {StreamingPreprocessor.RESTART_BACKOFF_SECONDS} seconds.')
+        time.sleep(StreamingPreprocessor.RESTART_BACKOFF_SECONDS)
+
+
+class StreamingPreprocessor:
+    load_dotenv()
+    SERVER_IP = os.getenv('GCP_IP')
+    logger = ProjectLogger(class_name='StreamingPreprocessor').create_logger()
+    BATCH_SIZE = 5000
+    FLUSH_INTERVAL = 1.0
+    TRANSACTION_TIMEOUT = 30
+    RETRY_BACKOFF_SECONDS = 2
+    MAX_TRANSACTION_RETRIES = 3     # short, the consumer is not polled while a batch is retried
+    RESTART_BACKOFF_SECONDS = 30
+    # the group or the transactional id moved on, retrying can not succeed, main() returns and run_streaming_preprocessor restarts it
+    restart_errors = [
+        getattr(KafkaError, name) for name in
+        ['_FENCED', 'PRODUCER_FENCED', 'INVALID_PRODUCER_EPOCH', 'UNKNOWN_MEMBER_ID', 'ILLEGAL_GENERATION', 'REBALANCE_IN_PROGRESS', 'FENCED_INSTANCE_ID']
+        if hasattr(KafkaError, name)
+    ]
+    numeric_columns = ['axialAxisRmsVibration', 'radialAxisKurtosis', 'radialAxisPeakAcceleration', 'radialAxisRmsAcceleration', 'radialAxisRmsVibration', 'temperature']
+
+    def __init__(self, topics:dict, worker_id:int=0, group_id:str='streaming-preprocessor'):
+        # consume -> process -> produce in one kafka transaction per micro-batch, the consumed offsets are committed inside it
+        # so a processed row is visible exactly once even when the worker dies between producing and committing
+        self.topics = topics
+        self.preprocessor = DataPreprocessor()
+        self.serializer = SimpleProducer()
+        self.consumer_config = {
+            'bootstrap.servers': f'{self.SERVER_IP}:9092',
+            'group.id': group_id,
+            'auto.offset.reset': 'earliest',
+            'enable.auto.commit': False,
+            'isolation.level': 'read_committed'
+        }
+        self.producer_config = {
+            'bootstrap.servers': f'{self.SERVER_IP}:9092',
+            'transactional.id': f'{group_id}-{worker_id}',     # stable per worker, a restarted worker fences its old instance
+            'enable.idempotence': True,
+            'linger.ms': 50,
+            'compression.type': 'lz4'
+        }
+        self.consumer = Consumer(self.consumer_config)
+        self.producer = Producer(self.producer_config)
+
+
+    def main(self):
+        try:
+            self.producer.init_transactions(self.TRANSACTION_TIMEOUT)
+            self.consumer.subscribe(topics=list(self.topics))
+            self.logger.info(msg=f'Streaming preprocessor started: {self.topics}')
+            while True:
+                messages = self.consumer.consume(num_messages=self.BATCH_SIZE, timeout=self.FLUSH_INTERVAL)
+                rows = {}
+                offsets = {}
+                for msg in messages:
+                    if msg.error() is not None:
+                        if msg.error().code() == KafkaError._PARTITION_EOF:
+                            continue
+                        raise KafkaException(msg.error())
+                    offsets[(msg.topic(), msg.partition())] = msg.offset() + 1
+                    try:
+                        rows.setdefault(msg.topic(), []).append(json.loads(msg.value()))
+                    except Exception as e:
+                        self.logger.error(msg=f'Message skipped, it could not be deserialized. Offset: {msg.offset()}, error: {e}')
+                if len(offsets) > 0:
+                    self.process_batch(rows=rows, offsets=offsets)
+        except KeyboardInterrupt:
+            raise
+        except Exception as e:
+            self.logger.error(msg=f'Exception happened in the streaming preprocessor, error: {e}')
+            self.logger.error(msg=traceback.format_exc())
+        finally:
+            self.consumer.close()
+
+
+    def process(self, rows:list):
+        # the same vectorized threshold rule as the nightly DataPreprocessor, applied to one micro-batch
+        df = pd.DataFrame(data=rows)
+        for column in self.numeric_columns:
+            if column in df.columns:
+                df[column] = pd.to_numeric(df[column], errors='coerce')
+        self.preprocessor.df = df
+        return self.preprocessor.process()
+
+
+    def process_batch(self, rows:dict, offsets:dict):
+        # rows are processed before the transaction starts, a batch that can not be processed is skipped like a bad message
+        serialized = []
+        for raw_topic, topic_rows in rows.items():
+            processed_topic = self.topics[raw_topic]
+            try:
+                serialized += [(processed_topic, key, value) for key, value in self.serializer.serialize_frame(topic=processed_topic, df=self.process(rows=topic_rows))]
+            except Exception as e:
+                self.logger.error(msg=f'{len(topic_rows)} {raw_topic} rows skipped, they could not be processed. Error: {e}')
+
+        commit_offsets = [TopicPartition(topic, partition, offset) for (topic, partition), offset in offsets.items()]
+        attempt = 0
+        while True:
+            began = False
+            try:
+                self.producer.begin_transaction()
+                began = True
+                for topic, key, value in serialized:
+                    self.produce(topic=topic, key=key, value=value)
+                self.producer.send_offsets_to_transaction(commit_offsets, self.consumer.consumer_group_metadata(), self.TRANSACTION_TIMEOUT)
+                self.producer.commit_transaction(self.TRANSACTION_TIMEOUT)
+                return len(serialized)
+            except KafkaException as e:
+                error = e.args[0]
+                attempt += 1
+                if error.fatal() or error.code() in self.restart_errors or attempt > self.MAX_TRANSACTION_RETRIES:
+                    self.logger.error(msg=f'Transaction failed after {attempt} attempt(s), the worker stops. Error: {error}')
+                    raise
+                # read_committed consumers never see the aborted rows, the same batch is produced again in a new transaction
+                backoff = min(self.RETRY_BACKOFF_SECONDS * (2 ** (attempt - 1)), 10)
+                self.logger.error(msg=f'Transaction aborted, the batch of {len(serialized)} rows is retried in {backoff} seconds. Error: {error}')
+                if began:
+                    self.producer.abort_transaction(self.TRANSACTION_TIMEOUT)
+                time.sleep(backoff)
+
+
+    def produce(self, topic:str, key:str, value:bytes):
+        SimpleProducer.produce_with_retry(producer=self.producer, topic=topic, key=key, value=value)
+        self.producer.poll(0)
@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from numpy.lib.stride_tricks import sliding_window_view
+from src._logger import ProjectLogger
+
+
+def configure_threading(intra_op_threads:int=None, inter_op_threads:int=None):
+    # has to run before tf executes anything in the process, a second call in the same process is only logged
+    try:
+        if intra_op_threads is not None:
+            tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+        if inter_op_threads is not None:
+            tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+    except RuntimeError as e:
+        SlidingWindowBuilder.logger.warning(msg=f'TF threading is already initialized, keeping the current settings: {e}')
+
+
+class SlidingWindowBuilder:
+    logger = ProjectLogger(class_name='SlidingWindowBuilder').create_logger()
+
+    def __init__(self, window_size:int, dtype=np.float32, threads:int=None):
+        # threads sizes the private pool of the tf.data pipelines, None leaves it to tf
+        self.window_size = window_size
+        self.dtype = dtype
+        self.threads = threads
+
+
+    def build(self, df:pd.DataFrame, target_column:str):
+        # X is a read-only (n_windows, window_size, n_features) view over one float32 buffer, nothing is copied here
+        target_index = df.columns.tolist().index(target_column)
+        data = np.ascontiguousarray(df.to_numpy(dtype=self.dtype))
+        X = self.windows(data=data)[:-1]
+        y = data[self.window_size:, target_index]
+        y.flags.writeable = False
+        self.logger.info(msg=f'Sliding windows created as a view. Shape: {X.shape}, base buffer: {data.nbytes / 1e6:.1f} MB')
+        return X, y
+
+
+    def windows(self, data:np.ndarray):
+        return sliding_window_view(data, window_shape=self.window_size, axis=0).transpose(0, 2, 1)
+
+
+    def rows(self, X:np.ndarray):
+        # recover the (n_windows + window_size - 1, n_features) rows the windows were cut from
+        if len(X) == 0:
+            return np.empty((0, X.shape[2]), dtype=X.dtype)
+        return np.concatenate([X[:, 0, :], X[-1, 1:, :]], axis=0)
+
+
+    def transform(self, X:np.ndarray, scaler):
+        # scaling is row-wise, so scaling the rows once and re-windowing equals scaling every window
+        scaled_rows = np.ascontiguousarray(scaler.transform(self.rows(X=X)), dtype=self.dtype)
+        return self.windows(data=scaled_rows)
+
+
+    def dataset(self, rows:np.ndarray, starts:np.ndarray, targets:np.ndarray=None, batch_size:int=32, shuffle:bool=False, cache:bool=False, seed:int=None):
+        # windows are gathered from `rows` per batch, starts are row offsets so several series can live in one rows array
+        # cache keeps the gathered batches after the first epoch, only meant for the small unshuffled val/test splits
+        rows = tf.convert_to_tensor(rows, dtype=tf.as_dtype(self.dtype))
+        offsets = tf.range(self.window_size, dtype=tf.int64)
+        slices = np.asarray(starts, dtype=np.int64) if targets is None else (np.asarray(starts, dtype=np.int64), np.asarray(targets, dtype=self.dtype).reshape(-1, 1))
+        dataset = tf.data.Dataset.from_tensor_slices(slices)
+        if shuffle:
+            dataset = dataset.shuffle(buffer_size=len(starts), seed=seed, reshuffle_each_iteration=True)
+        dataset = dataset.batch(batch_size)
+        if targets is None:
+            dataset = dataset.map(lambda batch_starts: tf.gather(rows, batch_starts[:, tf.newaxis] + offsets), num_parallel_calls=tf.data.AUTOTUNE)
+        else:
+            dataset = dataset.map(lambda batch_starts, batch_targets: (tf.gather(rows, batch_starts[:, tf.newaxis] + offsets), batch_targets), num_parallel_calls=tf.data.AUTOTUNE)
+        if cache:
+            dataset = dataset.cache()
+
+        options = tf.data.Options()
+        options.deterministic = not shuffle
+        options.threading.max_intra_op_parallelism = 1
+        if self.threads is not None:
+            options.threading.private_threadpool_size = self.threads
+        return dataset.with_options(options).prefetch(tf.data.AUTOTUNE)
+
+
+    def from_windows(self, X:np.ndarray, y:np.ndarray=None, batch_size:int=32, shuffle:bool=False, cache:bool=False, seed:int=None):
+        # X is a window view as returned by build/transform, only its rows go into the pipeline
+        return self.dataset(rows=self.rows(X=X), starts=np.arange(len(X)), targets=y, batch_size=batch_size, shuffle=shuffle, cache=cache, seed=seed)